@@ -1,21 +1,38 @@
 import os
 import sys
-from flask import Flask, request, jsonify, send_from_directory, render_template
-import re
+from flask import Flask, request, jsonify, send_from_directory, render_template, json
 from collections import defaultdict
-import networkx as nx
-import json
+import numpy as np
 import pandas as pd
 
-df = pd.read_csv("../data/df_expanded_with_sentiment.csv")
+SENTIMENT_CSV = "../data/df_expanded_with_sentiment.csv"
+EMAIL_GRAPH_JSON = "../data/email_graph.json"
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'utils')))
-from dbop import setup_database, init_db
+from dbop import init_db, close_database, db_generation
+from db_pool import ConnectionPool, QueryTimeout
+from entity_graph import load_entity_graph, neighbourhood, graph_payload
+from response_cache import cached_json_response, response_cache_stats, files_fingerprint
+from result_cache import LRUCache
+import centrality
+from sentiment_store import load_sentiment_store, source_columns, entity_columns, as_records
+from email_graph import EMAIL_HEADERS_CSV, SUBJECT_CLUSTERS_CSV
+from email_events import load_email_events, window_graph
+from graph_stream import entity_view, payload_view, json_graph_view, graph_page, stream_response, paging_options
+from graph_layout import layout_payload, layout_cache_stats
+from communities import load_hierarchy, collapsed_view, lod_options
+from metrics import AGGREGATION_SECONDS, instrument_app, metrics_response, register_cache, register_gauge
+
+# Q2 (source, entity) sentiment aggregates, computed once per csv version and memory-mapped
+with AGGREGATION_SECONDS.time("q2_sentiment_store"):
+    sentiment = load_sentiment_store(SENTIMENT_CSV)
 
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
-init_db()
-app.conn = setup_database("../db", False)
+# reuses the existing database unless news_articles.csv or the build settings changed
+close_database(init_db())
+# requests get their own connection from a pool over the database opened read only
+app.db_pool = ConnectionPool(read_only=True)
  
 
 app.filters = {
@@ -27,6 +44,24 @@ app.filters = {
 }
 
 
+# /data results by (similarity threshold, min edge count, database generation)
+app.q1_cache = LRUCache(max_size=256)
+# PageRank and HITS scores by source graph fingerprint
+app.centrality_cache = LRUCache(max_size=256)
+# last PageRank scores, used to warm start the next computation. HITS is not warm
+# started: on a graph of several components its principal eigenvector is not unique,
+# and the result would depend on the request computed before
+app.centrality_previous = {"pagerank": {}}
+
+# request latencies and sizes, query and aggregation timings and cache ratios on /metrics
+instrument_app(app)
+register_cache("q1", app.q1_cache.stats)
+register_cache("centrality", app.centrality_cache.stats)
+register_cache("response", response_cache_stats)
+register_cache("layout", layout_cache_stats)
+register_gauge("vast_db_pool_connections", "Connections of the database pool.", app.db_pool.stats)
+
+
 @app.route('/data', methods=["POST"])
 def get_q1_data():
     req = request.get_json()
@@ -35,9 +70,27 @@ def get_q1_data():
     size_metric = configs.get("node_size", "pagerank")
     color_metric = configs.get("node_color", "referenced_by_count")
 
-    min_count = filters.get("min_edge_count", 1)
-    similarity_threshold = filters.get("similarity_threshold", 0.5)
+    # the same slider position always maps to the same key
+    min_count = int(filters.get("min_edge_count", 1))
+    similarity_threshold = round(float(filters.get("similarity_threshold", 0.5)), 6)
+
+    # the generation changes whenever articles are ingested, the pool reopens the database then
+    key = (similarity_threshold, min_count, db_generation())
+    try:
+        body = app.q1_cache.get_or_compute(
+            key, lambda: json.dumps(compute_q1_data(similarity_threshold, min_count)).encode("utf-8")
+        )
+    except QueryTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    return app.response_class(body, mimetype="application/json")
+
+
+@app.route('/data/cache', methods=["GET"])
+def get_q1_cache_stats():
+    return jsonify({**app.q1_cache.stats(), "db_pool": app.db_pool.stats()})
+
 
+def compute_q1_data(similarity_threshold, min_count):
     node_index_map = {}
     nodes_output = []
     edges_output = []
@@ -47,7 +100,7 @@ def get_q1_data():
     source_names = {}
 
     # First pass: build edge info and accumulate degree weights
-    result = app.conn.execute("""
+    edges = app.db_pool.query_df("""
         MATCH (a1:Article)-[r:References]->(a2:Article),
               (a1)-[:PublishedBy]->(s1:Source),
               (a2)-[:PublishedBy]->(s2:Source)
@@ -55,13 +108,11 @@ def get_q1_data():
         WITH s1, s2, COUNT(*) AS refCount
         WHERE refCount >= $min_count
         RETURN s1.id, s1.name, s2.id, s2.name, refCount
-    """, {"sim_thresh": similarity_threshold, "min_count": min_count})
-
-    G = nx.DiGraph()
-
-    while result.has_next():
-        s1_id, s1_name, s2_id, s2_name, count = result.get_next()
+    """, {"sim_thresh": similarity_threshold, "min_count": min_count}, name="q1_reference_edges")
+    s1_ids, s1_names, s2_ids, s2_names, counts = (edges[column].to_numpy() for column in edges.columns)
 
+    for s1_id, s1_name, s2_id, s2_name, count in zip(
+            s1_ids.tolist(), s1_names.tolist(), s2_ids.tolist(), s2_names.tolist(), counts.tolist()):
         source_names[s1_id] = s1_name
         source_names[s2_id] = s2_name
 
@@ -75,16 +126,27 @@ def get_q1_data():
             "count": count
         })
 
-        G.add_edge(s1_id, s2_id, weight=count)
-
-    # Compute PageRank and HITS scores
-    pagerank_score = nx.pagerank(G, weight='weight') if len(G) > 0 else {}
-    hits_hub, hits_auth = nx.hits(G, max_iter=1000, normalized=True) if len(G) > 0 else ({}, {})
+    # Compute PageRank and HITS scores on the sparse source graph, once per graph.
+    # PageRank starts from the previous scores so small filter changes converge
+    # quickly; it is iterated to float precision, so the scores do not depend on
+    # that start. HITS starts from uniform
+    with AGGREGATION_SECONDS.time("q1_centrality"):
+        graph_ids, src, dst = centrality.node_index(s1_ids.astype(np.int64), s2_ids.astype(np.int64))
+        A = centrality.adjacency(src, dst, counts, len(graph_ids))
+
+        def compute_centrality():
+            previous = app.centrality_previous
+            pagerank, _ = centrality.stable_pagerank(A, x0=centrality.warm_start(graph_ids, previous["pagerank"]))
+            hubs, auths, _ = centrality.hits(A, max_iter=1000)
+            return tuple(dict(zip(graph_ids.tolist(), scores.tolist())) for scores in (pagerank, hubs, auths))
+
+        pagerank_score, hits_hub, hits_auth = app.centrality_cache.get_or_compute(
+            centrality.fingerprint(graph_ids, A), compute_centrality)
+    if len(graph_ids):
+        app.centrality_previous = {"pagerank": pagerank_score}
 
     # Second pass: include all Source nodes even if isolated
-    result = app.conn.execute("MATCH (s:Source) RETURN s.id, s.name")
-    while result.has_next():
-        s_id, s_name = result.get_next()
+    for s_id, s_name in app.db_pool.query_rows("MATCH (s:Source) RETURN s.id, s.name", name="q1_sources"):
         source_names[s_id] = s_name  # ensure all names captured
 
     # Build nodes_output with all metrics
@@ -107,47 +169,10 @@ def get_q1_data():
         edge["from_idx"] = node_index_map[edge.pop("from_id")]
         edge["to_idx"] = node_index_map[edge.pop("to_id")]
 
-    return jsonify({
+    return {
         "nodes": nodes_output,
         "relations": edges_output
-    })
-
-# === 解析 Cypher 文件 ===
-def parse_cypher_file(filepath):
-    nodes = {}
-    edges = []
-    current_source = None
-    current_target = None
-
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-
-            # 解析节点
-            if line.startswith("CREATE (") and "name:" in line:
-                match = re.search(r'\(:([A-Z]+) \{name:\s*"([^"]+)"\}\)', line)
-                if match:
-                    label, name = match.groups()
-                    nodes[name] = label
-
-            # 解析MATCH行
-            elif line.startswith("MATCH") and "{name:" in line:
-                node_matches = re.findall(r'\{name:\s*"([^"]+)"\}', line)
-                if len(node_matches) == 2:
-                    current_source, current_target = node_matches
-                else:
-                    current_source, current_target = None, None
-
-            # 解析CREATE关系
-            elif line.startswith("CREATE") and current_source and current_target:
-                weight_match = re.search(r'weight:\s*(\d+)', line)
-                weight = int(weight_match.group(1)) if weight_match else 1
-                edges.append((current_source, current_target, weight))
-                current_source, current_target = None, None
-
-    node_list = [{"id": name, "label": label} for name, label in nodes.items()]
-    link_list = [{"source": src, "target": tgt, "weight": w} for src, tgt, w in edges]
-    return {"nodes": node_list, "links": link_list}
+    }
 
 @app.route("/graph", methods=["POST"])
 def get_graph_data():
@@ -157,6 +182,25 @@ def get_graph_data():
 
         dataset_type = data.get("dataset", "import")  # default to import
         organization = data.get("organization", None)
+        # neighbourhood options for the organization filter
+        hops = int(data.get("hops", 1))
+        min_weight = int(data.get("min_weight", 1))
+        labels = data.get("labels", None)
+        # one label ("PERSON") or a list of them
+        if isinstance(labels, str):
+            labels = [labels]
+        if labels is not None and not (isinstance(labels, list) and all(isinstance(label, str) for label in labels)):
+            raise ValueError("labels must be a label or a list of labels")
+        max_nodes = data.get("max_nodes", None)
+        # streamed (NDJSON) or paginated delivery, see graph_stream
+        stream = bool(data.get("stream", False))
+        paging = paging_options(data)
+        # server side x/y positions of the nodes, for whole graphs (no cursor or page_size)
+        layout = bool(data.get("layout", False)) and paging["page_size"] is None and paging["cursor"] is None
+        # level of detail: communities collapsed into supernodes, some expanded
+        lod = lod_options(data) if data.get("lod", False) else None
+        if lod and (organization or stream or any(value is not None for value in paging.values())):
+            raise ValueError("lod is served for the whole graph, without organization, paging or streaming")
         print(dataset_type)
         print(organization)
         # 选择不同的数据文件
@@ -165,28 +209,52 @@ def get_graph_data():
         else:
             cypher_path = os.path.join("../data/entity_graph_import.cypher")
         print(cypher_path)
-        graph_data = parse_cypher_file(cypher_path)
-
-        # 如果选择了组织，过滤相关节点
-        if organization:
-            filtered_nodes = set()
-            filtered_links = []
-
-            filtered_nodes.add(organization)
-            for link in graph_data['links']:
-                source = link['source']
-                target = link['target']
-                if source == organization or target == organization:
-                    filtered_links.append(link)
-                    filtered_nodes.add(source)
-                    filtered_nodes.add(target)
-
-            graph_data['nodes'] = [node for node in graph_data['nodes'] if node['id'] in filtered_nodes]
-            graph_data['links'] = filtered_links
-
-        print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
-        return jsonify(graph_data)
 
+        def subgraph():
+            # compiled once per file version, shared across requests
+            graph = load_entity_graph(cypher_path)
+
+            # 如果选择了组织，过滤相关节点
+            if organization:
+                return neighbourhood(
+                    graph, organization, hops=hops, min_weight=min_weight, labels=labels,
+                    max_nodes=int(max_nodes) if max_nodes is not None else None
+                )
+            return graph
+
+        def view():
+            graph_data = subgraph()
+            return payload_view(graph_data) if organization else entity_view(graph_data)
+
+        # the neighbourhood already applied min_weight, the full graph only filters on request
+        page_min_weight = None if organization or "min_weight" not in data else min_weight
+        if stream:
+            return stream_response(view(), paging["limit"], page_min_weight)
+
+        def build():
+            if lod:
+                graph_view = view()
+                with AGGREGATION_SECONDS.time("graph_lod"):
+                    graph_data = collapsed_view(graph_view, load_hierarchy(cypher_path, graph_view), *lod)
+            elif any(value is not None for value in paging.values()):
+                graph_data = graph_page(view(), paging["cursor"] or 0, paging["page_size"], paging["limit"], page_min_weight)
+            else:
+                graph_data = subgraph()
+                if not organization:
+                    graph_data = graph_payload(graph_data)
+            if layout:
+                filter_key = (organization, hops, min_weight, tuple(labels or ()), max_nodes, page_min_weight, paging["limit"], lod)
+                graph_data = layout_payload(graph_data, cypher_path, filter_key, files_fingerprint([cypher_path]))
+
+            print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
+            return graph_data
+
+        key = ("graph", cypher_path, organization, hops, min_weight, tuple(labels or ()), max_nodes,
+               page_min_weight, tuple(paging.values()), layout, lod)
+        return cached_json_response(key, [cypher_path], build)
+
+    except ValueError as e:
+        return jsonify({"error": f"Invalid graph parameters: {e}"}), 400
     except Exception as e:
         print(f"Error processing graph data: {e}")
         return jsonify({"error": str(e)}), 500
@@ -196,18 +264,100 @@ def get_graph_data():
 def get_email_graph_data():
     try:
         print("Received email graph data request")
-        json_file_path = os.path.join("../data/email_graph.json")
-        with open(json_file_path, "r", encoding="utf-8") as f:
-            graph_data = json.load(f)
+        # streamed (NDJSON) or paginated delivery, see graph_stream
+        paging = paging_options(request.args)
+        min_weight = request.args.get("min_weight", type=int)
+        # server side x/y positions of the nodes, for whole graphs (no cursor or page_size)
+        layout = (request.args.get("layout", "") not in ("", "0", "false")
+                  and paging["page_size"] is None and paging["cursor"] is None)
+        stream = request.args.get("stream", "") not in ("", "0", "false")
+        # level of detail: communities collapsed into supernodes, some expanded
+        lod = None
+        if request.args.get("lod", "") not in ("", "0", "false"):
+            lod = lod_options({"level": request.args.get("level"), "expand": ",".join(request.args.getlist("expand"))})
+            if stream or min_weight is not None or any(value is not None for value in paging.values()):
+                raise ValueError("lod is served for the whole graph, without min_weight, paging or streaming")
+        if stream:
+            return stream_response(json_graph_view(EMAIL_GRAPH_JSON), paging["limit"], min_weight)
+
+        def build():
+            if lod:
+                graph_view = json_graph_view(EMAIL_GRAPH_JSON)
+                with AGGREGATION_SECONDS.time("email_graph_lod"):
+                    graph_data = collapsed_view(graph_view, load_hierarchy(EMAIL_GRAPH_JSON, graph_view), *lod)
+            elif min_weight is not None or any(value is not None for value in paging.values()):
+                graph_data = graph_page(json_graph_view(EMAIL_GRAPH_JSON), paging["cursor"] or 0,
+                                        paging["page_size"], paging["limit"], min_weight)
+            else:
+                with open(EMAIL_GRAPH_JSON, "r", encoding="utf-8") as f:
+                    graph_data = json.load(f)
+            if layout:
+                graph_data = layout_payload(graph_data, EMAIL_GRAPH_JSON, (min_weight, paging["limit"], lod),
+                                            files_fingerprint([EMAIL_GRAPH_JSON]))
+            print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
+            return graph_data
+
+        key = ("email_graph", min_weight, tuple(paging.values()), layout, lod)
+        return cached_json_response(key, [EMAIL_GRAPH_JSON], build)
+
+    except ValueError as e:
+        return jsonify({"error": f"Invalid graph parameters: {e}"}), 400
+    except Exception as e:
+        print(f"Error processing email graph data: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
-        return jsonify(graph_data)
 
+@app.route("/email_graph/window", methods=["GET"])
+def get_email_graph_window():
+    '''
+    email graph of the mails sent between start and end (inclusive, any
+    pandas timestamp e.g. 2014-01-17 or 2014-01-17T08:00), optionally only
+    those of one subject cluster. start or end may be left out.
+    '''
+    try:
+        start = request.args.get("start")
+        end = request.args.get("end")
+        subject = request.args.get("subject")
+        start = pd.Timestamp(start) if start else None
+        end = pd.Timestamp(end) if end else None
+        # a bare date as end means the whole day
+        if end is not None and len(request.args["end"]) <= 10:
+            end = end + pd.Timedelta(days=1) - pd.Timedelta(1)
+        print(f"Received email graph window request {start} - {end} {subject}")
+
+        def build():
+            graph_data = window_graph(load_email_events(), start, end, subject)
+            with open(EMAIL_GRAPH_JSON, "r", encoding="utf-8") as f:
+                nodes = {node["id"]: node for node in json.load(f)["nodes"]}
+            graph_data["nodes"] = [
+                nodes.get(name, {"id": name, "label": "PERSON", "department": None}) for name in graph_data["nodes"]
+            ]
+            print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
+            return graph_data
+
+        key = ("email_graph_window", start, end, subject)
+        return cached_json_response(key, [EMAIL_HEADERS_CSV, SUBJECT_CLUSTERS_CSV, EMAIL_GRAPH_JSON], build)
+
+    except ValueError as e:
+        return jsonify({"error": f"Invalid time range: {e}"}), 400
     except Exception as e:
-        print(f"Error processing email graph data: {e}")
+        print(f"Error processing email graph window: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/email_graph/subjects", methods=["GET"])
+def get_email_subjects():
+    return cached_json_response(
+        ("email_subjects",), [EMAIL_HEADERS_CSV, SUBJECT_CLUSTERS_CSV],
+        lambda: load_email_events()["cluster_names"]
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return metrics_response()
+
+
 @app.route("/status", methods=["GET"])
 def api_status():
     try:
@@ -217,66 +367,55 @@ def api_status():
 
 @app.route("/q2/entities")
 def get_entities():
-    entities = sorted(df["entities"].dropna().unique())
-    return jsonify(entities)
+    return cached_json_response(("q2_entities",), [SENTIMENT_CSV], lambda: sentiment["entities"])
 
 @app.route("/q2/sources")
 def get_sources():
-    sources = sorted(df["source"].dropna().unique())
-    return jsonify(sources)
+    return cached_json_response(("q2_sources",), [SENTIMENT_CSV], lambda: sentiment["sources"])
 
 @app.route("/q2/source_data")
 def get_source_data():
     source = request.args.get("source")
     if not source:
         return jsonify([])
-    filtered = df[df["source"] == source]
-    # Group by entity, get mean sentiment and the first content for each entity
-    pivot = (
-        filtered.groupby("entities")
-        .agg({"entity_sentiment": "mean", "content": "first"})
-        .reset_index()
-    )
-    result = pivot.rename(
-        columns={"entities": "x", "entity_sentiment": "y", "content": "content"}
-    ).to_dict(orient="records")
-    return jsonify(result)
+    # mean sentiment and the first content for each entity, precomputed per source
+    with AGGREGATION_SECONDS.time("q2_source_data"):
+        columns = source_columns(sentiment, source)
+        records = as_records(columns["entities"], columns["sentiments"], columns["contents"])
+    return jsonify(records)
 
 @app.route("/q2/source_entity_heatmap")
 def source_entity_heatmap():
     source = request.args.get("source")
     if not source:
         return jsonify({"entities": [], "sentiments": [], "contents": []})
-    filtered = df[df["source"] == source]
-    # Group by entity, get mean sentiment and the first content for each entity
-    pivot = (
-        filtered.groupby("entities")
-        .agg({"entity_sentiment": "mean", "content": "first"})
-        .reset_index()
-    )
-    result = {
-        "entities": pivot["entities"].tolist(),
-        "sentiments": pivot["entity_sentiment"].tolist(),
-        "contents": pivot["content"].tolist()
-    }
-    return jsonify(result)
+    with AGGREGATION_SECONDS.time("q2_source_entity_heatmap"):
+        columns = source_columns(sentiment, source)
+    return jsonify(columns)
 
 @app.route("/q2/data")
 def get_q2_data():
     entity = request.args.get("entity")
     if not entity:
         return jsonify([])
-    filtered = df[df["entities"] == entity]
-    # Group by source, get mean sentiment and the first content for each source
-    pivot = (
-        filtered.groupby("source")
-        .agg({"entity_sentiment": "mean", "content": "first"})
-        .reset_index()
-    )
-    result = pivot.rename(
-        columns={"source": "x", "entity_sentiment": "y", "content": "content"}
-    ).to_dict(orient="records")
-    return jsonify(result)
+    # mean sentiment and the first content for each source, precomputed per entity
+    with AGGREGATION_SECONDS.time("q2_data"):
+        columns = entity_columns(sentiment, entity)
+        records = as_records(columns["sources"], columns["sentiments"], columns["contents"])
+    return jsonify(records)
+
+
+def warm_data():
+    '''
+    load every artifact the routes otherwise load on first use: the entity graph
+    stores (built if missing, then memory-mapped), the email graph, the community
+    hierarchies and the email event index. serve.py calls it before forking so
+    the workers share them instead of each building its own.
+    '''
+    for cypher_path in ("../data/entity_graph_import.cypher", "../data/entity_graph_article.cypher"):
+        load_hierarchy(cypher_path, entity_view(load_entity_graph(cypher_path)))
+    load_hierarchy(EMAIL_GRAPH_JSON, json_graph_view(EMAIL_GRAPH_JSON))
+    load_email_events()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+import os
+import gc
+import sys
+import time
+import socket
+import signal
+import shutil
+import argparse
+import tempfile
+
+# workers default to one per core, each serving requests on a few threads
+WORKERS = os.cpu_count() or 1
+HOST = "127.0.0.1"
+PORT = 5002
+# a worker that dies sooner than this after starting is not restarted (seconds)
+MIN_WORKER_LIFETIME = 1.0
+
+
+def listen(host, port, backlog=128):
+    '''the listening socket, opened before forking so every worker accepts on it'''
+    sock = socket.create_server((host, port), backlog=backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, threaded=True):
+    '''serve app on the inherited socket until the worker is told to stop'''
+    from werkzeug.serving import make_server
+    from metrics import METRICS_DIR, start_metrics_writer
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if METRICS_DIR:
+        # /metrics, on whichever worker answers it, merges the files of all workers
+        start_metrics_writer(METRICS_DIR)
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=threaded, fd=sock.fileno())
+    print(f"Worker {os.getpid()} serving")
+    server.serve_forever()
+
+
+def spawn(app, sock, threaded):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(app, sock, threaded)
+        except BaseException as e:
+            print(f"Worker {os.getpid()} stopped: {e!r}")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve(app, sock, workers=WORKERS, threaded=True):
+    '''
+    fork workers processes serving app on sock and restart any that dies,
+    until SIGINT or SIGTERM, which is passed on to the workers.
+    '''
+    # objects loaded so far are never collected, the collector would otherwise
+    # write to their pages and unshare them from the workers
+    gc.freeze()
+    started = {spawn(app, sock, threaded): time.monotonic() for _ in range(workers)}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(started):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Serving on http://{sock.getsockname()[0]}:{sock.getsockname()[1]} with {workers} workers")
+
+    while started:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        lifetime = time.monotonic() - started.pop(pid, time.monotonic())
+        if stopping:
+            continue
+        if lifetime < MIN_WORKER_LIFETIME:
+            print(f"Worker {pid} exited right after starting (status {status}), not restarting it")
+            continue
+        print(f"Worker {pid} exited (status {status}), restarting it")
+        started[spawn(app, sock, threaded)] = time.monotonic()
+    sock.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Serve the backend with pre-forked worker processes sharing the memory-mapped data"
+    )
+    arg_parser.add_argument("--host", default=HOST)
+    arg_parser.add_argument("--port", type=int, default=PORT)
+    arg_parser.add_argument("--workers", type=int, default=WORKERS)
+    arg_parser.add_argument("--no-threads", action="store_true", help="one request at a time per worker")
+    arg_parser.add_argument("--db-buffer-mb", type=int, default=None,
+                            help="database page cache of each worker (MB), see VAST_DB_BUFFER_POOL_MB")
+    arg_parser.add_argument("--metrics-dir", default=None,
+                            help="directory the workers write their metrics to, merged on /metrics "
+                                 "(default: a temporary directory removed on exit), see VAST_METRICS_DIR")
+    args = arg_parser.parse_args()
+    if args.db_buffer_mb is not None:
+        os.environ["VAST_DB_BUFFER_POOL_MB"] = str(args.db_buffer_mb)
+    metrics_dir = args.metrics_dir or os.environ.get("VAST_METRICS_DIR")
+    remove_metrics_dir = metrics_dir is None
+    if metrics_dir is None:
+        metrics_dir = tempfile.mkdtemp(prefix="vast-metrics-")
+    # counts of an earlier run would be merged into this one
+    os.makedirs(metrics_dir, exist_ok=True)
+    for name in os.listdir(metrics_dir):
+        if name.endswith(".json") and name[:-len(".json")].isdigit():
+            os.remove(os.path.join(metrics_dir, name))
+    os.environ["VAST_METRICS_DIR"] = metrics_dir
+
+    # importing the backend builds (or reuses) the database and the data stores, once, here.
+    # the workers inherit the loaded module and only open the database read only
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as backend
+    backend.warm_data()
+    try:
+        serve(backend.app, listen(args.host, args.port), args.workers, threaded=not args.no_threads)
+    finally:
+        if remove_metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import statistics
+import tracemalloc
+import importlib.util
+from datetime import datetime
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(BENCH_DIR)
+sys.path.append(os.path.join(BENCH_DIR, '..', 'utils'))
+from synthetic_corpus import generate_corpus
+import parse_news
+import preliminary
+import dbop
+
+APP_PATH = os.path.join(BENCH_DIR, '..', 'backend', 'app.py')
+BASELINE_JSON = os.path.join(BENCH_DIR, "baseline.json")
+# a result is a regression when it is this many times slower than the baseline ...
+REGRESSION_RATIO = 1.25
+# ... and slower by more than this, so timer noise on fast calls is not flagged (seconds)
+REGRESSION_MIN_DELTA = 0.02
+WINDOW_START = "2014-01-08"
+WINDOW_END = "2014-01-10"
+
+
+def measure(results, name, fn):
+    '''
+    run fn once and record its wall time, the peak of python (and numpy)
+    allocations during the call and the peak rss of the process after it.
+    return the result of fn
+    '''
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        value = fn()
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results[name] = {
+        "seconds": elapsed,
+        "peak_mb": peak / 2**20,
+        # kilobytes on linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    }
+    print(f"{name:<50} {elapsed:9.3f}s {peak / 2**20:9.1f} MB")
+    return value
+
+
+def measure_request(results, client, name, method, url, body=None, repeat=5):
+    '''
+    time one endpoint: the first call (cold, it fills the caches) is measured like
+    a pipeline stage, the median of repeat further calls is recorded as "<name> (cached)"
+    '''
+    def call():
+        response = client.open(url, method=method, json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"{method} {url} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        return response
+
+    response = measure(results, name, call)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    if timings:
+        results[f"{name} (cached)"] = {"seconds": statistics.median(timings)}
+        print(f"{name + ' (cached)':<50} {statistics.median(timings):9.3f}s")
+    return response.get_json()
+
+
+def load_app():
+    '''import the backend from its file, startup builds the database and the Q2 store'''
+    spec = importlib.util.spec_from_file_location("benchmark_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+def run_pipeline(results, workers=None):
+    '''time the offline stages, run with the working directory next to data/ and db/'''
+    measure(results, "create_news_csv", lambda: parse_news.create_news_csv(workers=workers))
+    measure(results, "calc_sim_matrix", preliminary.calc_sim_matrix)
+    connection = measure(results, "init_db (full build)", lambda: dbop.init_db(force=True))
+    try:
+        measure(results, "init_references_rel", lambda: dbop.init_references_rel(connection))
+    finally:
+        dbop.close_database(connection)
+
+
+def run_endpoints(results, app, repeat=5):
+    client = app.test_client()
+    for threshold in (0.5, 0.8):
+        filters = {"similarity_threshold": threshold, "min_edge_count": 1}
+        measure_request(results, client, f"POST /data similarity>={threshold}", "POST", "/data",
+                        {"filters": filters, "configs": {}}, repeat)
+
+    for dataset in ("import", "article"):
+        graph = measure_request(results, client, f"POST /graph {dataset}", "POST", "/graph", {"dataset": dataset}, repeat)
+        measure_request(results, client, f"POST /graph {dataset} lod", "POST", "/graph", {"dataset": dataset, "lod": True}, repeat)
+    # the organization with the most links, a worst case for the neighbourhood view
+    degrees = {}
+    for link in graph["links"]:
+        for end in ("source", "target"):
+            degrees[link[end]] = degrees.get(link[end], 0) + 1
+    labels = {node["id"]: node["label"] for node in graph["nodes"]}
+    organizations = [name for name in degrees if labels.get(name) == "ORG"] or list(degrees)
+    if organizations:
+        organization = max(organizations, key=degrees.get)
+        measure_request(results, client, "POST /graph article organization", "POST", "/graph",
+                        {"dataset": "article", "organization": organization}, repeat)
+        measure_request(results, client, "POST /graph article organization 2 hops", "POST", "/graph",
+                        {"dataset": "article", "organization": organization, "hops": 2}, repeat)
+
+    entities = measure_request(results, client, "GET /q2/entities", "GET", "/q2/entities", repeat=repeat)
+    sources = measure_request(results, client, "GET /q2/sources", "GET", "/q2/sources", repeat=repeat)
+    if sources:
+        measure_request(results, client, "GET /q2/source_data", "GET", f"/q2/source_data?source={sources[0]}", repeat=repeat)
+        measure_request(results, client, "GET /q2/source_entity_heatmap", "GET",
+                        f"/q2/source_entity_heatmap?source={sources[0]}", repeat=repeat)
+    if entities:
+        measure_request(results, client, "GET /q2/data", "GET", f"/q2/data?entity={entities[0]}", repeat=repeat)
+
+    measure_request(results, client, "GET /email_graph", "GET", "/email_graph", repeat=repeat)
+    measure_request(results, client, "GET /email_graph lod", "GET", "/email_graph?lod=1", repeat=repeat)
+    measure_request(results, client, "GET /email_graph/window", "GET",
+                    f"/email_graph/window?start={WINDOW_START}&end={WINDOW_END}", repeat=repeat)
+
+
+def run_benchmarks(workdir, scale=1.0, seed=0, repeat=5, workers=None):
+    '''
+    generate a corpus of scale x the shipped one in workdir/data, then time every
+    pipeline stage and endpoint against it. return the results by name
+    '''
+    data_dir = os.path.join(workdir, "data")
+    run_dir = os.path.join(workdir, "run")
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(run_dir)
+
+    results = {}
+    n_articles, n_mails = measure(results, "generate corpus", lambda: generate_corpus(data_dir, scale, seed))
+    print(f"Generated {n_articles} articles and {n_mails} mails in {data_dir}")
+
+    # the app and the utils resolve ../data and ../db against the working directory
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        run_pipeline(results, workers)
+        app = measure(results, "app startup", load_app)
+        try:
+            run_endpoints(results, app, repeat)
+        finally:
+            app.db_pool.close()
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def compare(results, baseline, ratio=REGRESSION_RATIO, min_delta=REGRESSION_MIN_DELTA):
+    '''names of the results slower than the baseline by more than ratio and min_delta'''
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous or not previous["seconds"]:
+            continue
+        change = result["seconds"] / previous["seconds"]
+        slower = change > ratio and result["seconds"] - previous["seconds"] > min_delta
+        flag = "REGRESSION" if slower else ""
+        print(f"{name:<50} {previous['seconds']:9.3f}s -> {result['seconds']:9.3f}s {change:6.2f}x {flag}")
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def read_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark the pipeline and the endpoints on a synthetic corpus")
+    arg_parser.add_argument("--scale", type=float, default=1.0, help="corpus size relative to the shipped 845 articles")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--workdir", default="/tmp/vast_benchmark", help="directory the corpus and database are written to")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="cached calls timed per endpoint")
+    arg_parser.add_argument("--workers", type=int, default=None, help="processes used to parse the articles")
+    arg_parser.add_argument("--baseline", default=BASELINE_JSON, help="json file holding the baseline of every scale")
+    arg_parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline of this scale")
+    arg_parser.add_argument("--threshold", type=float, default=REGRESSION_RATIO, help="slowdown ratio flagged as a regression")
+    args = arg_parser.parse_args()
+
+    results = run_benchmarks(os.path.abspath(args.workdir), args.scale, args.seed, args.repeat, args.workers)
+    with open(os.path.join(args.workdir, "results.json"), "w", encoding="utf-8") as f:
+        json.dump({"scale": args.scale, "seed": args.seed, "results": results}, f, indent=2)
+
+    baselines = read_baselines(args.baseline)
+    key = str(args.scale)
+    if args.save_baseline:
+        baselines[key] = {"recorded": datetime.now().isoformat(timespec="seconds"), "seed": args.seed, "results": results}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Saved baseline for scale {key} to {args.baseline}")
+    elif key in baselines:
+        regressions = compare(results, baselines[key]["results"], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions against the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+    else:
+        print(f"No baseline for scale {key} in {args.baseline}, run with --save-baseline to record one")
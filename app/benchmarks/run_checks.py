@@ -0,0 +1,178 @@
+import os
+import sys
+import shutil
+import argparse
+import subprocess
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(BENCH_DIR)
+sys.path.append(os.path.join(BENCH_DIR, '..', 'utils'))
+from synthetic_corpus import generate_corpus, _article_text
+import parse_news
+import preliminary
+import centrality
+import dbop
+from email_graph import EMAIL_HEADERS_CSV, SUBJECT_CLUSTERS_CSV, read_headers, load_subject_clusters
+from email_events import build_email_events, window_counts
+
+# a serving process: a read-only pool counting the articles on every line of its stdin
+READER_SCRIPT = """
+import sys
+sys.path.append(sys.argv[1])
+from db_pool import ConnectionPool
+pool = ConnectionPool(read_only=True)
+for line in sys.stdin:
+    print(pool.query_rows("MATCH (a:ARTICLE) RETURN count(*)")[0][0], flush=True)
+"""
+WINDOW_START = "2014-01-08"
+WINDOW_END = "2014-01-10"
+
+
+def check_email_events():
+    '''
+    build the email event index with a prefix budget below two boundaries (it
+    then has no prefix table) and check its window counts against the default index
+    '''
+    rows, clusters = read_headers(EMAIL_HEADERS_CSV), load_subject_clusters(SUBJECT_CLUSTERS_CSV)
+    index = build_email_events(rows, clusters)
+    over_budget = build_email_events(rows, clusters, max_cells=max(2 * index["n_combos"] - 1, 1))
+    if over_budget["prefix"] is not None:
+        raise AssertionError("email events kept a prefix table over its budget")
+    for start, end in ((None, None), (pd.Timestamp(WINDOW_START), pd.Timestamp(WINDOW_END))):
+        if not np.array_equal(window_counts(index, start, end), window_counts(over_budget, start, end)):
+            raise AssertionError(f"email window counts without a prefix table differ for {start} - {end}")
+
+
+def check_centrality_warm_start(seed=0, n=500, n_edges=3000):
+    '''
+    PageRank of a random weighted graph, from uniform and warm started from the
+    scores of the graph with a tenth of its edges dropped, must return the same scores
+    '''
+    rng = np.random.default_rng(seed)
+    src, dst = rng.integers(0, n, n_edges), rng.integers(0, n, n_edges)
+    weights = rng.integers(1, 20, n_edges)
+    kept = rng.random(n_edges) > 0.1
+    previous, _ = centrality.stable_pagerank(centrality.adjacency(src[kept], dst[kept], weights[kept], n))
+    A = centrality.adjacency(src, dst, weights, n)
+    cold, _ = centrality.stable_pagerank(A)
+    warm, _ = centrality.stable_pagerank(A, x0=previous)
+    if not np.array_equal(cold, warm):
+        raise AssertionError(f"warm started pagerank differs from the cold one by up to {np.abs(cold - warm).max()}")
+
+
+def build_database():
+    '''the news csv, similarity matrix and a full database build of the corpus'''
+    parse_news.create_news_csv(workers=1)
+    preliminary.calc_sim_matrix()
+    dbop.close_database(dbop.init_db(force=True))
+
+
+def _write_article(article_id, source, title, content):
+    path = Path("..", "data", "ingest", f"{article_id}.txt")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(_article_text(source, title, "2014/01/20", None, None, content), encoding="utf-8")
+    return path
+
+
+def check_ingest_roundtrip():
+    '''
+    ingest an article whose title and content start with a quote, then rebuild
+    the database from the news csv it was appended to and read the article back
+    '''
+    build_database()
+    article_id = int(preliminary.load_articles().index.max()) + 1
+    path = _write_article(article_id, "Ingested Source", '"Quoted" title', '"Quoted" content with a | pipe and ~tildes~')
+    expected = parse_news.read_article(path)
+    dbop.close_database(dbop.ingest_articles([str(path)]))
+
+    connection = dbop.init_db(force=True)
+    try:
+        rows = connection.execute(
+            "MATCH (a:ARTICLE) WHERE a.id = $id RETURN a.title, a.content", {"id": article_id}
+        ).get_as_df().values.tolist()
+    finally:
+        dbop.close_database(connection)
+    if rows != [[expected["title"], expected["content"]]]:
+        raise AssertionError(f"ingested article {article_id} read back after a rebuild as {rows}, "
+                             f"expected {[expected['title'], expected['content']]}")
+
+
+def check_live_ingest():
+    '''
+    ingest an article while another process serves the database read only:
+    the ingest gets the database, and the server sees the article afterwards
+    without being restarted
+    '''
+    article_id = int(preliminary.load_articles().index.max()) + 1
+    path = _write_article(article_id, "Live Source", "Live ingest", "Content ingested while a server runs")
+    reader = subprocess.Popen([sys.executable, "-c", READER_SCRIPT, os.path.join(BENCH_DIR, '..', 'utils')],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def count():
+        reader.stdin.write("count\n")
+        reader.stdin.flush()
+        # the pool logs to stdout as well
+        line = reader.stdout.readline()
+        while line and not line.strip().isdigit():
+            line = reader.stdout.readline()
+        return int(line)
+
+    try:
+        before = count()
+        dbop.close_database(dbop.ingest_articles([str(path)]))
+        after = count()
+    finally:
+        reader.kill()
+        reader.wait()
+    if after != before + 1:
+        raise AssertionError(f"the server counted {before} articles before the live ingest and {after} after it")
+
+
+# run in order, with the working directory next to the corpus data/ (and db/)
+CHECKS = [check_email_events, check_centrality_warm_start, check_ingest_roundtrip, check_live_ingest]
+
+
+def run_checks(workdir, scale=0.1, seed=0, checks=CHECKS):
+    '''
+    generate a corpus of scale x the shipped one in workdir/data and run every
+    check against it. correctness only, timings are run_benchmarks' job.
+    return the names of the failed checks
+    '''
+    data_dir = os.path.join(workdir, "data")
+    run_dir = os.path.join(workdir, "run")
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(run_dir)
+    generate_corpus(data_dir, scale, seed)
+
+    failures = []
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        for check in checks:
+            try:
+                check()
+            except Exception as e:
+                print(f"FAIL {check.__name__}: {e!r}")
+                failures.append(check.__name__)
+            else:
+                print(f"ok   {check.__name__}")
+    finally:
+        os.chdir(cwd)
+    return failures
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Correctness checks of the pipeline on a synthetic corpus")
+    arg_parser.add_argument("--scale", type=float, default=0.1, help="corpus size relative to the shipped 845 articles")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--workdir", default="/tmp/vast_checks", help="directory the corpus and database are written to")
+    args = arg_parser.parse_args()
+
+    failures = run_checks(os.path.abspath(args.workdir), args.scale, args.seed)
+    if failures:
+        print(f"{len(failures)} checks failed: {', '.join(failures)}")
+        sys.exit(1)
+    print("All checks passed")
@@ -0,0 +1,210 @@
+import os
+import sys
+import csv
+import json
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'utils')))
+from parse_news import KNOWN_DATE_FORMATS
+from email_graph import clean_headers, build_email_graph
+from entity_cooccurrence import build_cypher
+
+# the shipped corpus the distributions are sampled from
+REFERENCE_DATA = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+SHIPPED_ARTICLES = 845
+SHIPPED_MAILS = 1175
+# share of articles that rewrite an earlier article, and the share of its words that change
+REWRITE_SHARE = 0.4
+REWRITE_CHANGED = (0.05, 0.3)
+WORDS_PER_SENTENCE = 20
+MAIL_START = datetime(2014, 1, 6)
+MAIL_DAYS = 12
+
+
+def reference_distributions(data_dir=REFERENCE_DATA):
+    '''
+    empirical distributions of the shipped corpus: word and source frequencies,
+    article lengths, entities with their labels, sentiments, mail senders,
+    recipient counts and subjects.
+    '''
+    articles = pd.read_csv(os.path.join(data_dir, "news_articles.csv"), sep="|", quotechar="~")
+    words = Counter(word for content in articles["content"].fillna("") for word in content.split())
+    sentiment = pd.read_csv(os.path.join(data_dir, "df_expanded_with_sentiment.csv"))
+    entities = sentiment["entities"].value_counts()
+    with open(os.path.join(data_dir, "raw_data", "sentence_entities.json"), "r", encoding="utf-8") as f:
+        labels = {entity["text"].strip().lower(): entity["label"] for record in json.load(f) for entity in record["entities"]}
+    headers = clean_headers(pd.read_csv(os.path.join(data_dir, "email headers.csv"), encoding="latin1"))
+    clusters = pd.read_csv(os.path.join(data_dir, "raw_data", "Clustered_Email_Subjects.csv"), index_col=0)
+    clusters = clusters.drop_duplicates("titles")
+    mails = headers.drop_duplicates(["sender", "date", "subject"])
+
+    return {
+        "words": np.array(list(words)),
+        "word_cdf": np.cumsum(list(words.values())) / sum(words.values()),
+        "sources": articles["source"].value_counts(normalize=True),
+        "lengths": articles["content"].fillna("").str.split().str.len().to_numpy(),
+        "locations": articles["location"].dropna().to_numpy(),
+        "authors": articles.loc[articles["author"] != "NULL", "author"].dropna().to_numpy(),
+        "entities": entities.index.to_numpy(),
+        "entity_p": entities.to_numpy() / entities.sum(),
+        "entity_labels": labels,
+        "entities_per_article": sentiment.groupby("articleID").size().to_numpy(),
+        "article_sentiments": sentiment.drop_duplicates("articleID")["sentiment"].to_numpy(),
+        "entity_sentiments": sentiment["entity_sentiment"].to_numpy(),
+        "senders": headers["sender"].value_counts(normalize=True),
+        "recipient_counts": headers.groupby(["sender", "date", "subject"]).size().to_numpy(),
+        "subjects": mails["subject"].to_numpy(),
+        "subject_clusters": dict(zip(clusters["titles"], clusters["subject"])),
+        "departments": pd.read_csv(os.path.join(data_dir, "raw_data", "people_color.csv")),
+    }
+
+
+def _sample_words(rng, ref, size):
+    # inverse cdf sampling, rng.choice with p recomputes the cdf on every call
+    return ref["words"][np.minimum(np.searchsorted(ref["word_cdf"], rng.random(size)), len(ref["words"]) - 1)]
+
+
+def _article_text(source, title, date, author, location, content):
+    lines = [f"SOURCE: {source}", "", f"TITLE: {title}", "", f"PUBLISHED: {date}"]
+    if author is not None:
+        lines += [f"AUTHOR: {author}"]
+    if location is not None:
+        lines += ["", f"LOCATION: {location}"]
+    return "\n".join(lines + ["", content, ""])
+
+
+def generate_articles(out_dir, n_articles, ref, rng):
+    '''
+    write n_articles files to out_dir/News Articles/<source>/<id>.txt and return
+    (article rows, sentence entity records). a share of the articles rewrites an
+    earlier one, so similarity edges between sources appear as in the real corpus.
+    '''
+    sources = ref["sources"].index.to_numpy()
+    article_sources = rng.choice(sources, size=n_articles, p=ref["sources"].to_numpy())
+    lengths = rng.choice(ref["lengths"], size=n_articles)
+    articles, records = [], []
+    for article_id in range(n_articles):
+        source = article_sources[article_id]
+        if article_id and rng.random() < REWRITE_SHARE:
+            original = articles[rng.integers(len(articles))]
+            words = original["content"].split()
+            changed = rng.random(len(words)) < rng.uniform(*REWRITE_CHANGED)
+            words = np.where(changed, _sample_words(rng, ref, len(words)), words).tolist()
+            entities = original["entities"]
+        else:
+            words = _sample_words(rng, ref, max(int(lengths[article_id]), 5)).tolist()
+            n_entities = int(rng.choice(ref["entities_per_article"]))
+            entities = list(dict.fromkeys(rng.choice(ref["entities"], size=n_entities, p=ref["entity_p"]).tolist()))
+
+        # mention every entity somewhere in the text
+        for entity in entities:
+            words.insert(int(rng.integers(len(words) + 1)), entity.title())
+        content = " ".join(words)
+        date = datetime(1982, 1, 1) + timedelta(days=int(rng.integers(32 * 365)))
+        author = rng.choice(ref["authors"]) if rng.random() < 0.15 else None
+        location = rng.choice(ref["locations"]) if rng.random() < 0.64 else None
+        title = " ".join(_sample_words(rng, ref, int(rng.integers(3, 9)))).upper()
+
+        path = os.path.join(out_dir, "News Articles", source, f"{article_id}.txt")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(_article_text(source, title, date.strftime(rng.choice(KNOWN_DATE_FORMATS)), author, location, content))
+        articles.append({"id": article_id, "source": source, "title": title, "author": author,
+                         "publish_date": date.strftime("%Y-%m-%d"), "location": location,
+                         "content": content, "entities": entities})
+
+        n_sentences = max(len(words) // WORDS_PER_SENTENCE, 1)
+        sentences = [[] for _ in range(n_sentences)]
+        for entity in entities:
+            sentences[int(rng.integers(n_sentences))].append(entity)
+        for sentence_index, sentence_entities in enumerate(sentences):
+            records.append({
+                "articleID": article_id,
+                "sentence_index": sentence_index,
+                "entities": [{"text": entity, "label": ref["entity_labels"].get(entity, "PERSON")} for entity in sentence_entities],
+            })
+    return articles, records
+
+
+def write_sentiment_csv(path, articles, ref, rng):
+    '''rows in the df_expanded_with_sentiment.csv layout, one per (article, entity)'''
+    rows = []
+    for article in articles:
+        sentiment = float(rng.choice(ref["article_sentiments"]))
+        for entity in article["entities"]:
+            rows.append({
+                "articleID": article["id"], "source": article["source"], "title": article["title"],
+                "author": article["author"], "publish_date": article["publish_date"], "location": article["location"],
+                "content": article["content"], "sentiment": sentiment, "entities": entity,
+                "entity_sentiment": float(rng.choice(ref["entity_sentiments"])),
+            })
+    pd.DataFrame(rows).to_csv(path, index=False)
+    return len(rows)
+
+
+def write_email_headers(path, n_mails, ref, rng):
+    '''mails over MAIL_DAYS days of office hours, with the shipped sender and recipient count distributions'''
+    people = ref["senders"].index.to_numpy()
+    senders = rng.choice(people, size=n_mails, p=ref["senders"].to_numpy())
+    recipient_counts = rng.choice(ref["recipient_counts"], size=n_mails)
+    starts = rng.integers(MAIL_DAYS, size=n_mails) * 86400 + rng.integers(7 * 3600, 19 * 3600, size=n_mails)
+    with open(path, "w", newline="", encoding="latin1") as f:
+        writer = csv.writer(f)
+        writer.writerow(["From", "To", "Date", "Subject"])
+        for sender, count, start in sorted(zip(senders, recipient_counts, starts), key=lambda mail: mail[2]):
+            recipients = rng.choice(people, size=min(int(count), len(people)), replace=False)
+            date = MAIL_START + timedelta(seconds=int(start))
+            writer.writerow([
+                f"{sender}@gastech.com.kronos",
+                ", ".join(f"{recipient}@gastech.com.kronos" for recipient in recipients),
+                f"{date.month}/{date.day}/{date.year} {date.hour}:{date.minute:02d}",
+                rng.choice(ref["subjects"]),
+            ])
+
+
+def generate_corpus(out_dir, scale=1.0, seed=0, reference_dir=REFERENCE_DATA):
+    '''
+    write a synthetic corpus of scale x the shipped one to out_dir (used as the
+    "data" directory): the article files, the expanded sentiment csv, the email
+    headers and the graph artifacts derived from them.
+    return the number of articles and mails
+    '''
+    rng = np.random.default_rng(seed)
+    ref = reference_distributions(reference_dir)
+    n_articles = max(int(round(SHIPPED_ARTICLES * scale)), 2)
+    n_mails = max(int(round(SHIPPED_MAILS * scale)), 2)
+    raw_dir = os.path.join(out_dir, "raw_data")
+    os.makedirs(raw_dir, exist_ok=True)
+
+    articles, records = generate_articles(out_dir, n_articles, ref, rng)
+    write_sentiment_csv(os.path.join(out_dir, "df_expanded_with_sentiment.csv"), articles, ref, rng)
+    with open(os.path.join(raw_dir, "sentence_entities.json"), "w", encoding="utf-8") as f:
+        json.dump(records, f)
+    build_cypher(os.path.join(raw_dir, "sentence_entities.json"), os.path.join(out_dir, "entity_graph_import.cypher"), "sentence")
+    build_cypher(os.path.join(raw_dir, "sentence_entities.json"), os.path.join(out_dir, "entity_graph_article.cypher"), "article")
+
+    headers_path = os.path.join(out_dir, "email headers.csv")
+    write_email_headers(headers_path, n_mails, ref, rng)
+    clusters = pd.DataFrame({"titles": list(ref["subject_clusters"]), "subject": list(ref["subject_clusters"].values())})
+    clusters.to_csv(os.path.join(raw_dir, "Clustered_Email_Subjects.csv"))
+    ref["departments"].to_csv(os.path.join(raw_dir, "people_color.csv"), index=False)
+    departments = dict(zip(ref["departments"]["name"], ref["departments"]["class"]))
+    graph = build_email_graph(clean_headers(pd.read_csv(headers_path, encoding="latin1")),
+                              {title: cluster.lower() for title, cluster in ref["subject_clusters"].items()}, departments)
+    with open(os.path.join(out_dir, "email_graph.json"), "w", encoding="utf-8") as f:
+        json.dump(graph, f, indent=2)
+    return n_articles, n_mails
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Write a synthetic VAST-style corpus")
+    arg_parser.add_argument("out_dir", help="data directory to write")
+    arg_parser.add_argument("--scale", type=float, default=1.0, help="size relative to the shipped corpus")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+    n_articles, n_mails = generate_corpus(args.out_dir, args.scale, args.seed)
+    print(f"Wrote {n_articles} articles and {n_mails} mails to {args.out_dir}")
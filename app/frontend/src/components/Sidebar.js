@@ -94,12 +94,12 @@ const SidebarFilter = ({ currentQ, setData }) => {
   useEffect(() => {
     const fetchAndRenderQ3Data = async () => {
       if (Q3Graph == 'org-person'){
-        const data = await API.fetchGraphData({ dataset: graphSource });
+        const data = await API.fetchGraphData({ dataset: graphSource, layout: true });
         setQ3Data(data);
         applyFilters(data, Q3PendingFilters.organization, Q3PendingFilters.min_cooccurence, Q3PendingFilters.person);
       }
       else if (Q3Graph == 'person-person') {
-        const data = await API.fetchEmailGraphData();
+        const data = await API.fetchEmailGraphData({ layout: true });
         setQ3Data(data);
         applyEmailFilters(data, Q3PendingFilters.person_2, Q3PendingFilters.min_connection);
       }
@@ -5,13 +5,49 @@ console.log("API module loaded");
 
 const API = (function () {
 
+  /**
+   * Read a streamed (NDJSON) graph response, calling onProgress with the
+   * nodes and links received so far after every chunk
+   * @param {Response} response - Response of a request with stream enabled
+   * @param {Function} onProgress - Called with {nodes, links} as chunks arrive
+   * @returns {Promise<Object>} - The complete graph data
+   */
+  async function readGraphStream(response, onProgress) {
+    const data = { nodes: [], links: [] };
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    const handleLine = (line) => {
+      if (!line.trim()) return;
+      const chunk = JSON.parse(line);
+      if (chunk.nodes) data.nodes.push(...chunk.nodes);
+      if (chunk.links) data.links.push(...chunk.links);
+      onProgress({ nodes: data.nodes, links: data.links, totalLinks: chunk.total_links });
+    };
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split("\n");
+      buffer = lines.pop();
+      lines.forEach(handleLine);
+    }
+    handleLine(buffer + decoder.decode());
+    return data;
+  }
+
   /**
    * Fetch graph data from the backend based on filter parameters
    * @param {Object} params - Filter parameters
    * @param {string} params.organization - Organization to filter by
+   * @param {number} params.limit - Only the heaviest links, at most this many
+   * @param {boolean} params.layout - Ask for server side node positions (x, y in [0, 1])
+   * @param {Function} onProgress - Optional, streams the graph and is called with the partial data
    * @returns {Promise<Object>} - Graph data with nodes and links
    */
-  async function fetchGraphData(params = {}) {
+  async function fetchGraphData(params = {}, onProgress = null) {
     try {
       console.log("API: Fetching graph data with params:", params);
 
@@ -20,7 +56,7 @@ const API = (function () {
         headers: {
           "Content-Type": "application/json",
         },
-        body: JSON.stringify(params),
+        body: JSON.stringify(onProgress ? { ...params, stream: true } : params),
       });
 
       if (!response.ok) {
@@ -28,7 +64,7 @@ const API = (function () {
         throw new Error(`API error (${response.status}): ${errorText}`);
       }
 
-      const data = await response.json();
+      const data = onProgress ? await readGraphStream(response, onProgress) : await response.json();
       console.log("API: Received graph data:", {
         nodes: data.nodes?.length || 0,
         links: data.links?.length || 0,
@@ -43,13 +79,17 @@ const API = (function () {
 
   /**
    * Fetch email graph data from the backend
+   * @param {Object} params - Query parameters
+   * @param {boolean} params.layout - Ask for server side node positions (x, y in [0, 1])
+   * @param {Function} onProgress - Optional, streams the graph and is called with the partial data
    * @returns {Promise<Object>} - Email graph data with nodes and links
    */
-  async function fetchEmailGraphData() {
+  async function fetchEmailGraphData(params = {}, onProgress = null) {
     try {
       console.log("API: Fetching email graph data");
 
-      const response = await fetch(`/api/email_graph`, {
+      const query = new URLSearchParams(onProgress ? { ...params, stream: 1 } : params).toString();
+      const response = await fetch(query ? `/api/email_graph?${query}` : `/api/email_graph`, {
         method: "GET",
         headers: {
           "Content-Type": "application/json",
@@ -61,7 +101,7 @@ const API = (function () {
         throw new Error(`API error (${response.status}): ${errorText}`);
       }
 
-      const data = await response.json();
+      const data = onProgress ? await readGraphStream(response, onProgress) : await response.json();
       console.log("API: Received email graph data:", {
         nodes: data.nodes?.length || 0,
         links: data.links?.length || 0,
@@ -74,10 +74,15 @@ const Visualization = (function () {
     });
 
     const nodeMap = {};
+    // positions laid out by the backend are in the unit square
+    const hasLayout = nodes.length > 0 && nodes.every(node => typeof node.x === "number" && typeof node.y === "number");
     nodes.forEach(node => {
       nodeMap[node.id] = node;
       const deg = nodeDegree[node.id] || 0;
-      if (deg <= 1) {
+      if (hasLayout) {
+        node.x = node.x * width;
+        node.y = node.y * height;
+      } else if (deg <= 1) {
         node.x = width / 2 + Math.random() * 20 - 10;
         node.y = height / 2 + Math.random() * 20 - 10;
       } else {
@@ -191,7 +196,8 @@ const Visualization = (function () {
 
     simulation.nodes(nodes).on("tick", ticked);
     simulation.force("link").links(links);
-    simulation.alpha(1).restart();
+    // a precomputed layout only needs to settle
+    simulation.alpha(hasLayout ? 0.1 : 1).restart();
 
     function ticked() {
       link
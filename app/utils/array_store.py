@@ -0,0 +1,81 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+META_FILE = "meta.json"
+
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def pack_strings(values):
+    '''
+    strings as one utf-8 buffer with offsets starting at 0, string i is bytes
+    offsets[i]:offsets[i+1]. missing values (None, NaN) are stored empty and
+    set in the null mask. return (buffer, offsets, null)
+    '''
+    null = np.asarray(pd.isna(values), dtype=bool).reshape(len(values))
+    encoded = [b"" if missing else str(value).encode("utf-8") for value, missing in zip(values, null.tolist())]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, null
+
+
+def unpack_strings(buffer, offsets, null=None):
+    '''the list of strings of pack_strings, NaN where null is set'''
+    data = buffer.tobytes()
+    offsets = offsets.tolist()
+    values = [data[start:stop].decode("utf-8") for start, stop in zip(offsets[:-1], offsets[1:])]
+    if null is not None:
+        for i in np.flatnonzero(null).tolist():
+            values[i] = np.nan
+    return values
+
+
+def string_at(buffer, offsets, i):
+    '''string i of pack_strings, without decoding the others'''
+    return buffer[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+
+def write_array_store(path, arrays, meta):
+    '''
+    write every array as a .npy file in directory path, with meta (a json
+    dict) next to them. the directory is replaced as a whole.
+    '''
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), np.ascontiguousarray(array))
+    with open(os.path.join(tmp_path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    # swap directories, a reader sees the old or the new store
+    old_path = path + ".old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def read_store_meta(path, version):
+    '''meta.json of a store, or None if there is no store of this version'''
+    try:
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == version else None
+
+
+def load_array_store(path, names, mmap_mode="r"):
+    '''
+    the arrays of a store, memory-mapped read only: loading does not depend on
+    their size, and processes mapping the same store share its pages.
+    '''
+    return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in names}
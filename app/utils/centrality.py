@@ -0,0 +1,117 @@
+import hashlib
+import numpy as np
+from scipy import sparse
+
+# served PageRank scores are iterated to float precision and rounded to this many
+# decimals, so they do not depend on the vector the iteration started from
+PAGERANK_DECIMALS = 9
+
+
+def node_index(src_ids, dst_ids):
+    '''
+    number the nodes appearing in an edge list.
+    return (sorted node ids, src indices, dst indices)
+    '''
+    node_ids, inverse = np.unique(np.concatenate([src_ids, dst_ids]), return_inverse=True)
+    return node_ids, inverse[:len(src_ids)], inverse[len(src_ids):]
+
+
+def adjacency(src, dst, weights, n):
+    '''weighted n x n CSR adjacency matrix, parallel edges are summed'''
+    return sparse.csr_matrix((np.asarray(weights, dtype=np.float64), (src, dst)), shape=(n, n))
+
+
+def fingerprint(node_ids, A):
+    '''digest of a numbered graph and its weights, equal for equal graphs whatever the edge order'''
+    A = A.tocsr(copy=True)
+    A.sum_duplicates()
+    A.sort_indices()
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (np.asarray(node_ids, dtype=np.int64), A.indptr, A.indices, A.data):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def warm_start(node_ids, previous):
+    '''
+    initial vector for node_ids from a previous result {node id: score}, so a
+    slightly changed graph converges in a few iterations. returns None when
+    there is nothing to start from.
+    '''
+    if not previous:
+        return None
+    x0 = np.array([previous.get(node_id, 0.0) for node_id in node_ids.tolist()], dtype=np.float64)
+    if x0.sum() <= 0:
+        return None
+    # nodes new to the graph start from the average score
+    x0[x0 == 0] = x0.sum() / len(x0)
+    return x0
+
+
+def pagerank(A, alpha=0.85, tol=1.0e-6, max_iter=100, x0=None):
+    '''
+    weighted PageRank of adjacency matrix A by power iteration, the same
+    iteration and stopping rule as networkx.pagerank: rows are normalized by
+    their out weight and dangling nodes spread their score uniformly.
+    return (scores summing to 1, iterations used)
+    '''
+    n = A.shape[0]
+    if n == 0:
+        return np.zeros(0), 0
+    out_weight = np.asarray(A.sum(axis=1)).ravel()
+    dangling = out_weight == 0
+    inv_out = np.zeros(n)
+    inv_out[~dangling] = 1.0 / out_weight[~dangling]
+    # transition matrix transposed, so each step is one sparse mat-vec
+    QT = (sparse.diags(inv_out) @ A).T.tocsr()
+
+    p = np.full(n, 1.0 / n)
+    x = p.copy() if x0 is None else np.asarray(x0, dtype=np.float64) / np.sum(x0)
+    for iteration in range(1, max_iter + 1):
+        x_last = x
+        x = alpha * (QT @ x_last + x_last[dangling].sum() * p) + (1 - alpha) * p
+        if np.abs(x - x_last).sum() < n * tol:
+            return x, iteration
+    print(f"Warning: pagerank did not converge in {max_iter} iterations")
+    return x, max_iter
+
+
+def stable_pagerank(A, x0=None):
+    '''
+    pagerank iterated until it stops changing and rounded to PAGERANK_DECIMALS:
+    a warm start x0 only saves iterations, cold and warm runs return the same scores.
+    return (scores, iterations used)
+    '''
+    x, iterations = pagerank(A, tol=1.0e-15, max_iter=1000, x0=x0)
+    return np.round(x, PAGERANK_DECIMALS), iterations
+
+
+def hits(A, tol=1.0e-8, max_iter=1000, a0=None):
+    '''
+    weighted HITS hubs and authorities of adjacency matrix A by power iteration
+    on A^T A. the authorities are its principal eigenvector, the principal right
+    singular vector of A that networkx.hits computes.
+    return (hubs, authorities, iterations used), both normalized to sum to 1
+    '''
+    n = A.shape[0]
+    if n == 0:
+        return np.zeros(0), np.zeros(0), 0
+    AT = A.T.tocsr()
+    a = np.full(n, 1.0 / n) if a0 is None else np.asarray(a0, dtype=np.float64)
+    a = a / a.max()
+    iteration = 0
+    for iteration in range(1, max_iter + 1):
+        a_last = a
+        a = AT @ (A @ a_last)
+        peak = a.max()
+        if peak == 0:
+            break
+        a = a / peak
+        if np.abs(a - a_last).sum() < tol:
+            break
+    else:
+        print(f"Warning: hits did not converge in {max_iter} iterations")
+
+    h = A @ a
+    a_sum, h_sum = a.sum(), h.sum()
+    return (h / h_sum if h_sum else h), (a / a_sum if a_sum else a), iteration
@@ -0,0 +1,235 @@
+import os
+import threading
+import numpy as np
+import networkx as nx
+
+# bump when the layout of the cache file changes
+COMMUNITIES_VERSION = 1
+COMMUNITIES_SUFFIX = ".communities.npz"
+COMMUNITY_SEED = 0
+# the coarsest level keeps the largest communities and merges the rest into one,
+# so a fully collapsed graph never has more supernodes than this
+TOP_LEVEL_SIZE = 50
+# member names shown on a supernode, the most connected first
+TOP_MEMBERS = 5
+COMMUNITY_PREFIX = "community"
+
+# source path -> (fingerprint, hierarchy), see load_hierarchy
+_hierarchy_cache = {}
+_hierarchy_cache_lock = threading.Lock()
+
+
+def _rank_by_size(labels):
+    '''relabel communities 0..k-1 from the largest to the smallest (ties by first member)'''
+    _, first, inverse, sizes = np.unique(labels, return_index=True, return_inverse=True, return_counts=True)
+    order = np.lexsort((first, -sizes))
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return rank[inverse]
+
+
+def community_hierarchy(n_nodes, src, dst, weights, seed=COMMUNITY_SEED, top_level_size=TOP_LEVEL_SIZE):
+    '''
+    nested louvain communities of a graph given as link arrays, directions and
+    parallel links are summed into one undirected weight. return a
+    levels x n_nodes int32 array, levels[l][i] the community of node i at level
+    l, from the coarsest level (0) to the finest. every community of a level is
+    a union of communities of the next one, ids are ranked by size.
+    when louvain stops after its first pass there is a single level (plus the
+    folded top level below): level 0 is then the only one, and expanding one of
+    its communities shows its nodes directly. on a hub with its leaves
+    modularity finds no finer split to build another level from.
+    '''
+    graph = nx.Graph()
+    graph.add_nodes_from(range(n_nodes))
+    for a, b, w in zip(np.asarray(src).tolist(), np.asarray(dst).tolist(), np.asarray(weights).tolist()):
+        if a == b:
+            continue
+        if graph.has_edge(a, b):
+            graph[a][b]["weight"] += w
+        else:
+            graph.add_edge(a, b, weight=w)
+
+    levels = []
+    # louvain yields its passes from the finest partition to the coarsest
+    for partition in nx.community.louvain_partitions(graph, weight="weight", seed=seed):
+        labels = np.zeros(n_nodes, dtype=np.int64)
+        for community, members in enumerate(partition):
+            labels[list(members)] = community
+        levels.insert(0, _rank_by_size(labels))
+    if not levels:
+        levels = [np.zeros(n_nodes, dtype=np.int32)]
+
+    # graphs of many components leave many small communities at the top, fold
+    # the tail into one expandable community
+    if levels[0].max(initial=-1) >= top_level_size:
+        levels.insert(0, np.minimum(levels[0], top_level_size - 1).astype(np.int32))
+    return np.stack(levels).astype(np.int32)
+
+
+def node_strength(n_nodes, src, dst, weights):
+    '''summed link weight of every node, in both directions'''
+    weights = np.asarray(weights, dtype=np.float64)
+    return (np.bincount(np.asarray(src), weights, minlength=n_nodes)
+            + np.bincount(np.asarray(dst), weights, minlength=n_nodes))
+
+
+def hierarchy_path(source_path):
+    return os.path.splitext(source_path)[0] + COMMUNITIES_SUFFIX
+
+
+def save_hierarchy(path, levels, fingerprint):
+    # write next to the final file and swap, a reader never sees half a cache
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, version=np.array(COMMUNITIES_VERSION), fingerprint=np.array(fingerprint, dtype=np.int64), levels=levels)
+    os.replace(tmp_path, path)
+
+
+def read_hierarchy(path, fingerprint):
+    '''levels from a cache file, or None when it is missing, older or from another version of the graph'''
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as stored:
+        if int(stored["version"]) != COMMUNITIES_VERSION:
+            return None
+        if tuple(stored["fingerprint"].tolist()) != tuple(fingerprint):
+            return None
+        return stored["levels"]
+
+
+def load_hierarchy(source_path, view):
+    '''
+    community hierarchy of the graph in view, read from source_path. it is
+    computed once per version of the file, kept in memory and in a cache file
+    next to it, so restarts and other processes reuse it.
+    return {"levels", "strength"}
+    '''
+    stat = os.stat(source_path)
+    fingerprint = (stat.st_size, stat.st_mtime_ns)
+    cached = _hierarchy_cache.get(source_path)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+    with _hierarchy_cache_lock:
+        cached = _hierarchy_cache.get(source_path)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+
+        cache_path = hierarchy_path(source_path)
+        levels = read_hierarchy(cache_path, fingerprint)
+        if levels is None or levels.shape[1] != view["n_nodes"]:
+            print(f"Building community hierarchy {cache_path}")
+            levels = community_hierarchy(view["n_nodes"], view["src"], view["dst"], view["weights"])
+            try:
+                save_hierarchy(cache_path, levels, fingerprint)
+            except OSError as e:
+                # read only data directory, serve from memory
+                print(f"Warning: could not write {cache_path}: {e}")
+        hierarchy = {
+            "levels": levels,
+            "strength": node_strength(view["n_nodes"], view["src"], view["dst"], view["weights"]),
+        }
+        _hierarchy_cache[source_path] = (fingerprint, hierarchy)
+        return hierarchy
+
+
+def community_id(level, community):
+    return f"{COMMUNITY_PREFIX}:{level}:{community}"
+
+
+def parse_community_id(value):
+    '''(level, community) of a supernode id, raises ValueError on anything else'''
+    prefix, level, community = str(value).split(":")
+    if prefix != COMMUNITY_PREFIX:
+        raise ValueError(f"not a community id: {value}")
+    return int(level), int(community)
+
+
+def display_levels(levels, level, expand):
+    '''
+    the level every node is shown at: level, one deeper for every expanded
+    community it is in, len(levels) for nodes shown on their own
+    '''
+    shown = np.full(levels.shape[1], level, dtype=np.int64)
+    expanded = {}
+    for lvl, community in expand:
+        expanded.setdefault(lvl, []).append(community)
+    for lvl in range(level, len(levels)):
+        if lvl in expanded:
+            opened = (shown == lvl) & np.isin(levels[lvl], expanded[lvl])
+            shown[opened] = lvl + 1
+    return shown
+
+
+def collapsed_view(view, hierarchy, level=0, expand=()):
+    '''
+    the graph with every community of level collapsed into one supernode, except
+    the communities in expand ((level, community) pairs) which are replaced by
+    their communities one level down, or by their nodes below the finest level
+    (at once, for a hierarchy of a single level).
+    links between two units are summed into one, links inside a unit dropped.
+    the size of the payload follows the number of units shown, not the graph.
+    '''
+    levels, strength = hierarchy["levels"], hierarchy["strength"]
+    n_levels, n_nodes = levels.shape
+    if not 0 <= level < n_levels:
+        raise ValueError(f"level must be between 0 and {n_levels - 1}")
+
+    shown = display_levels(levels, level, expand)
+    # one integer per unit: (shown level, community) or (n_levels, node)
+    padded = np.vstack([levels, np.arange(n_nodes, dtype=np.int32)])
+    unit_keys = shown * (n_nodes + 1) + padded[shown, np.arange(n_nodes)]
+    keys, unit = np.unique(unit_keys, return_inverse=True)
+    unit_level, unit_member = (keys // (n_nodes + 1)).tolist(), (keys % (n_nodes + 1)).tolist()
+
+    # members of every unit, the most connected first
+    by_strength = np.lexsort((np.arange(n_nodes), -strength))
+    grouped = by_strength[np.argsort(unit[by_strength], kind="stable")]
+    starts = np.r_[0, np.cumsum(np.bincount(unit, minlength=len(keys)))]
+
+    names, nodes = [], []
+    single = [i for i, lvl in enumerate(unit_level) if lvl == n_levels]
+    records = {record["id"]: record for record in view["node_records"]([unit_member[u] for u in single])}
+    for u, (lvl, member) in enumerate(zip(unit_level, unit_member)):
+        if lvl == n_levels:
+            name = view["node_names"]([member])[0]
+            names.append(name)
+            # names only seen in links have no record, as in the full graph
+            if name in records:
+                nodes.append(records[name])
+            continue
+        names.append(community_id(lvl, member))
+        members = grouped[starts[u]:starts[u + 1]]
+        nodes.append({
+            "id": names[-1],
+            "label": "COMMUNITY",
+            "level": lvl,
+            "size": len(members),
+            "top_members": view["node_names"](members[:TOP_MEMBERS].tolist()),
+        })
+
+    # links between two units summed into one, ordered by unit
+    src, dst = unit[np.asarray(view["src"])], unit[np.asarray(view["dst"])]
+    between = src != dst
+    pair_keys, pair = np.unique(src[between] * len(keys) + dst[between], return_inverse=True)
+    weights = np.bincount(pair, np.asarray(view["weights"], dtype=np.float64)[between], minlength=len(pair_keys))
+    counts = np.bincount(pair, minlength=len(pair_keys))
+    links = [
+        {"source": names[a], "target": names[b], "weight": int(w), "links": int(c)}
+        for a, b, w, c in zip((pair_keys // len(keys)).tolist(), (pair_keys % len(keys)).tolist(),
+                              weights.tolist(), counts.tolist())
+    ]
+    return {"nodes": nodes, "links": links, "level": level, "levels": n_levels}
+
+
+def lod_options(params):
+    '''
+    (level, expand) of a level of detail request, from a json body or a query
+    string; expand is a list (or comma separated string) of supernode ids.
+    raises ValueError on invalid values.
+    '''
+    level = int(params.get("level") or 0)
+    expand = params.get("expand") or []
+    if isinstance(expand, str):
+        expand = expand.split(",")
+    return level, tuple(sorted({parse_community_id(value) for value in expand if value}))
@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+import kuzu
+from metrics import QUERY_SECONDS
+
+DB_PATH = "../db"
+# connections kept per process, and how long a request waits for a free one (seconds)
+POOL_SIZE = max(4, os.cpu_count() or 1)
+POOL_WAIT = 30
+# queries running longer than this are interrupted (milliseconds)
+QUERY_TIMEOUT_MS = 30_000
+# page cache of the database per process (MB), kuzu's default (most of the RAM) when unset.
+# every serving process keeps its own, so cap it when running several workers
+DB_BUFFER_POOL_MB = int(os.environ.get("VAST_DB_BUFFER_POOL_MB", 0))
+# a process serving the database read only leaves <db>/server-<pid>.json, see running_servers
+SERVER_FILE_PREFIX = "server-"
+# a writer (an ingest) asks the serving processes to close the database with this file,
+# see request_write_access
+WRITER_FILE = "writer.json"
+# how long a writer waits for the servers to close the database, and how often they check (seconds)
+WRITER_WAIT = 60
+WRITER_POLL = 0.2
+
+
+class QueryTimeout(TimeoutError):
+    pass
+
+
+# db paths this process registered an atexit cleanup for
+_registered = set()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _server_file(db_path, pid):
+    return os.path.join(db_path, f"{SERVER_FILE_PREFIX}{pid}.json")
+
+
+def register_server(db_path):
+    '''record that this process has db_path open, for running_servers'''
+    try:
+        with open(_server_file(db_path, os.getpid()), "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "command": " ".join(sys.argv), "started": time.time()}, f)
+    except OSError as e:
+        print(f"Warning: could not register the server in {db_path}: {e}")
+        return
+    if db_path not in _registered:
+        _registered.add(db_path)
+        atexit.register(unregister_server, db_path)
+
+
+def unregister_server(db_path):
+    try:
+        os.remove(_server_file(db_path, os.getpid()))
+    except OSError:
+        pass
+
+
+def running_servers(db_path=DB_PATH):
+    '''
+    {"pid", "command", "started"} of every live process serving db_path.
+    files left by processes that are gone (killed workers) are removed.
+    '''
+    try:
+        names = sorted(os.listdir(db_path))
+    except OSError:
+        return []
+    servers = []
+    for name in names:
+        if not (name.startswith(SERVER_FILE_PREFIX) and name.endswith(".json")):
+            continue
+        path = os.path.join(db_path, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                server = json.load(f)
+            alive = _alive(server["pid"])
+        except (OSError, ValueError, KeyError):
+            continue
+        if not alive:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        servers.append(server)
+    return servers
+
+
+def writer_waiting(db_path=DB_PATH):
+    '''whether a live process asked the servers of db_path to close it'''
+    try:
+        with open(os.path.join(db_path, WRITER_FILE), "r", encoding="utf-8") as f:
+            return _alive(json.load(f)["pid"])
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def request_write_access(db_path=DB_PATH, wait=WRITER_WAIT):
+    '''
+    ask the processes serving db_path to close it and wait until they did.
+    they hold their requests meanwhile and reopen the database once
+    release_write_access withdraws the request. raises RuntimeError naming the
+    servers still holding the database after wait seconds.
+    '''
+    path = os.path.join(db_path, WRITER_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"pid": os.getpid(), "command": " ".join(sys.argv), "started": time.time()}, f)
+    os.replace(path + ".tmp", path)
+    deadline = time.monotonic() + wait
+    while True:
+        servers = running_servers(db_path)
+        if not servers:
+            return
+        if time.monotonic() > deadline:
+            release_write_access(db_path)
+            names = ", ".join(f"pid {server['pid']} ({server['command']})" for server in servers)
+            raise RuntimeError(f"{db_path} is still open in {names} after {wait} s")
+        time.sleep(WRITER_POLL)
+
+
+def release_write_access(db_path=DB_PATH):
+    '''withdraw the request of this process, the servers reopen the database'''
+    path = os.path.join(db_path, WRITER_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            if json.load(f)["pid"] != os.getpid():
+                return
+        os.remove(path)
+    except (OSError, ValueError, KeyError):
+        pass
+
+
+class PooledConnection:
+    '''
+    a kuzu connection with its own cache of prepared statements.
+    prepared statements belong to the connection they were prepared on, so
+    every connection of a pool keeps its own.
+    '''
+
+    def __init__(self, database, timeout_ms=QUERY_TIMEOUT_MS):
+        self.connection = kuzu.Connection(database)
+        self.timeout_ms = timeout_ms
+        if timeout_ms:
+            self.connection.set_query_timeout(timeout_ms)
+        self.prepared = {}
+
+    def execute(self, query, parameters=None):
+        '''run query, parameterized queries are prepared once per connection'''
+        try:
+            if not parameters:
+                return self.connection.execute(query)
+            statement = self.prepared.get(query)
+            if statement is None:
+                statement = self.prepared[query] = self.connection.prepare(query)
+            return self.connection.execute(statement, parameters)
+        except RuntimeError as e:
+            if "interrupted" in str(e).lower():
+                raise QueryTimeout(f"Query exceeded {self.timeout_ms} ms and was interrupted") from e
+            raise
+
+    def close(self):
+        self.prepared.clear()
+        self.connection.close()
+
+
+class ConnectionPool:
+    '''
+    connections over one kuzu.Database, one per concurrent request. a
+    connection is created when no idle one is left (up to size), otherwise
+    the request waits for one to be returned. query results have to be read
+    before the connection goes back, query_df and query_rows do both.
+    read_only opens the database in read-only mode: any number of serving
+    processes can then share it, but a writer cannot open it next to them.
+    a writer asks for it with request_write_access: the pool then lets the
+    running queries finish, closes the database and holds new requests until
+    the writer is done, then opens it again. the database is opened with the
+    first connection, so a pool created before the process forks is opened
+    by every child itself.
+    '''
+
+    def __init__(self, db_path=DB_PATH, size=POOL_SIZE, read_only=True, timeout_ms=QUERY_TIMEOUT_MS,
+                 buffer_pool_mb=DB_BUFFER_POOL_MB):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.buffer_pool_mb = buffer_pool_mb
+        self.database = None
+        self.size = size
+        self.timeout_ms = timeout_ms
+        self._idle = []
+        self._created = 0
+        self._in_use = 0
+        # set while a writer has the database
+        self._paused = False
+        self._watching = False
+        self._lock = threading.Condition()
+
+    def _open(self):
+        # called holding the lock
+        self.database = kuzu.Database(self.db_path, read_only=self.read_only,
+                                      buffer_pool_size=self.buffer_pool_mb * 2**20)
+        register_server(self.db_path)
+        if self.read_only and not self._watching:
+            self._watching = True
+            threading.Thread(target=self._watch_writers, name="db-writer-watch", daemon=True).start()
+        return self.database
+
+    def _acquire(self, wait):
+        deadline = time.monotonic() + wait
+        with self._lock:
+            while True:
+                # a database closed for a writer is not opened again before it is done
+                available = not self._paused and not (self.database is None and writer_waiting(self.db_path))
+                if available and self._idle:
+                    self._in_use += 1
+                    return self._idle.pop()
+                if available and self._created < self.size:
+                    database = self.database or self._open()
+                    self._created += 1
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise QueryTimeout(f"No database connection free after {wait} s")
+                self._lock.wait(min(remaining, WRITER_POLL))
+        try:
+            return PooledConnection(database, self.timeout_ms)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+                self._in_use -= 1
+                self._lock.notify_all()
+            raise
+
+    def _release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+            self._idle.append(conn)
+            self._lock.notify_all()
+
+    def _close_database(self):
+        # called holding the lock, once no connection is in use
+        for conn in self._idle:
+            conn.close()
+        self._idle.clear()
+        self._created = 0
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+            unregister_server(self.db_path)
+
+    def _watch_writers(self):
+        '''close the database for a waiting writer and resume once it is done'''
+        while True:
+            time.sleep(WRITER_POLL)
+            if self.database is None or not writer_waiting(self.db_path):
+                continue
+            with self._lock:
+                self._paused = True
+                # queries already running finish first
+                while self._in_use:
+                    self._lock.wait()
+                self._close_database()
+            print(f"Closed {self.db_path} for a writer, requests wait until it is done")
+            while writer_waiting(self.db_path):
+                time.sleep(WRITER_POLL)
+            with self._lock:
+                self._paused = False
+                self._lock.notify_all()
+            print(f"Writer done, reopening {self.db_path}")
+
+    @contextmanager
+    def connection(self, wait=POOL_WAIT):
+        conn = self._acquire(wait)
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def query_df(self, query, parameters=None, name="unnamed"):
+        '''result of query as a DataFrame, the time to run and fetch it is recorded under name'''
+        with self.connection() as conn, QUERY_SECONDS.time(name):
+            return conn.execute(query, parameters).get_as_df()
+
+    def query_rows(self, query, parameters=None, name="unnamed"):
+        with self.connection() as conn, QUERY_SECONDS.time(name):
+            result = conn.execute(query, parameters)
+            rows = []
+            while result.has_next():
+                rows.append(result.get_next())
+            return rows
+
+    def stats(self):
+        return {"size": self.size, "created": self._created, "idle": len(self._idle)}
+
+    def close(self):
+        with self._lock:
+            self._close_database()
@@ -1,32 +1,201 @@
 import kuzu
 import os
+import csv
+import json
+import time
+import hashlib
+import argparse
+from collections import defaultdict
+from pathlib import Path
+import numpy as np
+import pandas as pd
 import preliminary
+import near_duplicates
+import parse_news
 
+DB_PATH = "../db"
+ARTICLES_CSV = "../data/news_articles.csv"
+MANIFEST_FILE = "build_manifest.json"
+SIM_INDEX_FILE = "sim_index.npz"
+
+# manifest path -> ((inode, mtime), generation), see db_generation
+_generation_cache = {}
+# bump when the table definitions change, forces a full rebuild
+SCHEMA_VERSION = 2
 
 
 def setup_database(db_path, delete_existing=True):
     print('Loading graph database')
-    lock_file = os.path.join(db_path, ".lock")
+    from db_pool import running_servers, request_write_access, release_write_access
+    if delete_existing:
+        # a rebuild deletes the database under the servers, they have to be stopped
+        servers = running_servers(db_path)
+        if servers:
+            names = ", ".join(f"pid {server['pid']} ({server['command']})" for server in servers)
+            raise RuntimeError(f"{db_path} is open in a running server: {names}. "
+                               "Stop the server, rebuild, then start it again")
+    elif os.path.exists(db_path):
+        # running servers close the database until close_database, holding their requests
+        request_write_access(db_path)
     # Remove existing database directory if it exists
     if delete_existing and os.path.exists(db_path):
         import shutil
         print(f"Removing existing database at {db_path}")
         shutil.rmtree(db_path)
         assert not os.path.exists(db_path), f"Failed to remove {db_path}"
-    elif os.path.exists(lock_file):
-        print('Removing lock file')
+    # kuzu holds an OS lock on .lock while the database is open, a file left by
+    # a crashed process does not block anything. removing it would let a second
+    # writer in while another process still has the database open.
+    try:
         try:
-            os.remove(lock_file)
-            print(f"Removed stale lock file: {lock_file}")
-        except Exception as e:
-            print(f"Warning: Failed to remove lock file: {e}")
-    # Create database with new directory
-    db = kuzu.Database(db_path)
+            db = kuzu.Database(db_path)
+        except RuntimeError as e:
+            if delete_existing or "lock" not in str(e).lower() or not running_servers(db_path):
+                raise
+            # a server opened the database right before the request, it closes it as well
+            request_write_access(db_path)
+            db = kuzu.Database(db_path)
+    except RuntimeError as e:
+        release_write_access(db_path)
+        if "lock" in str(e).lower():
+            raise RuntimeError(f"{db_path} is open in another process (a server or another rebuild or ingest), "
+                               "stop it before rebuilding or ingesting") from e
+        raise
     connection = kuzu.Connection(db)
     return connection
 
-def init_db():
-    connection = setup_database("../db", delete_existing=True)
+
+def close_database(connection):
+    '''close a connection from setup_database/init_db, release the database lock and let the servers reopen it'''
+    from db_pool import release_write_access
+    database = connection.database
+    db_path = database.database_path
+    connection.close()
+    database.close()
+    release_write_access(db_path)
+
+def file_sha256(path):
+    '''content hash of a file, read in blocks'''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _fingerprint(*parts):
+    return hashlib.sha256("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+def build_fingerprints(csv_path=ARTICLES_CSV):
+    '''
+    fingerprint of every table built by init_db, computed from the inputs it depends on.
+    a table has to be rebuilt when its fingerprint (or one of its dependencies') changes.
+    '''
+    article_fp = _fingerprint(SCHEMA_VERSION, file_sha256(csv_path))
+    references_fp = _fingerprint(article_fp, preliminary.SIM_THRESHOLD, preliminary.SIM_TOP_K)
+    if preliminary.SIM_METHOD != "exact":
+        references_fp = _fingerprint(references_fp, preliminary.SIM_METHOD, near_duplicates.LSH_BANDS,
+                                     near_duplicates.LSH_ROWS, near_duplicates.SHINGLE_SIZE, near_duplicates.MAX_WORD_DF)
+    return {
+        "Article": article_fp,
+        "Source": _fingerprint(article_fp),
+        "REFERENCES": references_fp,
+        "ReferencesSource": _fingerprint(references_fp),
+    }
+
+def read_manifest(db_path):
+    manifest_path = os.path.join(db_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Failed to read build manifest: {e}")
+        return None
+
+def write_manifest(db_path, fingerprints, csv_path=ARTICLES_CSV, generation=None):
+    '''
+    record the fingerprints of the built tables. every write bumps the database
+    generation, which tells readers that cached query results are out of date.
+    '''
+    if generation is None:
+        generation = db_generation(db_path) + 1
+    manifest = {
+        "schema_version": SCHEMA_VERSION,
+        "generation": generation,
+        "articles_csv": csv_path,
+        "sim_threshold": preliminary.SIM_THRESHOLD,
+        "sim_top_k": preliminary.SIM_TOP_K,
+        "sim_method": preliminary.SIM_METHOD,
+        "tables": fingerprints,
+    }
+    manifest_path = os.path.join(db_path, MANIFEST_FILE)
+    # write then rename, so a crash mid-build never leaves a manifest for a half built db
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def db_generation(db_path=DB_PATH):
+    '''
+    generation counter of the database, bumped on every build or ingest.
+    cheap to call per request: the manifest is only re-read when it was replaced.
+    '''
+    manifest_path = os.path.join(db_path, MANIFEST_FILE)
+    try:
+        stat = os.stat(manifest_path)
+    except OSError:
+        return 0
+    # write_manifest renames a new file into place, so the inode changes on every write
+    version = (stat.st_ino, stat.st_mtime_ns)
+    cached = _generation_cache.get(manifest_path)
+    if cached and cached[0] == version:
+        return cached[1]
+    generation = (read_manifest(db_path) or {}).get("generation", 0)
+    _generation_cache[manifest_path] = (version, generation)
+    return generation
+
+def init_db(db_path=DB_PATH, csv_path=ARTICLES_CSV, force=False):
+    '''
+    build the graph database, reusing whatever is still up to date.
+    the build manifest stored with the database records the fingerprint of every table;
+    only tables whose inputs changed (and the tables depending on them) are rebuilt.
+    return a connection to the database.
+    '''
+    fingerprints = build_fingerprints(csv_path)
+    # a full rebuild wipes the manifest, carry the generation over
+    generation = db_generation(db_path) + 1
+    manifest = None if force else read_manifest(db_path)
+    built = (manifest or {}).get("tables", {})
+
+    if (manifest is None
+            or manifest.get("schema_version") != SCHEMA_VERSION
+            or built.get("Article") != fingerprints["Article"]):
+        # articles changed, every table depends on them
+        connection = setup_database(db_path, delete_existing=True)
+        init_articles(connection, csv_path)
+        stale = list(BUILD_STAGES)
+    else:
+        connection = setup_database(db_path, delete_existing=False)
+        changed = [stage for stage in BUILD_STAGES if built.get(stage) != fingerprints[stage]]
+        if not changed:
+            print("Graph database is up to date.")
+            return connection
+        # everything after the first changed stage depends on it
+        stages = list(BUILD_STAGES)
+        stale = stages[stages.index(changed[0]):]
+    print(f"Rebuilding tables: {', '.join(stale)}")
+
+    # drop stale tables in reverse dependency order before rebuilding them
+    for stage in reversed(stale):
+        for table in BUILD_STAGES[stage][1]:
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+    for stage in stale:
+        BUILD_STAGES[stage][0](connection)
+
+    write_manifest(db_path, fingerprints, csv_path, generation)
+    return connection
+
+def init_articles(connection, csv_path=ARTICLES_CSV):
     connection.execute("DROP TABLE IF EXISTS ARTICLE")
     connection.execute('''CREATE NODE TABLE ARTICLE (
                        id INT64,
@@ -40,9 +209,9 @@ def init_db():
                         )
                        ''')
     
-    connection.execute(f'COPY ARTICLE FROM \"../data/news_articles.csv\" (HEADER=TRUE, DELIM=\"|\")')
+    # the csv is written with ~ as the quote (parse_news), a field starting with " is not quoted
+    connection.execute(f'COPY ARTICLE FROM \"{csv_path}\" (HEADER=TRUE, DELIM=\"|\", QUOTE=\"~\", ESCAPE=\"~\")')
     print("Articles node created from csv.")
-    init_Q1(connection)
 
 
 def init_Q1(conn):
@@ -50,20 +219,28 @@ def init_Q1(conn):
     init_references_rel(conn)
     init_references_source_rel(conn)
 
+def copy_from_df(conn, table, frame):
+    '''bulk load a DataFrame into a kuzu table with COPY and report the throughput'''
+    start = time.perf_counter()
+    conn.execute(f"COPY {table} FROM frame")
+    elapsed = time.perf_counter() - start
+    rate = len(frame) / elapsed if elapsed > 0 else float("inf")
+    print(f"Copied {len(frame)} rows into {table} in {elapsed:.3f}s ({rate:.0f} rows/s)")
+
 def init_references_source_rel(conn):
     conn.execute("DROP TABLE IF EXISTS ReferencesSource;")
     conn.execute("""
     CREATE REL TABLE ReferencesSource(FROM Source TO Source, refCount INT64);
     """)
 
-    conn.execute("""
+    ref_counts = conn.execute("""
     MATCH (a1:Article)-[:References]->(a2:Article),
         (a1)-[:PublishedBy]->(s1:Source),
         (a2)-[:PublishedBy]->(s2:Source)
     WHERE s1 <> s2
-    WITH s1, s2, count(*) AS refCount
-    CREATE (s1)-[:ReferencesSource {refCount: refCount}]->(s2);
-    """)
+    RETURN s1.id AS `from`, s2.id AS `to`, count(*) AS refCount;
+    """).get_as_df()
+    copy_from_df(conn, "ReferencesSource", ref_counts)
 
     print("ReferencesSource relationships created.")
 
@@ -80,64 +257,184 @@ def init_source_and_PublishedBy(conn):
     CREATE REL TABLE PublishedBy(FROM Article TO Source);
     """)
 
-    # Create unique Source nodes with generated IDs
-    conn.execute("""
-    MATCH (a:Article)
-    WITH DISTINCT a.source AS source_name
-    WITH collect(source_name) AS sources
-    UNWIND range(0, size(sources)-1) AS i
-    CREATE (:Source {id: i, name: sources[i+1]});
-    """)
+    # Create unique Source nodes with generated IDs, in order of first appearance
+    articles = conn.execute("MATCH (a:Article) RETURN a.id AS id, a.source AS source").get_as_df()
+    source_ids, source_names = pd.factorize(articles["source"])
+    sources = pd.DataFrame({"id": np.arange(len(source_names)), "name": source_names})
+    copy_from_df(conn, "Source", sources)
 
-    # Create PublishedBy relationships by matching source names
-    conn.execute("""
-    MATCH (a:Article), (s:Source)
-    WHERE a.source = s.name
-    CREATE (a)-[:PublishedBy]->(s);
-    """)
+    # Create PublishedBy relationships from the article to its source id
+    published_by = pd.DataFrame({"from": articles["id"], "to": source_ids})
+    copy_from_df(conn, "PublishedBy", published_by)
 
     print("Source nodes and PublishedBy relationships created.")
 
 def init_references_rel(conn):
-    import datetime
-
     conn.execute("DROP TABLE IF EXISTS REFERENCES")
     conn.execute("CREATE REL TABLE REFERENCES(FROM Article TO Article, similarity DOUBLE)")
-    conn.execute("MATCH (:Article)-[r:REFERENCES]->(:Article) DELETE r;")
 
-    similarity_matrix = preliminary.calc_sim_matrix()
-    num_articles = similarity_matrix.shape[0]
+    # Get all article IDs, publish dates and contents from Kùzu, ordered by id
+    articles = conn.execute("MATCH (a:Article) RETURN a.id AS id, a.publish_date AS publish_date, a.content AS content ORDER BY a.id").get_as_df()
+    article_ids = articles["id"].to_numpy()
+    publish_dates = articles["publish_date"].to_numpy()
 
-    # Step 1: Get all article IDs and publish dates from Kùzu
-    result = conn.execute("MATCH (a:Article) RETURN a.id, a.publish_date, a.title ORDER BY a.id")
-    
-    article_ids = []
-    publish_dates = []
-    titles = []
-    while result.has_next():
-        row = result.get_next()
-        article_ids.append(row[0])
-        publish_dates.append(row[1])  # datetime object or string (Kùzu returns ISO format)
-        titles.append(row[2])
-
-    # Step 2: Iterate and apply filtering
-    for i in range(num_articles):
-        for j in range(num_articles):
-            if i == j:
-                continue
+    # sparse, only holds the top-k neighbours above SIM_THRESHOLD, from all pairs or the lsh candidates
+    tf_idf, vocab, idf = preliminary.build_tfidf(articles["content"])
+    similarity_matrix = preliminary.similar_articles(
+        tf_idf, articles["content"], preliminary.SIM_THRESHOLD, preliminary.SIM_TOP_K
+    ).tocoo()
+    # keep the document vectors and idf around for incremental ingestion
+    preliminary.save_sim_index(sim_index_path(conn), preliminary.build_sim_index(tf_idf, vocab, idf, article_ids))
 
-            sim = similarity_matrix[i][j]
-            if sim > preliminary.SIM_THRESHOLD and publish_dates[i] > publish_dates[j]:
-                query = f"""
-                MATCH (a:Article {{id: {article_ids[i]}}}), (b:Article {{id: {article_ids[j]}}})
-                CREATE (a)-[:REFERENCES {{similarity: {sim:.4f}}}]->(b);
-                """
-                conn.execute(query)
+    # the later article references the earlier one
+    rows, cols = similarity_matrix.row, similarity_matrix.col
+    newer = publish_dates[rows] > publish_dates[cols]
+    references = pd.DataFrame({
+        "from": article_ids[rows[newer]],
+        "to": article_ids[cols[newer]],
+        "similarity": np.round(similarity_matrix.data[newer], 4),
+    })
+    copy_from_df(conn, "REFERENCES", references)
 
     print("Reference relationships created.")
 
-def save_entry_to_db(connection, entry):
-    pass
+# stages built after the articles in dependency order: (builder, tables it creates)
+BUILD_STAGES = {
+    "Source": (init_source_and_PublishedBy, ["PublishedBy", "Source"]),
+    "REFERENCES": (init_references_rel, ["REFERENCES"]),
+    "ReferencesSource": (init_references_source_rel, ["ReferencesSource"]),
+}
+
+def sim_index_path(conn):
+    return os.path.join(conn.database.database_path, SIM_INDEX_FILE)
+
+def _null(value):
+    return None if value == "NULL" else value
+
+def save_entry_to_db(connection, entry, index=None):
+    '''
+    insert one parsed article (see parse_news.read_article) into the database:
+    the Article node, its Source and PublishedBy edge, REFERENCES edges to and from
+    its most similar existing articles and the affected ReferencesSource counts.
+    similarity uses the stored document vectors and idf, so the cost grows with the
+    new article rather than the corpus. pass a loaded sim index to add several
+    articles before saving it once, otherwise the index is loaded and saved here.
+    '''
+    own_index = index is None
+    if own_index:
+        index = preliminary.load_sim_index(sim_index_path(connection))
+
+    connection.execute("""
+    CREATE (:Article {id: $id, source: $source, title: $title, author: $author,
+                      publish_date: CAST($publish_date AS DATE), location: $location, content: $content});
+    """, {column: _null(entry[column]) for column in parse_news.ARTICLE_COLUMNS})
+
+    # Source node, created with the next free id if it is new
+    result = connection.execute("MATCH (s:Source {name: $name}) RETURN s.id", {"name": entry["source"]})
+    if result.has_next():
+        source_id = result.get_next()[0]
+    else:
+        max_id = connection.execute("MATCH (s:Source) RETURN max(s.id)").get_next()[0]
+        source_id = 0 if max_id is None else max_id + 1
+        connection.execute("CREATE (:Source {id: $id, name: $name})", {"id": source_id, "name": entry["source"]})
+    connection.execute("""
+    MATCH (a:Article {id: $article_id}), (s:Source {id: $source_id})
+    CREATE (a)-[:PublishedBy]->(s);
+    """, {"article_id": entry["id"], "source_id": source_id})
+
+    neighbour_ids, sims = preliminary.add_document(
+        index, entry["id"], _null(entry["content"]) or "", preliminary.SIM_THRESHOLD, preliminary.SIM_TOP_K
+    )
+    if len(neighbour_ids):
+        neighbours = connection.execute("""
+        UNWIND CAST($ids AS INT64[]) AS nid
+        MATCH (a:Article {id: nid})-[:PublishedBy]->(s:Source)
+        RETURN a.id, a.publish_date, s.id;
+        """, {"ids": neighbour_ids.tolist()}).get_as_df()
+        neighbours.columns = ["id", "publish_date", "source_id"]
+        neighbours["similarity"] = np.round(sims, 4)[pd.Index(neighbour_ids).get_indexer(neighbours["id"])]
+        publish_date = pd.Timestamp(_null(entry["publish_date"]))
+
+        # the later article references the earlier one
+        source_pairs = defaultdict(int)
+        for row in neighbours.itertuples():
+            if publish_date > row.publish_date:
+                ref_from, ref_to, pair = entry["id"], row.id, (source_id, row.source_id)
+            elif row.publish_date > publish_date:
+                ref_from, ref_to, pair = row.id, entry["id"], (row.source_id, source_id)
+            else:
+                continue
+            connection.execute("""
+            MATCH (a:Article {id: $from_id}), (b:Article {id: $to_id})
+            CREATE (a)-[:REFERENCES {similarity: $similarity}]->(b);
+            """, {"from_id": int(ref_from), "to_id": int(ref_to), "similarity": float(row.similarity)})
+            if pair[0] != pair[1]:
+                source_pairs[pair] += 1
+
+        for (s1, s2), count in source_pairs.items():
+            updated = connection.execute("""
+            MATCH (s1:Source {id: $s1})-[r:ReferencesSource]->(s2:Source {id: $s2})
+            SET r.refCount = r.refCount + $count
+            RETURN count(r);
+            """, {"s1": int(s1), "s2": int(s2), "count": count}).get_next()[0]
+            if not updated:
+                connection.execute("""
+                MATCH (s1:Source {id: $s1}), (s2:Source {id: $s2})
+                CREATE (s1)-[:ReferencesSource {refCount: $count}]->(s2);
+                """, {"s1": int(s1), "s2": int(s2), "count": count})
+
+    if own_index:
+        preliminary.save_sim_index(sim_index_path(connection), index)
+        db_path = connection.database.database_path
+        manifest = read_manifest(db_path)
+        if manifest:
+            write_manifest(db_path, manifest["tables"], manifest["articles_csv"])
+
+def ingest_articles(article_paths, db_path=DB_PATH, csv_path=ARTICLES_CSV):
+    '''
+    add new article .txt files to an existing database without rebuilding it.
+    the articles are appended to the news csv and the build manifest is updated,
+    so the next start reuses the database instead of rebuilding it.
+    '''
+    start = time.perf_counter()
+    connection = init_db(db_path, csv_path)
+    index = preliminary.load_sim_index(sim_index_path(connection))
+    known_ids = set(index["article_ids"].tolist())
+
+    entries = []
+    for path in article_paths:
+        entry = parse_news.read_article(Path(path))
+        if entry["id"] in known_ids:
+            print(f"Skipping article {entry['id']}, already in the database")
+            continue
+        save_entry_to_db(connection, entry, index)
+        known_ids.add(entry["id"])
+        entries.append(entry)
+    preliminary.save_sim_index(sim_index_path(connection), index)
+
+    with open(csv_path, "a", newline="", encoding="utf-8") as f:
+        cw = csv.DictWriter(f, parse_news.ARTICLE_COLUMNS, delimiter='|', quotechar='~', quoting=csv.QUOTE_MINIMAL)
+        cw.writerows(entries)
+    write_manifest(db_path, build_fingerprints(csv_path), csv_path)
+
+    print(f"Ingested {len(entries)} articles in {time.perf_counter() - start:.2f}s")
+    return connection
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Build the graph database or add new articles to it")
+    arg_parser.add_argument("--ingest", nargs="+", metavar="ARTICLE",
+                            help="article .txt files to add incrementally, running servers pause meanwhile")
+    arg_parser.add_argument("--force", action="store_true", help="rebuild every table")
+    arg_parser.add_argument("--references", choices=preliminary.SIM_METHODS, default=preliminary.SIM_METHOD,
+                            help="find similar articles over all pairs or minhash/lsh candidates (VAST_SIM_METHOD)")
+    arg_parser.add_argument("--lsh-bands", type=int, default=near_duplicates.LSH_BANDS,
+                            help="more bands find more similar pairs at the cost of more candidates")
+    arg_parser.add_argument("--lsh-rows", type=int, default=near_duplicates.LSH_ROWS,
+                            help="more rows per band find fewer, closer pairs")
+    args = arg_parser.parse_args()
+    preliminary.SIM_METHOD = args.references
+    near_duplicates.LSH_BANDS, near_duplicates.LSH_ROWS = args.lsh_bands, args.lsh_rows
+    if args.ingest:
+        close_database(ingest_articles(args.ingest))
+    else:
+        close_database(init_db(force=args.force))
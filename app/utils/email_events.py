@@ -0,0 +1,155 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from email_graph import EMAIL_HEADERS_CSV, SUBJECT_CLUSTERS_CSV, UNCLASSIFIED, read_headers, load_subject_clusters
+
+# width of the buckets the prefix aggregates are kept for
+BUCKET_SIZE = pd.Timedelta(hours=1)
+# upper bound on buckets x (pair, cluster) cells, buckets are widened to stay under it
+PREFIX_MAX_CELLS = 4_000_000
+
+# (headers path, clusters path) -> (versions, index), see load_email_events
+_events_cache = {}
+_events_cache_lock = threading.Lock()
+
+
+def build_email_events(rows, clusters, bucket_size=BUCKET_SIZE, max_cells=PREFIX_MAX_CELLS):
+    '''
+    time index over the mails of cleaned header rows (see email_graph.clean_headers).
+    every (sender, recipient) mail is an event coded by its (pair, subject cluster)
+    combination, events are sorted by timestamp. prefix[k] holds the event counts
+    per combination before bucket boundary k, where boundary k is at event
+    bucket_starts[k]. mails to oneself and mails without a date are left out,
+    pairs are numbered in order of first appearance like the links of the email graph.
+    prefix is None when even two boundaries would exceed max_cells.
+    '''
+    rows = rows[(rows["sender"] != rows["recipients"]) & rows["date"].notna()]
+    cluster_names = rows["subject"].map(clusters).fillna(UNCLASSIFIED)
+    pair_codes, pairs = pd.MultiIndex.from_arrays([rows["sender"], rows["recipients"]]).factorize()
+    cluster_codes, cluster_names = pd.factorize(cluster_names, sort=True)
+    combo_codes, combos = pd.MultiIndex.from_arrays([pair_codes, cluster_codes]).factorize()
+
+    times = rows["date"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    order = np.argsort(times, kind="stable")
+    times, combo_codes = times[order], combo_codes[order].astype(np.int64)
+    n_combos = len(combos)
+
+    # widen the buckets until the prefix table fits, one bucket wider than the span
+    # (two boundaries) is as narrow as the table gets
+    bucket = max(int(bucket_size.value), 1)
+    span = int(times[-1] - times[0]) if len(times) else 0
+    while (span // bucket + 2) * max(n_combos, 1) > max_cells and bucket <= span:
+        bucket *= 2
+    if (span // bucket + 2) * max(n_combos, 1) > max_cells:
+        # too many combinations for even two boundaries, windows are counted from the events
+        print(f"Warning: {n_combos} mail combinations exceed the prefix budget of {max_cells} cells, "
+              "windows are counted without a prefix table")
+        bucket_starts, prefix = np.zeros(0, dtype=np.int64), None
+    else:
+        if len(times):
+            boundaries = np.arange(times[0] - times[0] % bucket, times[-1] + bucket, bucket, dtype=np.int64)
+        else:
+            boundaries = np.zeros(1, dtype=np.int64)
+        bucket_starts = np.searchsorted(times, boundaries, side="left")
+
+        prefix = np.zeros((len(boundaries), n_combos), dtype=np.int32)
+        for k in range(1, len(boundaries)):
+            prefix[k] = prefix[k - 1] + np.bincount(combo_codes[bucket_starts[k - 1]:bucket_starts[k]], minlength=n_combos)
+
+    return {
+        "times": times,
+        "combo_codes": combo_codes,
+        "combo_pairs": np.asarray(combos.get_level_values(0), dtype=np.int64),
+        "combo_clusters": np.asarray(combos.get_level_values(1), dtype=np.int64),
+        "pair_sources": list(pairs.get_level_values(0)),
+        "pair_targets": list(pairs.get_level_values(1)),
+        "cluster_names": list(cluster_names),
+        "n_combos": n_combos,
+        "bucket_starts": bucket_starts,
+        "prefix": prefix,
+    }
+
+
+def load_email_events(headers_path=EMAIL_HEADERS_CSV, clusters_path=SUBJECT_CLUSTERS_CSV):
+    '''
+    email event index of the header csv, built once and kept in memory.
+    rebuilt when the modification time or size of either file changes.
+    '''
+    paths = [path for path in (headers_path, clusters_path) if os.path.exists(path)]
+    versions = tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths)
+    key = (headers_path, clusters_path)
+    cached = _events_cache.get(key)
+    if cached and cached[0] == versions:
+        return cached[1]
+
+    with _events_cache_lock:
+        cached = _events_cache.get(key)
+        if cached and cached[0] == versions:
+            return cached[1]
+        index = build_email_events(read_headers(headers_path), load_subject_clusters(clusters_path))
+        _events_cache[key] = (versions, index)
+        return index
+
+
+def window_counts(index, start=None, end=None):
+    '''
+    mail counts per (pair, cluster) combination with start <= timestamp <= end.
+    the event range is found by binary search, whole buckets inside it are
+    taken from the prefix table and only the events of the partial buckets at
+    both ends are counted, so the cost is bounded by the number of events in
+    the window and the number of combinations.
+    '''
+    times, combo_codes = index["times"], index["combo_codes"]
+    n_combos = index["n_combos"]
+    lo = 0 if start is None else np.searchsorted(times, start.value, side="left")
+    hi = len(times) if end is None else np.searchsorted(times, end.value, side="right")
+    if hi <= lo:
+        return np.zeros(n_combos, dtype=np.int64)
+    if hi - lo <= n_combos or index["prefix"] is None:
+        return np.bincount(combo_codes[lo:hi], minlength=n_combos)
+
+    bucket_starts = index["bucket_starts"]
+    # first boundary at or after lo, last boundary at or before hi
+    k_lo = np.searchsorted(bucket_starts, lo, side="left")
+    k_hi = np.searchsorted(bucket_starts, hi, side="right") - 1
+    if k_hi <= k_lo:
+        return np.bincount(combo_codes[lo:hi], minlength=n_combos)
+    counts = index["prefix"][k_hi].astype(np.int64) - index["prefix"][k_lo]
+    counts += np.bincount(combo_codes[lo:bucket_starts[k_lo]], minlength=n_combos)
+    counts += np.bincount(combo_codes[bucket_starts[k_hi]:hi], minlength=n_combos)
+    return counts
+
+
+def window_graph(index, start=None, end=None, subject=None):
+    '''
+    email graph {"nodes": [names], "links"} of the mails sent in [start, end],
+    optionally only those of one subject cluster. links are in the order of the
+    full email graph and carry their weight and subject clusters in the window.
+    '''
+    counts = window_counts(index, start, end)
+    if subject is not None:
+        subject = subject.lower()
+        if subject not in index["cluster_names"]:
+            return {"nodes": [], "links": []}
+        counts = np.where(index["combo_clusters"] == index["cluster_names"].index(subject), counts, 0)
+
+    present = np.flatnonzero(counts)
+    pairs, clusters = index["combo_pairs"][present], index["combo_clusters"][present]
+    weights = np.bincount(pairs, weights=counts[present], minlength=len(index["pair_sources"]))
+    subjects = {}
+    # cluster codes are in name order, so each pair's subjects come out sorted
+    for pair, cluster in sorted(zip(pairs.tolist(), clusters.tolist()), key=lambda pc: pc[1]):
+        subjects.setdefault(pair, []).append(index["cluster_names"][cluster])
+
+    links = [
+        {
+            "source": index["pair_sources"][pair],
+            "target": index["pair_targets"][pair],
+            "weight": int(weights[pair]),
+            "subjects": subjects[pair],
+        }
+        for pair in np.flatnonzero(weights).tolist()
+    ]
+    nodes = sorted({link["source"] for link in links} | {link["target"] for link in links})
+    return {"nodes": nodes, "links": links}
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import argparse
+import pandas as pd
+
+EMAIL_HEADERS_CSV = "../data/email headers.csv"
+EMPLOYEE_RECORDS = "../data/EmployeeRecords.xlsx"
+# subject cluster of every email title, and the curated department of every person
+SUBJECT_CLUSTERS_CSV = "../data/raw_data/Clustered_Email_Subjects.csv"
+PEOPLE_CLASSES_CSV = "../data/raw_data/people_color.csv"
+EMAIL_GRAPH_JSON = "../data/email_graph.json"
+# subject cluster of titles that were never clustered
+UNCLASSIFIED = "unclassified"
+
+DEPARTMENT_NAMES = {"Information Technology": "IT"}
+# assistants belong to the department of the person they assist
+EXECUTIVE_TITLES = {"CEO", "CFO", "CIO", "COO"}
+
+
+def clean_headers(df):
+    '''
+    one row per (sender, recipient) of every mail, as in the task3 notebook:
+    the comma separated To field is exploded and addresses are reduced to the
+    lowercase name before the @.
+    return (sender, recipients, date, subject) columns
+    '''
+    df = df[["From", "To", "Date", "Subject"]].dropna()
+    df.columns = ["sender", "recipients", "date", "subject"]
+    df = df.assign(recipients=df["recipients"].str.split(",")).explode("recipients")
+    for column in ("sender", "recipients"):
+        df[column] = df[column].str.strip().str.lower().str.split("@").str[0]
+    df["subject"] = df["subject"].fillna("").str.lower()
+    dates = pd.to_datetime(df["date"], format="%m/%d/%Y %H:%M", errors="coerce")
+    # a few mails only carry the day
+    df["date"] = dates.fillna(pd.to_datetime(df["date"], format="%m/%d/%Y", errors="coerce"))
+    return df.reset_index(drop=True)
+
+
+def read_headers(csv_path=EMAIL_HEADERS_CSV):
+    return clean_headers(pd.read_csv(csv_path, encoding="latin1"))
+
+
+def load_subject_clusters(csv_path=SUBJECT_CLUSTERS_CSV):
+    '''{lowercase title: lowercase subject cluster}, empty if there are no clusters'''
+    if not os.path.exists(csv_path):
+        return {}
+    clusters = pd.read_csv(csv_path, index_col=0).drop_duplicates("titles")
+    return dict(zip(clusters["titles"], clusters["subject"].str.lower()))
+
+
+def _department(employment_type, title):
+    if employment_type == "Administration" and isinstance(title, str) and title.startswith("Assistant to "):
+        assisted = title[len("Assistant to "):].replace(" Group Manager", "")
+        return "Executive" if assisted in EXECUTIVE_TITLES else DEPARTMENT_NAMES.get(assisted, assisted)
+    return DEPARTMENT_NAMES.get(employment_type, employment_type)
+
+
+def load_departments(records_path=EMPLOYEE_RECORDS, classes_path=PEOPLE_CLASSES_CSV):
+    '''
+    {mail name: department} from the employee records, where the curated
+    classes in classes_path take precedence.
+    '''
+    departments = {}
+    try:
+        records = pd.read_excel(records_path, sheet_name="Employee Records")
+        names = records["EmailAddress"].str.lower().str.split("@").str[0]
+        departments.update(
+            (name, _department(employment_type, title))
+            for name, employment_type, title in zip(names, records["CurrentEmploymentType"], records["CurrentEmploymentTitle"])
+        )
+    except (ImportError, OSError, ValueError) as e:
+        # reading xlsx needs openpyxl
+        print(f"Warning: could not read {records_path}: {e}")
+    if classes_path and os.path.exists(classes_path):
+        classes = pd.read_csv(classes_path)
+        departments.update(zip(classes["name"], classes["class"]))
+    return departments
+
+
+def aggregate_edges(rows, clusters):
+    '''
+    sender -> recipient mail counts and the sorted subject clusters of each pair,
+    in order of first appearance. mails to oneself are not links.
+    '''
+    rows = rows[rows["sender"] != rows["recipients"]]
+    rows = rows.assign(cluster=rows["subject"].map(clusters).fillna(UNCLASSIFIED))
+    counts = rows.groupby(["sender", "recipients"], sort=False).size()
+    subjects = (
+        rows[["sender", "recipients", "cluster"]].drop_duplicates()
+        .sort_values("cluster", kind="mergesort")
+        .groupby(["sender", "recipients"])["cluster"].agg(list)
+    )
+    return pd.DataFrame({
+        "source": counts.index.get_level_values(0),
+        "target": counts.index.get_level_values(1),
+        "weight": counts.to_numpy(),
+        "subjects": subjects.reindex(counts.index).to_numpy(),
+    })
+
+
+def node_records(names, departments):
+    return [{"id": name, "label": "PERSON", "department": departments.get(name)} for name in sorted(names)]
+
+
+def build_email_graph(rows, clusters, departments):
+    '''email graph {"nodes", "links"} in the email_graph.json shape'''
+    edges = aggregate_edges(rows, clusters)
+    people = set(rows["sender"]) | set(rows["recipients"])
+    links = [
+        {"source": source, "target": target, "weight": int(weight), "subjects": subjects}
+        for source, target, weight, subjects in edges.itertuples(index=False)
+    ]
+    return {"nodes": node_records(people, departments), "links": links}
+
+
+def append_email_rows(graph, rows, clusters, departments):
+    '''
+    add the mails in rows to graph in place. only the counts and subjects of
+    the pairs in rows are touched, new pairs and people are appended.
+    return the number of links changed or added
+    '''
+    edges = aggregate_edges(rows, clusters)
+    link_index = {(link["source"], link["target"]): i for i, link in enumerate(graph["links"])}
+    for source, target, weight, subjects in edges.itertuples(index=False):
+        i = link_index.get((source, target))
+        if i is None:
+            graph["links"].append({"source": source, "target": target, "weight": int(weight), "subjects": subjects})
+        else:
+            link = graph["links"][i]
+            link["weight"] += int(weight)
+            link["subjects"] = sorted(set(link["subjects"]) | set(subjects))
+
+    people = {node["id"] for node in graph["nodes"]}
+    new_people = (set(rows["sender"]) | set(rows["recipients"])) - people
+    if new_people:
+        graph["nodes"] = node_records(people | new_people, {**{node["id"]: node["department"] for node in graph["nodes"]}, **departments})
+    return len(edges)
+
+
+def write_email_graph(graph, json_path=EMAIL_GRAPH_JSON):
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(graph, f, indent=2)
+    os.replace(tmp_path, json_path)
+
+
+def create_email_graph(headers_path=EMAIL_HEADERS_CSV, json_path=EMAIL_GRAPH_JSON):
+    start = time.perf_counter()
+    rows = read_headers(headers_path)
+    graph = build_email_graph(rows, load_subject_clusters(), load_departments())
+    write_email_graph(graph, json_path)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {len(graph['nodes'])} nodes and {len(graph['links'])} links from {len(rows)} mails "
+          f"to {json_path} in {elapsed:.2f}s ({len(rows) / elapsed:.0f} mails/s)")
+    return graph
+
+
+def update_email_graph(headers_paths, json_path=EMAIL_GRAPH_JSON):
+    '''append new header csv files to an existing email graph'''
+    with open(json_path, "r", encoding="utf-8") as f:
+        graph = json.load(f)
+    rows = pd.concat([read_headers(path) for path in headers_paths], ignore_index=True)
+    changed = append_email_rows(graph, rows, load_subject_clusters(), load_departments())
+    write_email_graph(graph, json_path)
+    print(f"Appended {len(rows)} mails to {json_path}, {changed} links changed or added")
+    return graph
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Build email_graph.json from the email headers")
+    arg_parser.add_argument("--append", nargs="+", metavar="CSV", default=None,
+                            help="header csv files to add to the existing graph instead of rebuilding it")
+    args = arg_parser.parse_args()
+    if args.append:
+        update_email_graph(args.append)
+    else:
+        create_email_graph()
@@ -0,0 +1,285 @@
+import os
+import re
+import argparse
+import threading
+import numpy as np
+from array_store import unpack_strings, string_at
+from graph_store import (
+    graph_store_path, source_fingerprint, encode_names,
+    write_graph_store, read_graph_meta, load_graph_store,
+)
+
+# path -> ((mtime, size), graph), see load_entity_graph
+_graph_cache = {}
+_graph_cache_lock = threading.Lock()
+
+
+# === 解析 Cypher 文件 ===
+def parse_cypher_file(filepath, with_article_ids=False):
+    '''with_article_ids: also keep the article_ids of each link, as a list of strings'''
+    nodes = {}
+    edges = []
+    current_source = None
+    current_target = None
+
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+
+            # 解析节点
+            if line.startswith("CREATE (") and "name:" in line:
+                match = re.search(r'\(:([A-Z]+) \{name:\s*"([^"]+)"\}\)', line)
+                if match:
+                    label, name = match.groups()
+                    nodes[name] = label
+
+            # 解析MATCH行
+            elif line.startswith("MATCH") and "{name:" in line:
+                node_matches = re.findall(r'\{name:\s*"([^"]+)"\}', line)
+                if len(node_matches) == 2:
+                    current_source, current_target = node_matches
+                else:
+                    current_source, current_target = None, None
+
+            # 解析CREATE关系
+            elif line.startswith("CREATE") and current_source and current_target:
+                weight_match = re.search(r'weight:\s*(\d+)', line)
+                weight = int(weight_match.group(1)) if weight_match else 1
+                ids_match = re.search(r'article_ids:\s*"([^"]*)"', line)
+                article_ids = ids_match.group(1).split(",") if ids_match and ids_match.group(1) else []
+                edges.append((current_source, current_target, weight, article_ids))
+                current_source, current_target = None, None
+
+    node_list = [{"id": name, "label": label} for name, label in nodes.items()]
+    link_list = [{"source": src, "target": tgt, "weight": w} for src, tgt, w, _ in edges]
+    if with_article_ids:
+        for link, (_, _, _, article_ids) in zip(link_list, edges):
+            link["article_ids"] = article_ids
+    return {"nodes": node_list, "links": link_list}
+
+
+def _parse_unit(article_id):
+    '''(article id, sentence index) of an article_ids entry, "12-3" or "12" (sentence -1)'''
+    article, _, sentence = article_id.partition("-")
+    return int(article), int(sentence) if sentence else -1
+
+
+def compile_graph(graph):
+    '''
+    index a parsed graph for serving, as flat arrays (the layout of a graph store).
+    nodes are numbered in file order, names are kept as one utf-8 buffer with
+    offsets and a sorted order for lookups. the links are stored as an
+    undirected adjacency in CSR form: the neighbours of node i are
+    adj_nodes[indptr[i]:indptr[i+1]], reached through the links adj_links[...]
+    with weights adj_weights[...]. the article ids of link i are
+    unit_articles/unit_sentences[unit_offsets[i]:unit_offsets[i+1]].
+    '''
+    node_names = [node["id"] for node in graph["nodes"]]
+    node_index = {name: i for i, name in enumerate(node_names)}
+    # links may name nodes without a CREATE line, give them an index too
+    for link in graph["links"]:
+        for name in (link["source"], link["target"]):
+            if name not in node_index:
+                node_index[name] = len(node_names)
+                node_names.append(name)
+
+    label_names = sorted({node["label"] for node in graph["nodes"]})
+    label_codes = np.full(len(node_names), -1, dtype=np.int8)
+    for node in graph["nodes"]:
+        label_codes[node_index[node["id"]]] = label_names.index(node["label"])
+
+    n_links = len(graph["links"])
+    src = np.fromiter((node_index[link["source"]] for link in graph["links"]), dtype=np.int64, count=n_links)
+    dst = np.fromiter((node_index[link["target"]] for link in graph["links"]), dtype=np.int64, count=n_links)
+    weights = np.fromiter((link["weight"] for link in graph["links"]), dtype=np.int64, count=n_links)
+    link_ids = np.arange(n_links)
+
+    # both directions, self loops only once
+    not_loop = src != dst
+    from_nodes = np.concatenate([src, dst[not_loop]])
+    to_nodes = np.concatenate([dst, src[not_loop]])
+    adj_links = np.concatenate([link_ids, link_ids[not_loop]])
+    order = np.lexsort((adj_links, from_nodes))
+    indptr = np.zeros(len(node_names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(from_nodes, minlength=len(node_names)), out=indptr[1:])
+
+    units = [_parse_unit(article_id) for link in graph["links"] for article_id in link.get("article_ids", [])]
+    unit_offsets = np.zeros(n_links + 1, dtype=np.int64)
+    np.cumsum([len(link.get("article_ids", [])) for link in graph["links"]], out=unit_offsets[1:])
+    units = np.array(units, dtype=np.int64).reshape(-1, 2)
+
+    node_bytes, node_offsets, name_order = encode_names(node_names)
+    return {
+        "node_bytes": node_bytes,
+        "node_offsets": node_offsets,
+        "name_order": name_order,
+        "label_names": label_names,
+        "label_codes": label_codes,
+        "link_src": src,
+        "link_dst": dst,
+        "link_weights": weights,
+        "indptr": indptr,
+        "adj_nodes": to_nodes[order],
+        "adj_links": adj_links[order],
+        "adj_weights": weights[adj_links[order]],
+        "unit_offsets": unit_offsets,
+        "unit_articles": units[:, 0],
+        "unit_sentences": units[:, 1],
+    }
+
+
+def node_names(graph):
+    '''names of all nodes, decoded from the name buffer'''
+    return unpack_strings(graph["node_bytes"], graph["node_offsets"])
+
+
+def node_name(graph, i):
+    return string_at(graph["node_bytes"], graph["node_offsets"], i)
+
+
+def find_node(graph, name):
+    '''index of the node called name, or None. a binary search over the sorted names'''
+    key = name.encode("utf-8")
+    node_bytes, offsets, name_order = graph["node_bytes"], graph["node_offsets"], graph["name_order"]
+    lo, hi = 0, len(name_order)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        i = name_order[mid]
+        if node_bytes[offsets[i]:offsets[i + 1]].tobytes() < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(name_order):
+        i = int(name_order[lo])
+        if node_bytes[offsets[i]:offsets[i + 1]].tobytes() == key:
+            return i
+    return None
+
+
+def node_records(graph, ids, names=None):
+    '''{"id", "label"} of the given nodes, names only seen in links have no record'''
+    label_names, label_codes = graph["label_names"], graph["label_codes"]
+    return [
+        {"id": names[i] if names else node_name(graph, i), "label": label_names[label_codes[i]]}
+        for i in ids if label_codes[i] >= 0
+    ]
+
+
+def link_records(graph, ids, names=None):
+    '''{"source", "target", "weight"} of the given links'''
+    src, dst, weights = graph["link_src"], graph["link_dst"], graph["link_weights"]
+    name = (lambda i: names[i]) if names else (lambda i: node_name(graph, i))
+    return [{"source": name(src[i]), "target": name(dst[i]), "weight": int(weights[i])} for i in ids]
+
+
+def link_article_ids(graph, link):
+    '''article ids of link as written in the cypher file ("12-3" or "12")'''
+    lo, hi = graph["unit_offsets"][link], graph["unit_offsets"][link + 1]
+    return [
+        f"{article}-{sentence}" if sentence >= 0 else str(article)
+        for article, sentence in zip(graph["unit_articles"][lo:hi].tolist(), graph["unit_sentences"][lo:hi].tolist())
+    ]
+
+
+def graph_payload(graph):
+    '''the whole graph as {"nodes", "links"}, as parse_cypher_file returns it'''
+    names = node_names(graph)
+    return {
+        "nodes": node_records(graph, range(len(names)), names),
+        "links": link_records(graph, range(len(graph["link_src"])), names),
+    }
+
+
+def convert_cypher(filepath, store_path=None):
+    '''compile a cypher file and save it as a graph store next to it (or at store_path)'''
+    store_path = store_path or graph_store_path(filepath)
+    source = source_fingerprint(filepath)
+    graph = compile_graph(parse_cypher_file(filepath, with_article_ids=True))
+    try:
+        write_graph_store(store_path, graph, source)
+    except OSError as e:
+        # read only data directory, serve from memory
+        print(f"Warning: could not write {store_path}: {e}")
+    return graph
+
+
+def load_entity_graph(filepath):
+    '''
+    compiled graph of a cypher file, kept in memory.
+    it is memory-mapped from the graph store next to the file when the store was
+    converted from the current version of the file, otherwise the file is parsed
+    and the store (re)written. the returned graph is shared between requests and
+    must not be modified.
+    '''
+    stat = os.stat(filepath)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _graph_cache.get(filepath)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    with _graph_cache_lock:
+        cached = _graph_cache.get(filepath)
+        if cached and cached[0] == version:
+            return cached[1]
+        store_path = graph_store_path(filepath)
+        meta = read_graph_meta(store_path)
+        if meta is not None and meta["source"] == source_fingerprint(filepath):
+            graph = load_graph_store(store_path)
+        else:
+            graph = convert_cypher(filepath, store_path)
+        _graph_cache[filepath] = (version, graph)
+        return graph
+
+
+def neighbourhood(graph, center, hops=1, min_weight=1, labels=None, max_nodes=None):
+    '''
+    subgraph around center, expanded breadth first over the CSR adjacency.
+    hops: how many links away from center to go.
+    min_weight: ignore links with a lower co-occurrence weight.
+    labels: only expand into nodes with one of these labels (e.g. ["PERSON"]).
+    max_nodes: stop expanding once this many nodes are collected.
+    returns the collected nodes and the links that were followed, both in file order.
+    the cost depends on the size of the neighbourhood, not the whole graph.
+    '''
+    start = find_node(graph, center)
+    if start is None:
+        return {"nodes": [], "links": []}
+
+    allowed_labels = None
+    if labels:
+        allowed_labels = np.array([graph["label_names"].index(label) for label in labels if label in graph["label_names"]])
+
+    indptr, adj_nodes = graph["indptr"], graph["adj_nodes"]
+    adj_links, adj_weights = graph["adj_links"], graph["adj_weights"]
+    visited = {start}
+    link_ids = set()
+    frontier = [start]
+    for _ in range(hops):
+        next_frontier = []
+        for node in frontier:
+            lo, hi = indptr[node], indptr[node + 1]
+            keep = adj_weights[lo:hi] >= min_weight
+            if allowed_labels is not None:
+                keep &= np.isin(graph["label_codes"][adj_nodes[lo:hi]], allowed_labels)
+            for neighbour, link in zip(adj_nodes[lo:hi][keep].tolist(), adj_links[lo:hi][keep].tolist()):
+                if neighbour not in visited:
+                    if max_nodes is not None and len(visited) >= max_nodes:
+                        continue
+                    visited.add(neighbour)
+                    next_frontier.append(neighbour)
+                link_ids.add(link)
+        frontier = next_frontier
+        if not frontier:
+            break
+
+    return {"nodes": node_records(graph, sorted(visited)), "links": link_records(graph, sorted(link_ids))}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Convert cypher graph files to binary graph stores")
+    arg_parser.add_argument("cypher_files", nargs="+", help="cypher files, each store is written next to its file")
+    args = arg_parser.parse_args()
+    for cypher_file in args.cypher_files:
+        graph = convert_cypher(cypher_file)
+        print(f"Converted {cypher_file} ({len(graph['node_offsets']) - 1} nodes, "
+              f"{len(graph['link_src'])} links) to {graph_store_path(cypher_file)}")
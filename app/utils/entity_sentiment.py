@@ -0,0 +1,264 @@
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+import pandas as pd
+
+ARTICLES_CSV = "../data/news_articles.csv"
+EXPANDED_CSV = "../data/df_expanded_with_sentiment.csv"
+CACHE_FILE = "../data/entity_sentiment_cache.json"
+SPACY_MODEL = "en_core_web_sm"
+# bump when the entity rules or models change, so cached results are recomputed
+PIPELINE_VERSION = 1
+# sentences longer than this are cut before classification, to stay under the model's token limit
+SENTENCE_CHAR_LIMIT = 1500
+
+# entities (lowercase) that are always organizations
+CORRECT_LABELS = {
+    "kronos": "ORG",
+    "gastech": "ORG",
+    "pok": "ORG",
+    "apa": "ORG",
+    "anti-pollution alliance": "ORG",
+    "protectors of kronos": "ORG",
+    "kronos government": "ORG"
+}
+
+# any entity containing one of these is the pok
+SPECIAL_CASES = {
+    "people of kronos": "pok",
+    "the people of kronos": "pok",
+    "protectors of kronos": "pok",
+    "citizens of kronos": "pok",
+    "members of kronos": "pok"
+}
+
+PERSON_NORMALIZATION = {
+    "carman d'": "carman adrien",
+    "carman de adrien": "carman adrien",
+    "carmen adrien": "carman adrien",
+    "ada campo-corren": "ada campo-corrente",
+    "sanjorge jr.": "sanjorge jr",
+    "sanjorge jr.'s": "sanjorge jr",
+    "sanjorge, jr.": "sanjorge jr",
+    "sanjorge sr.": "sanjorge sr",
+    "silvia marek's": "silvia marek",
+    "sten": "sten sanjorge jr",
+    "sten jr.": "sten sanjorge jr",
+    "sten sanjorge": "sten sanjorge jr",
+    "sten sanjorge jr": "sten sanjorge jr",
+    "sten sanjorge jr.": "sten sanjorge jr",
+    "sten sanjorge jr.'s": "sten sanjorge jr",
+    "sten sanjorge - perforating": "sten sanjorge jr",
+    "sten sanjorge de gastech": "sten sanjorge jr",
+    "sten sanjorge je": "sten sanjorge jr",
+    "sten sanjorge jr. sanjorge": "sten sanjorge jr",
+    "sten sanjorge pok": "sten sanjorge jr",
+    "sten sanjorge, jr": "sten sanjorge jr",
+    "sten sanjorge, jr.": "sten sanjorge jr"
+}
+
+ENTITY_BLACKLIST = {"considerar"}
+
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+')
+MARKUP = re.compile(r"<<.*?>>")
+
+
+def clean_text(text):
+    '''drop misinterpreted (non ascii or non printable) characters'''
+    return ''.join(c for c in text if ord(c) < 128 and c.isprintable())
+
+
+def clean_entity_name(name):
+    if not name:
+        return ""
+    name = name.strip()
+    name = name.replace("抯", "'s")
+    name = name.replace("揓", "J")
+    name = name.replace("�", "")
+    return clean_text(name)
+
+
+def correct_label(text, label):
+    '''
+    normalized (name, label) of a spaCy entity, or None if it is not kept.
+    only whitelisted organizations and persons are kept.
+    '''
+    text = clean_entity_name(text.strip())
+    text_lower = text.lower()
+
+    if text_lower in ENTITY_BLACKLIST:
+        return None
+
+    for pattern, normalized_name in SPECIAL_CASES.items():
+        if pattern in text_lower:
+            return normalized_name, "ORG"
+
+    if text_lower in CORRECT_LABELS:
+        return text, CORRECT_LABELS[text_lower]
+    elif label == "PERSON":
+        return PERSON_NORMALIZATION.get(text_lower, text_lower), "PERSON"
+    return None
+
+
+def ner_text(content):
+    '''the text entities are extracted from: content without <<...>> markup'''
+    return clean_text(MARKUP.sub("", content))
+
+
+def doc_entities(doc):
+    '''lowercase entity names of a spaCy doc, each once, in order of appearance'''
+    entities = []
+    seen = set()
+    for ent in doc.ents:
+        corrected = correct_label(ent.text, ent.label_)
+        if corrected:
+            key = (corrected[0].lower(), corrected[1])
+            if key not in seen:
+                entities.append(key[0])
+                seen.add(key)
+    return entities
+
+
+def entity_sentence(content, entity):
+    '''first sentence of content mentioning entity, cut to SENTENCE_CHAR_LIMIT, or None'''
+    for sentence in SENTENCE_SPLIT.split(content):
+        if entity.lower() in sentence.lower():
+            return sentence[:SENTENCE_CHAR_LIMIT]
+    return None
+
+
+def content_hash(content):
+    return hashlib.sha256(f"{PIPELINE_VERSION}\0{content}".encode("utf-8")).hexdigest()
+
+
+def read_cache(path):
+    '''{content hash: result} of earlier runs, empty if there is no cache yet'''
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_cache(path, cache):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def load_models(spacy_model=SPACY_MODEL):
+    '''
+    (nlp, polarity, classifier): the spaCy pipeline, TextBlob polarity of a text
+    and the transformers sentiment classifier. imported here so the rest of the
+    module works without the nlp dependencies (requirement-nlp.txt) installed.
+    '''
+    import spacy
+    from textblob import TextBlob
+    from transformers import pipeline
+
+    # only the entity recognizer is used
+    nlp = spacy.load(spacy_model, disable=["parser", "lemmatizer"])
+    return nlp, lambda text: TextBlob(text).sentiment.polarity, pipeline("sentiment-analysis")
+
+
+def analyze_contents(contents, models, batch_size=64, n_process=1):
+    '''
+    article sentiment, entities and entity sentiments of every content.
+    spaCy runs over the batches with nlp.pipe (in n_process processes), the
+    article polarity is computed as each doc comes back, and the entity
+    sentences of a batch are classified together.
+    return a result dict per content, in order.
+    '''
+    nlp, polarity, classifier = models
+    results = []
+    docs = nlp.pipe(((ner_text(content), content) for content in contents),
+                    as_tuples=True, batch_size=batch_size, n_process=n_process)
+    batch = []
+    for doc, content in docs:
+        batch.append({"content": content, "sentiment": polarity(content), "entities": doc_entities(doc)})
+        if len(batch) == batch_size:
+            results.extend(_score_entities(batch, classifier, batch_size))
+            batch = []
+    results.extend(_score_entities(batch, classifier, batch_size))
+    return results
+
+
+def _score_entities(batch, classifier, batch_size):
+    sentences = {}
+    for item in batch:
+        for entity in item["entities"]:
+            sentence = entity_sentence(item["content"], entity)
+            if sentence is not None:
+                sentences.setdefault(sentence, None)
+    if sentences:
+        labels = classifier(list(sentences), batch_size=batch_size)
+        for sentence, label in zip(list(sentences), labels):
+            sentences[sentence] = label["score"] if label["label"] == "POSITIVE" else -label["score"]
+
+    results = []
+    for item in batch:
+        entity_sentiments = []
+        for entity in item["entities"]:
+            sentence = entity_sentence(item["content"], entity)
+            entity_sentiments.append(0.0 if sentence is None else sentences[sentence])
+        results.append({"sentiment": item["sentiment"], "entities": item["entities"],
+                        "entity_sentiments": entity_sentiments})
+    return results
+
+
+def expand_results(articles_df, results):
+    '''one row per (article, entity) in the df_expanded_with_sentiment.csv layout'''
+    rows = []
+    for article, result in zip(articles_df.to_dict("records"), results):
+        for entity, entity_sentiment in zip(result["entities"], result["entity_sentiments"]):
+            rows.append({**article, "sentiment": result["sentiment"],
+                         "entities": entity, "entity_sentiment": entity_sentiment})
+    columns = list(articles_df.columns) + ["sentiment", "entities", "entity_sentiment"]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def run_pipeline(csv_path=ARTICLES_CSV, out_path=EXPANDED_CSV, cache_path=CACHE_FILE,
+                 batch_size=64, n_process=1, models=None):
+    '''
+    build the expanded entity sentiment table from the news csv.
+    results are cached per article content hash, so only new or changed
+    articles go through the models.
+    '''
+    start = time.perf_counter()
+    articles_df = pd.read_csv(csv_path, sep="|", quotechar="~")
+    articles_df = articles_df.dropna(subset=["content", "source"]).rename(columns={"id": "articleID"})
+    for column in articles_df.columns[articles_df.dtypes == object]:
+        articles_df[column] = articles_df[column].map(lambda x: clean_text(x) if isinstance(x, str) else x)
+
+    cache = read_cache(cache_path)
+    hashes = [content_hash(content) for content in articles_df["content"]]
+    missing = {}
+    for key, content in zip(hashes, articles_df["content"]):
+        if key not in cache:
+            missing.setdefault(key, content)
+    print(f"{len(missing)} of {len(hashes)} articles are new or changed")
+
+    if missing:
+        models = models or load_models()
+        analyze_start = time.perf_counter()
+        cache.update(zip(missing, analyze_contents(list(missing.values()), models, batch_size, n_process)))
+        elapsed = time.perf_counter() - analyze_start
+        print(f"Analyzed {len(missing)} articles in {elapsed:.2f}s ({len(missing) / elapsed:.1f} articles/s)")
+        write_cache(cache_path, cache)
+
+    expanded = expand_results(articles_df, [cache[key] for key in hashes])
+    if out_path:
+        expanded.to_csv(out_path, index=False)
+        print(f"Wrote {len(expanded)} rows to {out_path} in {time.perf_counter() - start:.2f}s")
+    return expanded
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Extract entities and sentiment into df_expanded_with_sentiment.csv")
+    arg_parser.add_argument("--batch-size", type=int, default=64, help="documents per nlp.pipe and classifier batch")
+    arg_parser.add_argument("--processes", type=int, default=1, help="spaCy processes, -1 for the cpu count")
+    args = arg_parser.parse_args()
+    run_pipeline(batch_size=args.batch_size, n_process=args.processes)
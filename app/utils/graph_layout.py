@@ -0,0 +1,145 @@
+import zlib
+import threading
+import numpy as np
+from result_cache import LRUCache
+
+# force-directed iterations of a new layout, and of a relayout seeded from a cached one
+LAYOUT_ITERATIONS = 60
+RELAYOUT_ITERATIONS = 15
+# largest step of a node in the first iteration, coordinates are in the unit square
+LAYOUT_TEMPERATURE = 0.1
+RELAYOUT_TEMPERATURE = 0.02
+# share of the nodes that need a cached position for a seeded relayout
+RELAYOUT_MIN_OVERLAP = 0.8
+# above this many nodes repulsion is estimated from a sample of this many nodes
+REPULSION_SAMPLE = 500
+# rows of the pairwise repulsion computed at once
+LAYOUT_CHUNK = 1024
+LAYOUT_CACHE_SIZE = 64
+
+# (dataset, filter key, fingerprint) -> {name: (x, y)}
+_layout_cache = LRUCache(max_size=LAYOUT_CACHE_SIZE)
+# dataset -> {name: (x, y)} of its last layout, the seed of the next one
+_last_positions = {}
+_last_positions_lock = threading.Lock()
+
+
+def hash_positions(names):
+    '''a fixed position per name, so the same node starts at the same place in every layout'''
+    codes = np.array([zlib.crc32(name.encode("utf-8")) for name in names], dtype=np.uint64)
+    return np.column_stack([(codes & 0xFFFF) / 0xFFFF, (codes >> 16) / 0xFFFF]).astype(np.float64)
+
+
+def force_layout(pos, src, dst, weights, iterations=LAYOUT_ITERATIONS, temperature=LAYOUT_TEMPERATURE, seed=0):
+    '''
+    fruchterman-reingold layout refined from the n x 2 positions pos, vectorized
+    over all nodes. nodes repel with k^2 / d and linked nodes attract with
+    d^2 / k scaled by the log of the link weight. the step size cools linearly
+    from temperature to 0. return the new positions, scaled to the unit square.
+    '''
+    pos = np.array(pos, dtype=np.float64)
+    n = len(pos)
+    if n < 2:
+        return np.full((n, 2), 0.5)
+    rng = np.random.default_rng(seed)
+    k = np.sqrt(1.0 / n)
+    strength = np.log1p(np.asarray(weights, dtype=np.float64))
+
+    for iteration in range(iterations):
+        if n > REPULSION_SAMPLE:
+            others = pos[rng.choice(n, REPULSION_SAMPLE, replace=False)]
+            scale = n / REPULSION_SAMPLE
+        else:
+            others, scale = pos, 1.0
+        disp = np.zeros_like(pos)
+        others_sq = (others ** 2).sum(axis=1)
+        for start in range(0, n, LAYOUT_CHUNK):
+            block = pos[start:start + LAYOUT_CHUNK]
+            dist2 = (block ** 2).sum(axis=1)[:, None] + others_sq[None, :] - 2 * block @ others.T
+            # a node (or one on the same spot) does not push itself
+            inv = np.divide(k * k, dist2, out=np.zeros_like(dist2), where=dist2 > 1e-9)
+            # sum_j (p_i - o_j) * inv_ij without the n x m x 2 differences
+            disp[start:start + LAYOUT_CHUNK] = (block * inv.sum(axis=1)[:, None] - inv @ others) * scale
+
+        delta = pos[src] - pos[dst]
+        dist = np.sqrt((delta ** 2).sum(axis=1))
+        pull = delta * (dist * strength / k)[:, None]
+        np.subtract.at(disp, src, pull)
+        np.add.at(disp, dst, pull)
+
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)
+        step = temperature * (1 - iteration / iterations)
+        pos += disp * (np.minimum(length, step) / length)[:, None]
+
+    lo, span = pos.min(axis=0), np.ptp(pos, axis=0)
+    span[span == 0] = 1
+    return (pos - lo) / span
+
+
+def _graph_index(payload):
+    '''node names of a {"nodes", "links"} payload and its links as index arrays'''
+    names = [node["id"] for node in payload["nodes"]]
+    index = {name: i for i, name in enumerate(names)}
+    for link in payload["links"]:
+        for end in ("source", "target"):
+            if link[end] not in index:
+                index[link[end]] = len(names)
+                names.append(link[end])
+    src = np.array([index[link["source"]] for link in payload["links"]], dtype=np.int64)
+    dst = np.array([index[link["target"]] for link in payload["links"]], dtype=np.int64)
+    weights = np.array([link.get("weight", 1) for link in payload["links"]], dtype=np.float64)
+    return names, src, dst, weights
+
+
+def compute_layout(payload, seed_positions=None):
+    '''
+    {name: (x, y)} for every node of payload. when most nodes have a position in
+    seed_positions the layout starts from there and only settles the new nodes
+    (placed at the mean of their placed neighbours), otherwise it starts from
+    the hash positions.
+    '''
+    names, src, dst, weights = _graph_index(payload)
+    pos = hash_positions(names)
+    seeded = np.array([bool(seed_positions) and name in seed_positions for name in names], dtype=bool)
+
+    if len(names) and seeded.mean() >= RELAYOUT_MIN_OVERLAP:
+        pos[seeded] = [seed_positions[name] for name, known in zip(names, seeded) if known]
+        # new nodes start next to the neighbours that already have a place
+        sums, counts = np.zeros_like(pos), np.zeros(len(names))
+        for a, b in ((src, dst), (dst, src)):
+            placed = seeded[b] & ~seeded[a]
+            np.add.at(sums, a[placed], pos[b[placed]])
+            np.add.at(counts, a[placed], 1)
+        near = counts > 0
+        pos[near] = sums[near] / counts[near, None] + (pos[near] - 0.5) * 0.02
+        pos = force_layout(pos, src, dst, weights, RELAYOUT_ITERATIONS, RELAYOUT_TEMPERATURE)
+    else:
+        pos = force_layout(pos, src, dst, weights)
+    return dict(zip(names, map(tuple, np.round(pos, 4).tolist())))
+
+
+def layout_payload(payload, dataset, key, fingerprint):
+    '''
+    payload with "x" and "y" (in [0, 1]) on every node record. layouts are cached
+    per (dataset, filter key, data fingerprint); a filter the cache has not seen
+    is laid out from the last layout of the same dataset when the graphs overlap.
+    '''
+    def compute():
+        with _last_positions_lock:
+            seed_positions = _last_positions.get(dataset)
+        return compute_layout(payload, seed_positions)
+
+    cache_key = (dataset, key, fingerprint)
+    positions = _layout_cache.get_or_compute(cache_key, compute)
+    if any(node["id"] not in positions for node in payload["nodes"]):
+        # a key that does not pin down the node set, settle the new nodes from the cached layout
+        positions = compute_layout(payload, positions)
+        _layout_cache.put(cache_key, positions)
+    with _last_positions_lock:
+        _last_positions[dataset] = positions
+    nodes = [{**node, "x": positions[node["id"]][0], "y": positions[node["id"]][1]} for node in payload["nodes"]]
+    return {**payload, "nodes": nodes}
+
+
+def layout_cache_stats():
+    return _layout_cache.stats()
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+from array_store import source_fingerprint, write_array_store, read_store_meta, load_array_store, pack_strings
+
+# bump when the layout of a graph store changes
+GRAPH_STORE_VERSION = 1
+GRAPH_STORE_SUFFIX = ".graph"
+
+# arrays of a compiled graph, one .npy file each
+GRAPH_ARRAYS = [
+    "node_bytes", "node_offsets", "name_order", "label_codes",
+    "link_src", "link_dst", "link_weights",
+    "indptr", "adj_nodes", "adj_links", "adj_weights",
+    "unit_offsets", "unit_articles", "unit_sentences",
+]
+
+
+def graph_store_path(cypher_path):
+    '''directory holding the binary form of a cypher file'''
+    return os.path.splitext(cypher_path)[0] + GRAPH_STORE_SUFFIX
+
+
+def encode_names(names):
+    '''
+    names packed with pack_strings (name i is bytes offsets[i]:offsets[i+1]) and
+    the permutation sorting them by their bytes, for binary search lookups
+    '''
+    buffer, offsets, _ = pack_strings(names)
+    data = buffer.tobytes()
+    bounds = offsets.tolist()
+    order = np.array(sorted(range(len(names)), key=lambda i: data[bounds[i]:bounds[i + 1]]), dtype=np.int64)
+    return buffer, offsets, order
+
+
+def write_graph_store(path, graph, source=None):
+    '''
+    write the arrays of a compiled graph as .npy files in directory path,
+    together with a meta.json holding the label names and the fingerprint of
+    the file it was converted from. the directory is replaced as a whole.
+    '''
+    meta = {
+        "version": GRAPH_STORE_VERSION,
+        "source": source,
+        "label_names": graph["label_names"],
+        "n_nodes": len(graph["node_offsets"]) - 1,
+        "n_links": len(graph["link_src"]),
+    }
+    write_array_store(path, {name: graph[name] for name in GRAPH_ARRAYS}, meta)
+
+
+def read_graph_meta(path):
+    '''meta.json of a graph store, or None if there is no store of this version'''
+    return read_store_meta(path, GRAPH_STORE_VERSION)
+
+
+def load_graph_store(path, mmap_mode="r"):
+    '''
+    compiled graph from a graph store. the arrays are memory-mapped read only,
+    so loading does not depend on the graph size and worker processes serving
+    the same store share its pages.
+    '''
+    meta = read_graph_meta(path)
+    if meta is None:
+        raise FileNotFoundError(f"No graph store at {path}")
+    graph = load_array_store(path, GRAPH_ARRAYS, mmap_mode)
+    graph["label_names"] = meta["label_names"]
+    return graph
@@ -0,0 +1,153 @@
+import os
+import threading
+import numpy as np
+from flask import Response, json, stream_with_context
+from entity_graph import node_name, node_records, link_records
+
+# records per line of a streamed graph
+STREAM_CHUNK = 1000
+
+# json path -> (version, view), see json_graph_view
+_view_cache = {}
+_view_cache_lock = threading.Lock()
+
+
+def entity_view(graph):
+    '''view over a compiled entity graph, records are only built for the ids asked for'''
+    return {
+        "n_nodes": len(graph["node_offsets"]) - 1,
+        "src": graph["link_src"],
+        "dst": graph["link_dst"],
+        "weights": graph["link_weights"],
+        "node_records": lambda ids: node_records(graph, ids),
+        "link_records": lambda ids: link_records(graph, ids),
+        "node_names": lambda ids: [node_name(graph, i) for i in ids],
+    }
+
+
+def payload_view(payload):
+    '''view over a {"nodes", "links"} payload such as the email graph or a neighbourhood'''
+    nodes, links = payload["nodes"], payload["links"]
+    index = {node["id"]: i for i, node in enumerate(nodes)}
+    # links may name nodes that have no record
+    for link in links:
+        for end in ("source", "target"):
+            index.setdefault(link[end], len(index))
+    names = list(index)
+    return {
+        "n_nodes": len(index),
+        "src": np.array([index[link["source"]] for link in links], dtype=np.int64),
+        "dst": np.array([index[link["target"]] for link in links], dtype=np.int64),
+        "weights": np.array([link["weight"] for link in links], dtype=np.int64),
+        "node_records": lambda ids: [nodes[i] for i in ids if i < len(nodes)],
+        "link_records": lambda ids: [links[i] for i in ids],
+        "node_names": lambda ids: [names[i] for i in ids],
+    }
+
+
+def json_graph_view(json_path):
+    '''view over a graph json file such as email_graph.json, kept until the file changes'''
+    stat = os.stat(json_path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _view_cache.get(json_path)
+    if cached and cached[0] == version:
+        return cached[1]
+    with _view_cache_lock:
+        cached = _view_cache.get(json_path)
+        if cached and cached[0] == version:
+            return cached[1]
+        with open(json_path, "r", encoding="utf-8") as f:
+            view = payload_view(json.load(f))
+        _view_cache[json_path] = (version, view)
+        return view
+
+
+def link_order(view, limit=None, min_weight=None):
+    '''
+    ids of the links to serve, in the order they are served: file order, or
+    heaviest first (ties in file order) when only the limit heaviest are kept.
+    '''
+    weights = np.asarray(view["weights"])
+    ids = np.arange(len(weights)) if min_weight is None else np.flatnonzero(weights >= min_weight)
+    if limit is not None:
+        ids = ids[np.argsort(-weights[ids], kind="stable")[:limit]]
+    return ids
+
+
+def first_seen(view, order, keep_isolated=True):
+    '''
+    position in order of the first link touching each node. nodes without a link
+    get -1 when keep_isolated (they go out first) and len(order) otherwise (never).
+    '''
+    first = np.full(view["n_nodes"], len(order), dtype=np.int64)
+    positions = np.arange(len(order), dtype=np.int64)
+    np.minimum.at(first, np.asarray(view["src"])[order], positions)
+    np.minimum.at(first, np.asarray(view["dst"])[order], positions)
+    if keep_isolated:
+        first[first == len(order)] = -1
+    return first
+
+
+def graph_page(view, cursor=0, page_size=None, limit=None, min_weight=None):
+    '''
+    one page of links from cursor on, with the nodes first needed by them, so
+    the pages together hold the same nodes and links as the graph (nodes in
+    page order, not in the order of the full payload). the next_cursor of the
+    last page is None. without a limit or min_weight nodes without links come
+    with the first page, and a single page equals the full payload.
+    '''
+    order = link_order(view, limit, min_weight)
+    first = first_seen(view, order, keep_isolated=limit is None and min_weight is None)
+    cursor = min(cursor, len(order))
+    stop = len(order) if page_size is None else min(cursor + page_size, len(order))
+    # nodes without links (first seen at -1) come with the first page
+    lo = -1 if cursor == 0 else cursor
+    node_ids = np.flatnonzero((first >= lo) & (first < stop))
+    return {
+        "nodes": view["node_records"](node_ids.tolist()),
+        "links": view["link_records"](order[cursor:stop].tolist()),
+        "total_links": len(order),
+        "next_cursor": str(stop) if stop < len(order) else None,
+    }
+
+
+def stream_lines(view, limit=None, min_weight=None, chunk=STREAM_CHUNK):
+    '''
+    the graph as NDJSON: a {"total_links"} line, then {"nodes": [...]} lines and
+    {"links": [...]} lines of up to chunk records each. records are built chunk
+    by chunk, the whole payload is never held in memory.
+    '''
+    order = link_order(view, limit, min_weight)
+    first = first_seen(view, order, keep_isolated=limit is None and min_weight is None)
+    node_ids = np.flatnonzero(first < len(order))
+    yield json.dumps({"total_links": len(order)}) + "\n"
+    for start in range(0, len(node_ids), chunk):
+        yield json.dumps({"nodes": view["node_records"](node_ids[start:start + chunk].tolist())}) + "\n"
+    for start in range(0, len(order), chunk):
+        yield json.dumps({"links": view["link_records"](order[start:start + chunk].tolist())}) + "\n"
+
+
+def stream_response(view, limit=None, min_weight=None):
+    return Response(stream_with_context(stream_lines(view, limit, min_weight)), mimetype="application/x-ndjson")
+
+
+def _int_option(params, name, minimum):
+    value = params.get(name)
+    if value is None or value == "":
+        return None
+    value = int(value)
+    if value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return value
+
+
+def paging_options(params):
+    '''
+    {"cursor", "page_size", "limit"} from request parameters (json body or query
+    string), None where not given. raises ValueError on invalid values.
+    '''
+    return {
+        "cursor": _int_option(params, "cursor", 0),
+        "page_size": _int_option(params, "page_size", 1),
+        "limit": _int_option(params, "limit", 1),
+    }
@@ -0,0 +1,315 @@
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import Response, request, g
+
+# upper bounds of the histogram buckets, request and query latencies in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# response sizes in bytes
+SIZE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+# profiling is off unless a directory for the traces is set
+PROFILE_DIR = os.environ.get("VAST_PROFILE_DIR")
+# requests slower than this get their trace dumped (milliseconds)
+PROFILE_SLOW_MS = float(os.environ.get("VAST_PROFILE_SLOW_MS", 500))
+# with several worker processes (serve.py) every worker writes its metrics to a
+# file in this directory and /metrics merges the files of all workers
+METRICS_DIR = os.environ.get("VAST_METRICS_DIR")
+# how often a worker writes its metrics file (seconds)
+METRICS_WRITE_SECONDS = float(os.environ.get("VAST_METRICS_WRITE_SECONDS", 1.0))
+
+
+class Histogram:
+    '''cumulative histogram per combination of label values, in the prometheus sense'''
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (+inf last), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def snapshot(self):
+        '''{label values: (count per bucket, sum)}, a copy'''
+        with self._lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+
+    def samples(self, series=None):
+        '''samples of series (a snapshot, by default the current one)'''
+        series = self.snapshot() if series is None else series
+        for label_values, (counts, total) in sorted(series.items()):
+            labels = dict(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+REQUEST_SECONDS = Histogram(
+    "vast_request_duration_seconds", "Time spent handling a request.", ["route", "method", "status"])
+RESPONSE_BYTES = Histogram(
+    "vast_response_size_bytes", "Size of the response body.", ["route"], SIZE_BUCKETS)
+QUERY_SECONDS = Histogram(
+    "vast_db_query_duration_seconds", "Time spent executing a named database query.", ["query"])
+AGGREGATION_SECONDS = Histogram(
+    "vast_aggregation_duration_seconds", "Time spent in a named aggregation.", ["name"])
+HISTOGRAMS = [REQUEST_SECONDS, RESPONSE_BYTES, QUERY_SECONDS, AGGREGATION_SECONDS]
+
+# name -> function returning {"hits", "misses"}, see register_cache
+_caches = {}
+# name -> (help, function returning {label value: value}), see register_gauge
+_gauges = {}
+# one profiled request at a time, the profiler hooks are process wide on newer pythons
+_profile_lock = threading.Lock()
+
+
+def register_cache(name, stats):
+    '''export the hit and miss counts returned by stats() as cache name'''
+    _caches[name] = stats
+
+
+def register_gauge(name, help_text, values):
+    '''export values(), a {label value: number} dict read at every scrape, as gauge name'''
+    _gauges[name] = (help_text, values)
+
+
+def _format_value(value):
+    return value if isinstance(value, str) else repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample_line(name, labels, value):
+    if labels:
+        label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+        return f"{name}{{{label_text}}} {_format_value(value)}"
+    return f"{name} {_format_value(value)}"
+
+
+def collect():
+    '''
+    the current values of every metric of this process, as a json-able dict
+    {"histograms": {name: [[label values, counts, sum]]}, "caches": {name:
+    {"hits", "misses"}}, "gauges": {name: {label value: value}}}
+    '''
+    return {
+        "histograms": {
+            histogram.name: [[list(labels), counts, total] for labels, (counts, total) in histogram.snapshot().items()]
+            for histogram in HISTOGRAMS
+        },
+        "caches": {
+            name: {"hits": stats()["hits"], "misses": stats()["misses"]} for name, stats in _caches.items()
+        },
+        "gauges": {name: values() for name, (_, values) in _gauges.items()},
+    }
+
+
+def merge(collected, live=None):
+    '''
+    sum the metrics collected in several processes. histograms and cache
+    counts add up over every process, gauges only over the live ones (indexes
+    of collected), the pool of a dead worker is gone.
+    '''
+    merged = {"histograms": {}, "caches": {}, "gauges": {}}
+    for i, metrics in enumerate(collected):
+        for name, series in metrics["histograms"].items():
+            total_series = merged["histograms"].setdefault(name, {})
+            for labels, counts, total in series:
+                entry = total_series.setdefault(tuple(labels), [[0] * len(counts), 0.0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+        for name, stats in metrics["caches"].items():
+            entry = merged["caches"].setdefault(name, {"hits": 0, "misses": 0})
+            entry["hits"] += stats["hits"]
+            entry["misses"] += stats["misses"]
+        if live is not None and i not in live:
+            continue
+        for name, values in metrics["gauges"].items():
+            entry = merged["gauges"].setdefault(name, {})
+            for kind, value in values.items():
+                entry[kind] = entry.get(kind, 0) + value
+    return merged
+
+
+def _metrics_file(directory, pid):
+    return os.path.join(directory, f"{pid}.json")
+
+
+def write_metrics_file(directory):
+    '''write the metrics of this process to its file in directory'''
+    path = _metrics_file(directory, os.getpid())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(collect(), f)
+    os.replace(tmp_path, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect_workers(directory):
+    '''
+    the metrics of every worker that wrote a file to directory, merged. this
+    process contributes its current values, the others those of their last
+    write (at most METRICS_WRITE_SECONDS old). workers that exited keep
+    counting in the histograms and cache counts, which must not go down.
+    '''
+    write_metrics_file(directory)
+    collected, live = [], set()
+    for name in sorted(os.listdir(directory)):
+        pid, ext = os.path.splitext(name)
+        if ext != ".json" or not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                metrics = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if _alive(int(pid)):
+            live.add(len(collected))
+        collected.append(metrics)
+    return merge(collected, live)
+
+
+def start_metrics_writer(directory, interval=METRICS_WRITE_SECONDS):
+    '''write the metrics file of this process every interval seconds, from a daemon thread'''
+    def write_forever():
+        while True:
+            try:
+                write_metrics_file(directory)
+            except OSError as e:
+                print(f"Warning: could not write metrics to {directory}: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=write_forever, name="metrics-writer", daemon=True).start()
+
+
+def render_metrics(metrics=None):
+    '''every metric (of collect() or merge(), by default this process) in the prometheus text exposition format'''
+    metrics = collect() if metrics is None else metrics
+    lines = []
+    for histogram in HISTOGRAMS:
+        series = metrics["histograms"].get(histogram.name, {})
+        if isinstance(series, list):
+            series = {tuple(labels): (counts, total) for labels, counts, total in series}
+        lines += [f"# HELP {histogram.name} {histogram.help_text}", f"# TYPE {histogram.name} histogram"]
+        lines += [_sample_line(name, labels, value) for name, labels, value in histogram.samples(series)]
+
+    caches = dict(sorted(metrics["caches"].items()))
+    for metric, kind, help_text in (
+        ("hits", "counter", "Cache lookups answered from the cache."),
+        ("misses", "counter", "Cache lookups that had to compute the value."),
+    ):
+        name = f"vast_cache_{metric}_total"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [_sample_line(name, {"cache": cache}, stats[metric]) for cache, stats in caches.items()]
+    lines += ["# HELP vast_cache_hit_ratio Share of cache lookups answered from the cache.",
+              "# TYPE vast_cache_hit_ratio gauge"]
+    for cache, stats in caches.items():
+        lookups = stats["hits"] + stats["misses"]
+        lines.append(_sample_line("vast_cache_hit_ratio", {"cache": cache}, stats["hits"] / lookups if lookups else 0.0))
+
+    for name, (help_text, _) in sorted(_gauges.items()):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [_sample_line(name, {"kind": kind} if kind else {}, value)
+                  for kind, value in metrics["gauges"].get(name, {}).items()]
+    return "\n".join(lines) + "\n"
+
+
+def metrics_response(metrics_dir=METRICS_DIR):
+    '''/metrics of this process, or of all workers when they write to metrics_dir'''
+    metrics = collect_workers(metrics_dir) if metrics_dir else None
+    return Response(render_metrics(metrics), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _route():
+    # the url rule keeps the label set small, /q2/data?entity=x and =y are one route
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def _dump_profile(profiler, route, elapsed, profile_dir):
+    os.makedirs(profile_dir, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "_", f"{request.method}{route}").strip("_")
+    path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(elapsed * 1000)}ms-{name}.prof")
+    pstats.Stats(profiler).dump_stats(path)
+    print(f"Slow request {request.method} {request.full_path.rstrip('?')} took {elapsed * 1000:.0f} ms, profile written to {path}")
+
+
+def instrument_app(app, profile_dir=PROFILE_DIR, slow_ms=PROFILE_SLOW_MS):
+    '''
+    record the latency and response size of every request of app. when
+    profile_dir is set every request runs under cProfile and the trace of
+    those slower than slow_ms is dumped there (open it with pstats or snakeviz).
+    '''
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.profiler = None
+        if profile_dir and _profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("request_start", None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = _route()
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            _profile_lock.release()
+            if elapsed * 1000 >= slow_ms:
+                _dump_profile(profiler, route, elapsed, profile_dir)
+
+        REQUEST_SECONDS.observe(elapsed, route, request.method, str(response.status_code))
+        # streamed bodies have no length up front
+        if not response.is_streamed:
+            RESPONSE_BYTES.observe(response.calculate_content_length() or 0, route)
+        return response
+
+    @app.teardown_request
+    def release_profiler(exc):
+        # after_request is skipped when a handler raises
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            _profile_lock.release()
+
+    return app
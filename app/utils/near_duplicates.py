@@ -0,0 +1,116 @@
+import numpy as np
+
+# words per shingle, and the minhash signature length split into bands x rows
+SHINGLE_SIZE = 1
+LSH_BANDS = 64
+LSH_ROWS = 3
+# words in more than this share of the documents (the, said, ...) are left out of the shingles
+MAX_WORD_DF = 0.1
+# buckets with more documents than this (boilerplate shared by everything) are skipped
+LSH_MAX_BUCKET = 500
+# shingles hashed at once when building signatures, bounds memory to this x bands x rows
+MINHASH_CHUNK = 1 << 16
+MINHASH_SEED = 1
+
+# mersenne prime of the universal hash family, a * x + b stays below 2**64
+HASH_PRIME = (1 << 31) - 1
+EMPTY = np.uint32(HASH_PRIME)
+BAND_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def candidate_probability(similarity, bands=LSH_BANDS, rows=LSH_ROWS):
+    '''
+    chance that two documents with this jaccard similarity of their shingles
+    share at least one band, i.e. the recall of the lsh at that similarity
+    '''
+    return 1 - (1 - np.asarray(similarity, dtype=np.float64) ** rows) ** bands
+
+
+def shingle_hashes(doc_idx, word_ids, shingle_size=SHINGLE_SIZE, skip=None):
+    '''
+    hashes of the word shingles of every document, from flat (doc index, word id)
+    arrays sorted by document. words marked in skip are dropped first. documents
+    with fewer words than shingle_size have no shingles.
+    return (doc index, hash) sorted by document.
+    '''
+    doc_idx, word_ids = np.asarray(doc_idx), np.asarray(word_ids, dtype=np.uint64)
+    if skip is not None:
+        keep = ~skip[word_ids]
+        doc_idx, word_ids = doc_idx[keep], word_ids[keep]
+
+    n = len(word_ids) - shingle_size + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    # a shingle may not run into the next document
+    starts = np.flatnonzero(doc_idx[:n] == doc_idx[shingle_size - 1:])
+    hashes = np.zeros(len(starts), dtype=np.uint64)
+    for offset in range(shingle_size):
+        hashes = (hashes * np.uint64(1_000_003) + word_ids[starts + offset]) % HASH_PRIME
+    return doc_idx[starts], hashes
+
+
+def minhash_signatures(doc_idx, hashes, n_docs, num_perm=LSH_BANDS * LSH_ROWS, seed=MINHASH_SEED, chunk_size=MINHASH_CHUNK):
+    '''
+    minhash signature of every document: the minimum of num_perm universal
+    hashes (a * x + b) mod p over its shingles. documents without shingles get
+    EMPTY everywhere. return an n_docs x num_perm uint32 array.
+    '''
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, HASH_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, HASH_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.full((n_docs, num_perm), EMPTY, dtype=np.uint32)
+
+    for start in range(0, len(hashes), chunk_size):
+        docs = doc_idx[start:start + chunk_size]
+        # one row per permutation, reduceat runs along contiguous memory
+        values = ((a[:, None] * hashes[start:start + chunk_size] + b[:, None]) % HASH_PRIME).astype(np.uint32)
+        # docs are sorted, reduce every run of the same document
+        run_starts = np.flatnonzero(np.r_[True, docs[1:] != docs[:-1]])
+        minima = np.minimum.reduceat(values, run_starts, axis=1).T
+        run_docs = docs[run_starts]
+        # a document may continue from the previous chunk
+        signatures[run_docs] = np.minimum(signatures[run_docs], minima)
+    return signatures
+
+
+def lsh_candidates(signatures, bands=LSH_BANDS, rows=LSH_ROWS, max_bucket=LSH_MAX_BUCKET):
+    '''
+    candidate pairs (i, j), i < j, of documents whose signatures agree on all
+    rows of at least one band. more bands or fewer rows raise the recall at a
+    given similarity (see candidate_probability) and the number of candidates.
+    '''
+    n_docs = len(signatures)
+    docs = np.flatnonzero(signatures[:, 0] != EMPTY)
+    pair_keys = []
+    for band in range(bands):
+        # one hash per band, a collision only adds a candidate that fails verification
+        band_keys = np.zeros(len(docs), dtype=np.uint64)
+        for row in range(band * rows, (band + 1) * rows):
+            band_keys = band_keys * np.uint64(BAND_MULTIPLIER) + signatures[docs, row]
+        _, bucket, sizes = np.unique(band_keys, return_inverse=True, return_counts=True)
+        # only buckets shared by several documents make pairs
+        shared = (sizes[bucket] >= 2) & (sizes[bucket] <= max_bucket)
+        order = np.argsort(bucket[shared], kind="stable")
+        bucket_docs, sorted_buckets = docs[shared][order], bucket[shared][order]
+        starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        bucket_sizes = np.diff(np.r_[starts, len(sorted_buckets)])
+        # all pairs of the buckets of one size at once
+        for size in np.unique(bucket_sizes).tolist():
+            members = bucket_docs[starts[bucket_sizes == size][:, None] + np.arange(size)]
+            i, j = np.triu_indices(size, k=1)
+            pair_keys.append((members[:, i] * n_docs + members[:, j]).ravel())
+
+    if not pair_keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # members are in document order, so every pair is already (smaller, larger)
+    keys = np.unique(np.concatenate(pair_keys))
+    return keys // n_docs, keys % n_docs
+
+
+def pair_similarities(normed, i, j, chunk_size=MINHASH_CHUNK):
+    '''exact cosine similarity of the candidate pairs, from l2-normalized sparse rows'''
+    sims = np.zeros(len(i))
+    for start in range(0, len(i), chunk_size):
+        stop = start + chunk_size
+        sims[start:stop] = np.asarray(normed[i[start:stop]].multiply(normed[j[start:stop]]).sum(axis=1)).ravel()
+    return sims
@@ -1,36 +1,295 @@
 import os
 import pandas as pd
 import numpy as np
-from matplotlib import pyplot as plt
 import string
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+import near_duplicates
 
 SIM_THRESHOLD = 0.5
+# max number of neighbours kept per article, and rows of the similarity product computed at once
+SIM_TOP_K = 50
+SIM_CHUNK_SIZE = 1024
+# "exact" compares all pairs, "lsh" only the minhash/lsh candidate pairs (see near_duplicates)
+SIM_METHOD = os.environ.get("VAST_SIM_METHOD", "exact")
+SIM_METHODS = ("exact", "lsh")
 
-def calc_sim_matrix():
-    articles_df = pd.read_csv("../data/news_articles.csv", encoding="utf-8", sep="|", parse_dates=["publish_date"])
+PUNCTUATION_TABLE = str.maketrans(string.punctuation, " " * len(string.punctuation))
+
+
+def load_articles(csv_path="../data/news_articles.csv"):
+    articles_df = pd.read_csv(csv_path, encoding="utf-8", sep="|", quotechar="~", parse_dates=["publish_date"])
     articles_df.set_index("id", inplace=True)
     articles_df.sort_index(inplace=True)
+    return articles_df
+
 
-    sources = articles_df["source"].unique()# split the words of content
-    articles_df["words"] = articles_df["content"].apply(lambda x: np.array(x.lower().translate(str.maketrans(string.punctuation, " "*len(string.punctuation))).split()))
-    vocab = np.unique(np.concatenate(articles_df["words"].values))
-    n_articles = len(articles_df)
-    n_vocab = len(vocab)
-    n_source = len(sources)
+def tokenize(contents: pd.Series):
+    '''
+    split every document into lowercase words with punctuation removed.
+    return (doc index, word) pairs as flat arrays, one entry per token.
+    '''
+    words = contents.fillna("").str.lower().str.translate(PUNCTUATION_TABLE).str.split()
+    lengths = words.str.len().to_numpy()
+    doc_idx = np.repeat(np.arange(len(words)), lengths)
+    tokens = np.array([w for doc in words for w in doc], dtype=object)
+    return doc_idx, tokens
 
-    word_index = {str(word): idx for idx, word in enumerate(vocab)}
-    tf = np.zeros((len(articles_df), len(vocab)))
 
-    for doc_idx, doc in enumerate(articles_df["words"].values):
-        for word in doc:
-            tf[doc_idx, word_index[word]] += 1
-        tf[doc_idx] /= len(doc)  # normalize by total words in doc
+def build_tfidf(contents: pd.Series):
+    '''
+    build the sparse (CSR) tf-idf matrix of the documents.
+    tf is normalized by document length and idf = log(n_docs / df).
+    return (tf_idf, vocab, idf)
+    '''
+    n_articles = len(contents)
+    doc_idx, tokens = tokenize(contents)
+    vocab, word_idx = np.unique(tokens, return_inverse=True)
 
-    df = np.count_nonzero(tf > 0, axis=0)  # doc freq per term
+    # duplicate (doc, word) entries are summed into counts
+    tf = sparse.csr_matrix(
+        (np.ones(len(tokens)), (doc_idx, word_idx)),
+        shape=(n_articles, len(vocab))
+    )
+    tf.sum_duplicates()
+    doc_len = np.bincount(doc_idx, minlength=n_articles).astype(np.float64)
+    doc_len[doc_len == 0] = 1
+    tf = sparse.diags(1 / doc_len) @ tf
+
+    df = np.bincount(tf.indices, minlength=len(vocab))  # doc freq per term
     idf = np.log(n_articles / (df + 1e-10))
 
-    tf_idf = tf * idf
+    tf_idf = (tf @ sparse.diags(idf)).tocsr()
+    return tf_idf, vocab, idf
+
+
+def normalize_rows(matrix):
+    '''l2-normalize the rows of a sparse matrix, leaving empty rows at zero'''
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sparse.diags(1 / norms) @ matrix).tocsr()
+
+
+def _top_k_per_row(r, c, s, top_k):
+    '''keep the top_k most similar entries of every row of (row, col, similarity) triples'''
+    if top_k is None or not len(s):
+        return r, c, s
+    # sort by row, then by descending similarity and keep the first top_k per row
+    order = np.lexsort((-s, r))
+    r, c, s = r[order], c[order], s[order]
+    row_start = np.searchsorted(r, r, side="left")
+    rank = np.arange(len(r)) - row_start
+    keep = rank < top_k
+    return r[keep], c[keep], s[keep]
+
+
+def top_k_similar(tf_idf, threshold=SIM_THRESHOLD, top_k=SIM_TOP_K, chunk_size=SIM_CHUNK_SIZE):
+    '''
+    cosine similarity between all rows of tf_idf, keeping for every row only the
+    top_k most similar other rows above threshold. the product is computed
+    chunk_size rows at a time so memory stays bounded by chunk_size x n.
+    return a sparse n x n CSR matrix.
+    '''
+    normed = normalize_rows(tf_idf)
+    n = normed.shape[0]
+    rows, cols, sims = [], [], []
+
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        block = (normed[start:stop] @ normed.T).tocoo()
+        # drop self similarity and everything under the threshold
+        keep = (block.data > threshold) & (block.row + start != block.col)
+        r, c, s = block.row[keep] + start, block.col[keep], block.data[keep]
+
+        r, c, s = _top_k_per_row(r, c, s, top_k)
+        rows.append(r)
+        cols.append(c)
+        sims.append(s)
+
+    return sparse.csr_matrix(
+        (np.concatenate(sims), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n, n)
+    )
+
+
+def lsh_top_k_similar(tf_idf, contents: pd.Series, threshold=SIM_THRESHOLD, top_k=SIM_TOP_K,
+                      bands=None, rows=None, shingle_size=None):
+    '''
+    top_k_similar restricted to the candidate pairs of a minhash/lsh index over
+    the word shingles of contents. the exact cosine similarity is only computed
+    for the candidates, so the cost grows with the number of near duplicates
+    instead of n squared. pairs the lsh misses are lost, bands and rows trade
+    recall for candidates (see near_duplicates.candidate_probability), the
+    near_duplicates settings are used for those not given.
+    '''
+    bands = bands or near_duplicates.LSH_BANDS
+    rows = rows or near_duplicates.LSH_ROWS
+    shingle_size = shingle_size or near_duplicates.SHINGLE_SIZE
+    n, n_words = tf_idf.shape
+    if shingle_size == 1:
+        # single word shingles are the words of each row of the tf-idf matrix
+        doc_idx, word_ids = np.repeat(np.arange(n), np.diff(tf_idf.indptr)), tf_idf.indices
+    else:
+        # word ids in vocabulary order, the columns of build_tfidf
+        doc_idx, tokens = tokenize(contents)
+        _, word_ids = np.unique(tokens, return_inverse=True)
+    # words in most documents make unrelated documents look alike
+    df = np.bincount(tf_idf.indices, minlength=n_words)
+    skip = df > max(near_duplicates.MAX_WORD_DF * n, 1)
+    signatures = near_duplicates.minhash_signatures(
+        *near_duplicates.shingle_hashes(doc_idx, word_ids, shingle_size, skip), n, bands * rows
+    )
+    i, j = near_duplicates.lsh_candidates(signatures, bands, rows)
+    sims = near_duplicates.pair_similarities(normalize_rows(tf_idf), i, j)
+    print(f"LSH: {len(i)} candidate pairs of {n * (n - 1) // 2}, {np.count_nonzero(sims > threshold)} above {threshold}")
+
+    keep = sims > threshold
+    # the similarity is symmetric, every pair is a candidate in both rows
+    r = np.concatenate([i[keep], j[keep]])
+    c = np.concatenate([j[keep], i[keep]])
+    s = np.concatenate([sims[keep], sims[keep]])
+    r, c, s = _top_k_per_row(r, c, s, top_k)
+    return sparse.csr_matrix((s, (r, c)), shape=(n, n))
+
+
+def similar_articles(tf_idf, contents: pd.Series, threshold=SIM_THRESHOLD, top_k=SIM_TOP_K,
+                     method=None, chunk_size=SIM_CHUNK_SIZE):
+    '''top-k similarity matrix with the exact all-pairs product or the lsh candidates'''
+    method = method or SIM_METHOD
+    if method == "lsh":
+        return lsh_top_k_similar(tf_idf, contents, threshold, top_k)
+    if method != "exact":
+        raise ValueError(f"Unknown similarity method {method!r}, expected one of {SIM_METHODS}")
+    return top_k_similar(tf_idf, threshold, top_k, chunk_size)
+
+
+def calc_sim_matrix(threshold=SIM_THRESHOLD, top_k=SIM_TOP_K, chunk_size=SIM_CHUNK_SIZE, method=None):
+    '''
+    sparse article similarity matrix in article id order.
+    entry (i, j) holds the cosine similarity of the tf-idf vectors of article i and j,
+    only for the top_k neighbours of i whose similarity is above threshold.
+    method selects how the pairs are found, SIM_METHOD by default.
+    '''
+    articles_df = load_articles()
+    tf_idf, _, _ = build_tfidf(articles_df["content"])
+    return similar_articles(tf_idf, articles_df["content"], threshold, top_k, method, chunk_size)
+
+
+def build_sim_index(tf_idf, vocab, idf, article_ids):
+    '''
+    similarity index of the corpus, used to compare new articles against it
+    without recomputing the whole tf-idf matrix. the l2-normalized document
+    vectors are kept column-major so a new document only touches the postings
+    of its own words.
+    '''
+    return {
+        "matrix": normalize_rows(tf_idf).tocsc(),
+        "vocab": np.asarray(vocab, dtype=str),
+        "vocab_index": {str(word): idx for idx, word in enumerate(vocab)},
+        "idf": np.asarray(idf, dtype=np.float64),
+        "article_ids": np.asarray(article_ids, dtype=np.int64),
+        "pending": [],
+    }
+
+
+def save_sim_index(path, index):
+    '''write the index to an .npz file, folding in documents added since it was loaded'''
+    flush_sim_index(index)
+    matrix = index["matrix"]
+    np.savez(
+        path,
+        data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.array(matrix.shape),
+        vocab=index["vocab"], idf=index["idf"], article_ids=index["article_ids"]
+    )
+
+
+def load_sim_index(path):
+    with np.load(path) as stored:
+        matrix = sparse.csc_matrix(
+            (stored["data"], stored["indices"], stored["indptr"]), shape=tuple(stored["shape"])
+        )
+        return {
+            "matrix": matrix,
+            "vocab": stored["vocab"],
+            "vocab_index": {str(word): idx for idx, word in enumerate(stored["vocab"])},
+            "idf": stored["idf"],
+            "article_ids": stored["article_ids"],
+            "pending": [],
+        }
+
+
+def vectorize(index, content):
+    '''
+    normalized tf-idf vector of a new document using the stored idf.
+    words not in the vocabulary are added with the idf of a term seen in one document.
+    return (column indices, weights)
+    '''
+    _, tokens = tokenize(pd.Series([content]))
+    if not len(tokens):
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    words, counts = np.unique(tokens, return_counts=True)
+    cols = np.array([index["vocab_index"].get(str(word), -1) for word in words], dtype=np.int64)
+
+    new_words = cols < 0
+    if new_words.any():
+        n_docs = len(index["article_ids"]) + len(index["pending"])
+        new_cols = np.arange(len(index["vocab"]), len(index["vocab"]) + new_words.sum())
+        index["vocab"] = np.concatenate([index["vocab"], words[new_words].astype(str)])
+        index["vocab_index"].update(zip(words[new_words].tolist(), new_cols.tolist()))
+        index["idf"] = np.concatenate([index["idf"], np.full(len(new_cols), np.log(max(n_docs, 1)))])
+        cols[new_words] = new_cols
+
+    weights = counts / counts.sum() * index["idf"][cols]
+    norm = np.linalg.norm(weights)
+    if norm > 0:
+        weights = weights / norm
+    return cols, weights
+
+
+def add_document(index, article_id, content, threshold=SIM_THRESHOLD, top_k=SIM_TOP_K):
+    '''
+    add a new document to the index and find its most similar documents.
+    the cost depends on the postings of the document's words, not on the corpus size squared.
+    return (article ids, similarities) of the top_k neighbours above threshold, most similar first.
+    '''
+    cols, weights = vectorize(index, content)
+    matrix = index["matrix"]
+
+    known = cols < matrix.shape[1]
+    sims = matrix[:, cols[known]] @ weights[known]
+    ids = index["article_ids"]
+
+    # documents added since the last flush are not in the matrix yet
+    if index["pending"]:
+        pending_sims = [
+            _sparse_dot(p_cols, p_weights, cols, weights) for _, p_cols, p_weights in index["pending"]
+        ]
+        sims = np.concatenate([sims, pending_sims])
+        ids = np.concatenate([ids, [p_id for p_id, _, _ in index["pending"]]])
+
+    candidates = np.flatnonzero(sims > threshold)
+    candidates = candidates[np.argsort(-sims[candidates], kind="stable")][:top_k]
+    index["pending"].append((article_id, cols, weights))
+    return ids[candidates], sims[candidates]
+
+
+def _sparse_dot(cols_a, weights_a, cols_b, weights_b):
+    _, idx_a, idx_b = np.intersect1d(cols_a, cols_b, assume_unique=True, return_indices=True)
+    return float(weights_a[idx_a] @ weights_b[idx_b])
+
+
+def flush_sim_index(index):
+    '''append the pending documents as new rows of the index matrix'''
+    if not index["pending"]:
+        return
+    n_vocab = len(index["vocab"])
+    rows = np.concatenate([np.full(len(cols), i) for i, (_, cols, _) in enumerate(index["pending"])])
+    cols = np.concatenate([cols for _, cols, _ in index["pending"]])
+    weights = np.concatenate([weights for _, _, weights in index["pending"]])
+    new_rows = sparse.csr_matrix((weights, (rows, cols)), shape=(len(index["pending"]), n_vocab))
 
-    similarity_matrix = cosine_similarity(tf_idf)
-    return similarity_matrix
+    matrix = index["matrix"]
+    matrix = sparse.csc_matrix((matrix.data, matrix.indices, np.pad(matrix.indptr, (0, n_vocab - matrix.shape[1]), mode="edge")),
+                               shape=(matrix.shape[0], n_vocab))
+    index["matrix"] = sparse.vstack([matrix, new_rows], format="csc")
+    index["article_ids"] = np.concatenate([index["article_ids"], [p_id for p_id, _, _ in index["pending"]]]).astype(np.int64)
+    index["pending"] = []
@@ -0,0 +1,93 @@
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import Response, request, json
+
+# max number of (endpoint, parameters) payloads kept
+RESPONSE_CACHE_SIZE = 256
+
+# key -> entry, least recently used first
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+# lookups answered from the cache and lookups that built the payload
+_response_cache_stats = {"hits": 0, "misses": 0}
+
+
+def files_fingerprint(files):
+    '''modification time and size of every data file a payload is built from'''
+    fingerprint = []
+    for path in files:
+        stat = os.stat(path)
+        fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+def _encode(payload, fingerprint):
+    body = json.dumps(payload).encode("utf-8")
+    return {
+        "fingerprint": fingerprint,
+        "body": body,
+        "gzip_body": gzip.compress(body, compresslevel=6),
+        "etag": hashlib.sha1(body).hexdigest(),
+    }
+
+
+def cached_payload(key, files, build):
+    '''
+    encoded payload for key, built with build() only when it is missing or one
+    of files changed since it was built.
+    '''
+    fingerprint = files_fingerprint(files)
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is not None and entry["fingerprint"] == fingerprint:
+            _response_cache.move_to_end(key)
+            _response_cache_stats["hits"] += 1
+            return entry
+        _response_cache_stats["misses"] += 1
+
+    # build outside the lock, concurrent misses on the same key just do the work twice
+    entry = _encode(build(), fingerprint)
+    with _response_cache_lock:
+        _response_cache[key] = entry
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+    return entry
+
+
+def cached_json_response(key, files, build):
+    '''
+    json response served from pre-encoded (and pre-gzipped) bytes.
+    key identifies the endpoint and its parameters, files are the data files the
+    payload depends on and build() returns the payload when it has to be (re)built.
+    GET requests carrying a matching If-None-Match get an empty 304.
+    '''
+    entry = cached_payload(key, files, build)
+    use_gzip = request.accept_encodings["gzip"] > 0
+    # each encoding is its own representation and needs its own etag
+    etag = entry["etag"] + ("-gzip" if use_gzip else "")
+
+    if request.method in ("GET", "HEAD") and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry["gzip_body"] if use_gzip else entry["body"], mimetype="application/json")
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    # clients may keep the payload but have to revalidate it
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def response_cache_stats():
+    with _response_cache_lock:
+        return {**_response_cache_stats, "size": len(_response_cache), "max_size": RESPONSE_CACHE_SIZE}
+
+
+def clear_response_cache():
+    with _response_cache_lock:
+        _response_cache.clear()
@@ -0,0 +1,157 @@
+import os
+from bisect import bisect_left
+import numpy as np
+import pandas as pd
+from array_store import (
+    source_fingerprint, write_array_store, read_store_meta, load_array_store, pack_strings, unpack_strings, string_at,
+)
+from sentiment_tables import load_sentiment_tables, expand_sentiment_tables
+
+# bump when the layout of a sentiment store changes
+SENTIMENT_STORE_VERSION = 1
+SENTIMENT_STORE_SUFFIX = ".q2"
+
+# arrays of a sentiment store, one .npy file each
+SENTIMENT_ARRAYS = [
+    "entity_bytes", "entity_offsets", "source_bytes", "source_offsets",
+    "pair_source", "pair_entity", "pair_sentiment", "pair_content",
+    "content_bytes", "content_offsets",
+    "source_starts", "entity_order", "entity_starts",
+]
+
+
+def build_sentiment_store(df):
+    '''
+    pre-aggregate the expanded entity sentiment table for the Q2 routes.
+    the mean entity_sentiment and first content of every (source, entity) pair
+    are computed once and kept as flat arrays of pairs ordered by (source,
+    entity), with the slice of every source and a permutation ordering them by
+    (entity, source). contents are stored once each, as one utf-8 buffer.
+    same values and order as grouping the filtered rows per request.
+    '''
+    pairs = (
+        df.groupby(["source", "entities"], sort=True)
+        .agg({"entity_sentiment": "mean", "content": "first"})
+        .reset_index()
+    )
+    entities = sorted(df["entities"].dropna().unique())
+    sources = sorted(df["source"].dropna().unique())
+    pair_source = pd.Index(sources).get_indexer(pairs["source"]).astype(np.int32)
+    pair_entity = pd.Index(entities).get_indexer(pairs["entities"]).astype(np.int32)
+    # contents shared by several pairs (one article, many entities) are kept once, -1 is missing
+    pair_content, contents = pd.factorize(pairs["content"])
+    entity_order = np.lexsort((pair_source, pair_entity))
+    content_bytes, content_offsets, _ = pack_strings(contents)
+
+    return {
+        "entities": entities,
+        "sources": sources,
+        "pair_source": pair_source,
+        "pair_entity": pair_entity,
+        "pair_sentiment": pairs["entity_sentiment"].to_numpy(dtype=np.float64),
+        "pair_content": pair_content.astype(np.int32),
+        "content_bytes": content_bytes,
+        "content_offsets": content_offsets,
+        "source_starts": np.searchsorted(pair_source, np.arange(len(sources) + 1)),
+        "entity_order": entity_order,
+        "entity_starts": np.searchsorted(pair_entity[entity_order], np.arange(len(entities) + 1)),
+    }
+
+
+def sentiment_store_path(csv_path):
+    '''directory holding the sentiment store of an expanded sentiment csv'''
+    return os.path.splitext(csv_path)[0] + SENTIMENT_STORE_SUFFIX
+
+
+def write_sentiment_store(path, store, source=None):
+    arrays = {name: store[name] for name in SENTIMENT_ARRAYS if name in store}
+    arrays["entity_bytes"], arrays["entity_offsets"], _ = pack_strings(store["entities"])
+    arrays["source_bytes"], arrays["source_offsets"], _ = pack_strings(store["sources"])
+    meta = {
+        "version": SENTIMENT_STORE_VERSION,
+        "source": source,
+        "n_pairs": len(store["pair_source"]),
+    }
+    write_array_store(path, arrays, meta)
+
+
+def read_sentiment_store(path, source=None):
+    '''
+    sentiment store from its directory with the arrays memory-mapped read only,
+    worker processes serving the same store share its pages. None when there
+    is no store of this version or it was built from another csv (source).
+    '''
+    meta = read_store_meta(path, SENTIMENT_STORE_VERSION)
+    if meta is None or (source is not None and meta["source"] != source):
+        return None
+    store = load_array_store(path, SENTIMENT_ARRAYS)
+    store["entities"] = unpack_strings(store["entity_bytes"], store["entity_offsets"])
+    store["sources"] = unpack_strings(store["source_bytes"], store["source_offsets"])
+    return store
+
+
+def load_sentiment_store(csv_path, store_path=None):
+    '''
+    sentiment store of an expanded sentiment csv. it is built (from the
+    sentiment tables) only when the store next to the csv (or at store_path)
+    is missing or was built from a different version of the csv.
+    '''
+    store_path = store_path or sentiment_store_path(csv_path)
+    source = source_fingerprint(csv_path)
+    store = read_sentiment_store(store_path, source)
+    if store is not None:
+        return store
+
+    print(f"Building sentiment store {store_path}")
+    store = build_sentiment_store(expand_sentiment_tables(*load_sentiment_tables(csv_path)))
+    try:
+        write_sentiment_store(store_path, store, source)
+    except OSError as e:
+        # read only data directory, serve from memory
+        print(f"Warning: could not write {store_path}: {e}")
+        return store
+    return read_sentiment_store(store_path, source)
+
+
+def _find(names, name):
+    '''position of name in the sorted names, or None'''
+    i = bisect_left(names, name)
+    return i if i < len(names) and names[i] == name else None
+
+
+def _contents(store, codes):
+    data, offsets = store["content_bytes"], store["content_offsets"]
+    return [string_at(data, offsets, code) if code >= 0 else np.nan for code in codes.tolist()]
+
+
+def source_columns(store, source):
+    '''{"entities", "sentiments", "contents"} of one source, empty if unknown'''
+    i = _find(store["sources"], source)
+    if i is None:
+        return {"entities": [], "sentiments": [], "contents": []}
+    rows = slice(int(store["source_starts"][i]), int(store["source_starts"][i + 1]))
+    entities = store["entities"]
+    return {
+        "entities": [entities[code] for code in store["pair_entity"][rows].tolist()],
+        "sentiments": store["pair_sentiment"][rows].tolist(),
+        "contents": _contents(store, store["pair_content"][rows]),
+    }
+
+
+def entity_columns(store, entity):
+    '''{"sources", "sentiments", "contents"} of one entity, empty if unknown'''
+    i = _find(store["entities"], entity)
+    if i is None:
+        return {"sources": [], "sentiments": [], "contents": []}
+    rows = store["entity_order"][int(store["entity_starts"][i]):int(store["entity_starts"][i + 1])]
+    sources = store["sources"]
+    return {
+        "sources": [sources[code] for code in store["pair_source"][rows].tolist()],
+        "sentiments": store["pair_sentiment"][rows].tolist(),
+        "contents": _contents(store, store["pair_content"][rows]),
+    }
+
+
+def as_records(keys, sentiments, contents):
+    '''rows in the {"x", "y", "content"} shape the Q2 plots use'''
+    return [{"x": x, "y": y, "content": content} for x, y, content in zip(keys, sentiments, contents)]
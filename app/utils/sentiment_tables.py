@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import pandas as pd
+from array_store import pack_strings, unpack_strings
+
+# bump when the layout of the cache file changes
+TABLES_VERSION = 2
+TABLES_SUFFIX = ".tables.npz"
+
+# columns that are the same on every row of one article
+ARTICLE_COLUMNS = ["articleID", "source", "title", "author", "publish_date", "location", "content", "sentiment"]
+STRING_COLUMNS = ["title", "author", "publish_date", "location", "content"]
+
+
+def split_sentiment_df(df):
+    '''
+    split the expanded (article, entity) table into
+    articles: one row per article, source as a categorical
+    facts: one row per (article, entity) in file order, with "article" the row
+           of the article in articles, entity as a categorical and entity_sentiment.
+    every string of an article is then kept once instead of once per entity.
+    '''
+    articles = df.drop_duplicates("articleID")[ARTICLE_COLUMNS].reset_index(drop=True)
+    articles["source"] = pd.Categorical(articles["source"])
+    article_rows = pd.Index(articles["articleID"]).get_indexer(df["articleID"])
+    facts = pd.DataFrame({
+        "article": article_rows.astype(np.int32),
+        "entity": pd.Categorical(df["entities"]),
+        "entity_sentiment": df["entity_sentiment"].to_numpy(dtype=np.float64),
+    })
+    return articles, facts
+
+
+def expand_sentiment_tables(articles, facts):
+    '''
+    the (source, entities, entity_sentiment, content) columns of the expanded
+    table, in its row order. strings are shared with articles, not copied.
+    '''
+    rows = facts["article"].to_numpy()
+    return pd.DataFrame({
+        "source": articles["source"].astype(object).to_numpy()[rows],
+        "entities": facts["entity"].astype(object).to_numpy(),
+        "entity_sentiment": facts["entity_sentiment"].to_numpy(),
+        "content": articles["content"].to_numpy()[rows],
+    })
+
+
+def _pack_categorical(column):
+    buffer, offsets, _ = pack_strings(list(column.cat.categories))
+    return {"codes": column.cat.codes.to_numpy(dtype=np.int32), "buffer": buffer, "offsets": offsets}
+
+
+def _unpack_categorical(codes, buffer, offsets):
+    categories = unpack_strings(buffer, offsets)
+    return pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
+
+
+def save_sentiment_tables(path, articles, facts, fingerprint):
+    arrays = {
+        "version": np.array(TABLES_VERSION),
+        "fingerprint": np.array(fingerprint, dtype=np.int64),
+        "article_id": articles["articleID"].to_numpy(dtype=np.int64),
+        "article_sentiment": articles["sentiment"].to_numpy(dtype=np.float64),
+        "fact_article": facts["article"].to_numpy(dtype=np.int32),
+        "fact_sentiment": facts["entity_sentiment"].to_numpy(dtype=np.float64),
+    }
+    for name, packed in (("source", _pack_categorical(articles["source"])), ("entity", _pack_categorical(facts["entity"]))):
+        for part, array in packed.items():
+            arrays[f"{name}_{part}"] = array
+    for column in STRING_COLUMNS:
+        arrays[f"{column}_buffer"], arrays[f"{column}_offsets"], arrays[f"{column}_null"] = pack_strings(articles[column].tolist())
+
+    # write next to the final file and swap, a reader never sees half a cache
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_sentiment_tables(path, fingerprint=None):
+    '''
+    (articles, facts) from a cache file, or None when it is missing, has an
+    older layout or was built from a different csv (fingerprint)
+    '''
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as stored:
+        if int(stored["version"]) != TABLES_VERSION:
+            return None
+        if fingerprint is not None and tuple(stored["fingerprint"].tolist()) != tuple(fingerprint):
+            return None
+        articles = pd.DataFrame({"articleID": stored["article_id"]})
+        articles["source"] = _unpack_categorical(stored["source_codes"], stored["source_buffer"], stored["source_offsets"])
+        for column in STRING_COLUMNS:
+            articles[column] = unpack_strings(stored[f"{column}_buffer"], stored[f"{column}_offsets"], stored[f"{column}_null"])
+        articles["sentiment"] = stored["article_sentiment"]
+        facts = pd.DataFrame({
+            "article": stored["fact_article"],
+            "entity": _unpack_categorical(stored["entity_codes"], stored["entity_buffer"], stored["entity_offsets"]),
+            "entity_sentiment": stored["fact_sentiment"],
+        })
+    return articles[ARTICLE_COLUMNS], facts
+
+
+def load_sentiment_tables(csv_path, cache_path=None):
+    '''
+    normalized (articles, facts) tables of an expanded sentiment csv.
+    the csv is parsed only when the binary cache next to it (or at cache_path)
+    is missing or was built from a different version of the csv.
+    '''
+    if cache_path is None:
+        cache_path = os.path.splitext(csv_path)[0] + TABLES_SUFFIX
+    stat = os.stat(csv_path)
+    fingerprint = (stat.st_size, stat.st_mtime_ns)
+
+    tables = read_sentiment_tables(cache_path, fingerprint)
+    if tables is not None:
+        return tables
+
+    print(f"Building sentiment tables cache {cache_path}")
+    articles, facts = split_sentiment_df(pd.read_csv(csv_path))
+    try:
+        save_sentiment_tables(cache_path, articles, facts, fingerprint)
+    except OSError as e:
+        # read only data directory, serve from memory
+        print(f"Warning: could not write {cache_path}: {e}")
+    return articles, facts
@@ -1,4 +1,9 @@
 #!/bin/bash
 
-(cd app/backend && python ./app.py) &
+# VAST_WORKERS=4 ./run.sh serves the backend with pre-forked workers (see app/backend/serve.py)
+if [ -n "$VAST_WORKERS" ]; then
+    (cd app/backend && python ./serve.py --workers "$VAST_WORKERS") &
+else
+    (cd app/backend && python ./app.py) &
+fi
 (cd app/frontend && npm start)
\ No newline at end of file
@@ -9,4 +9,6 @@ NEWS_PATH = DATA_PATH + "/News Articles"
 
 ARTICLE_COLUMNS = ["articleID", "source", "title", "author", "publish_date", "location", "content"]
 
-NEWS_LABEL_PATTERN = re.compile(r'^(SOURCE|TITLE|PUBLISHED|AUTHOR|LOCATION|CONTENT)\s*:\s*(.+)', re.IGNORECASE)
\ No newline at end of file
+NEWS_LABEL_PATTERN = re.compile(r'^(SOURCE|TITLE|PUBLISHED|AUTHOR|LOCATION|CONTENT)\s*:\s*(.+)', re.IGNORECASE)
+# date formats seen in the article headers, tried before falling back to fuzzy parsing
+KNOWN_DATE_FORMATS = ["%Y/%m/%d", "%d %B %Y", "%B %d, %Y", "%d%B %Y"]
\ No newline at end of file
@@ -1,9 +1,15 @@
+import os
+import sys
 from flask import Flask, request, jsonify, render_template
-import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'app', 'utils')))
+from sentiment_store import build_sentiment_store, source_columns, entity_columns, as_records
+from sentiment_tables import load_sentiment_tables, expand_sentiment_tables
 
 app = Flask(__name__)
 
-df = pd.read_csv("df_expanded_with_sentiment.csv")
+# (source, entity) sentiment aggregates, computed once at startup
+sentiment = build_sentiment_store(expand_sentiment_tables(*load_sentiment_tables("df_expanded_with_sentiment.csv")))
 
 @app.route("/")
 def index():
@@ -11,66 +17,36 @@ def index():
 
 @app.route("/entities")
 def get_entities():
-    entities = sorted(df["entities"].dropna().unique())
-    return jsonify(entities)
+    return jsonify(sentiment["entities"])
 
 @app.route("/sources")
 def get_sources():
-    sources = sorted(df["source"].dropna().unique())
-    return jsonify(sources)
+    return jsonify(sentiment["sources"])
 
 @app.route("/source_data")
 def get_source_data():
     source = request.args.get("source")
     if not source:
         return jsonify([])
-    filtered = df[df["source"] == source]
-    # Group by entity, get mean sentiment and the first content for each entity
-    pivot = (
-        filtered.groupby("entities")
-        .agg({"entity_sentiment": "mean", "content": "first"})
-        .reset_index()
-    )
-    result = pivot.rename(
-        columns={"entities": "x", "entity_sentiment": "y", "content": "content"}
-    ).to_dict(orient="records")
-    return jsonify(result)
+    # mean sentiment and the first content for each entity, precomputed per source
+    columns = source_columns(sentiment, source)
+    return jsonify(as_records(columns["entities"], columns["sentiments"], columns["contents"]))
 
 @app.route("/source_entity_heatmap")
 def source_entity_heatmap():
     source = request.args.get("source")
     if not source:
         return jsonify({"entities": [], "sentiments": [], "contents": []})
-    filtered = df[df["source"] == source]
-    # Group by entity, get mean sentiment and the first content for each entity
-    pivot = (
-        filtered.groupby("entities")
-        .agg({"entity_sentiment": "mean", "content": "first"})
-        .reset_index()
-    )
-    result = {
-        "entities": pivot["entities"].tolist(),
-        "sentiments": pivot["entity_sentiment"].tolist(),
-        "contents": pivot["content"].tolist()
-    }
-    return jsonify(result)
+    return jsonify(source_columns(sentiment, source))
 
 @app.route("/data")
 def get_data():
     entity = request.args.get("entity")
     if not entity:
         return jsonify([])
-    filtered = df[df["entities"] == entity]
-    # Group by source, get mean sentiment and the first content for each source
-    pivot = (
-        filtered.groupby("source")
-        .agg({"entity_sentiment": "mean", "content": "first"})
-        .reset_index()
-    )
-    result = pivot.rename(
-        columns={"source": "x", "entity_sentiment": "y", "content": "content"}
-    ).to_dict(orient="records")
-    return jsonify(result)
+    # mean sentiment and the first content for each source, precomputed per entity
+    columns = entity_columns(sentiment, entity)
+    return jsonify(as_records(columns["sources"], columns["sentiments"], columns["contents"]))
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -1,46 +1,13 @@
 import os
-import re
+import sys
 import json
 from flask import Flask, request, jsonify, send_from_directory, render_template
 
-app = Flask(__name__, static_folder="static", template_folder="templates")
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'app', 'utils')))
+from entity_graph import load_entity_graph, neighbourhood, graph_payload
+from response_cache import cached_json_response
 
-# === 解析 Cypher 文件 ===
-def parse_cypher_file(filepath):
-    nodes = {}
-    edges = []
-    current_source = None
-    current_target = None
-
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-
-            # 解析节点
-            if line.startswith("CREATE (") and "name:" in line:
-                match = re.search(r'\(:([A-Z]+) \{name:\s*"([^"]+)"\}\)', line)
-                if match:
-                    label, name = match.groups()
-                    nodes[name] = label
-
-            # 解析MATCH行
-            elif line.startswith("MATCH") and "{name:" in line:
-                node_matches = re.findall(r'\{name:\s*"([^"]+)"\}', line)
-                if len(node_matches) == 2:
-                    current_source, current_target = node_matches
-                else:
-                    current_source, current_target = None, None
-
-            # 解析CREATE关系
-            elif line.startswith("CREATE") and current_source and current_target:
-                weight_match = re.search(r'weight:\s*(\d+)', line)
-                weight = int(weight_match.group(1)) if weight_match else 1
-                edges.append((current_source, current_target, weight))
-                current_source, current_target = None, None
-
-    node_list = [{"id": name, "label": label} for name, label in nodes.items()]
-    link_list = [{"source": src, "target": tgt, "weight": w} for src, tgt, w in edges]
-    return {"nodes": node_list, "links": link_list}
+app = Flask(__name__, static_folder="static", template_folder="templates")
 
 
 @app.route("/")
@@ -70,27 +37,21 @@ def get_graph_data():
         else:
             cypher_path = os.path.join(os.path.dirname(__file__), "data/entity_graph_import.cypher")
         print(cypher_path)
-        graph_data = parse_cypher_file(cypher_path)
 
-        # 如果选择了组织，过滤相关节点
-        if organization:
-            filtered_nodes = set()
-            filtered_links = []
+        def build():
+            # compiled once per file version, shared across requests
+            graph = load_entity_graph(cypher_path)
 
-            filtered_nodes.add(organization)
-            for link in graph_data['links']:
-                source = link['source']
-                target = link['target']
-                if source == organization or target == organization:
-                    filtered_links.append(link)
-                    filtered_nodes.add(source)
-                    filtered_nodes.add(target)
+            # 如果选择了组织，过滤相关节点
+            if organization:
+                graph_data = neighbourhood(graph, organization)
+            else:
+                graph_data = graph_payload(graph)
 
-            graph_data['nodes'] = [node for node in graph_data['nodes'] if node['id'] in filtered_nodes]
-            graph_data['links'] = filtered_links
+            print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
+            return graph_data
 
-        print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
-        return jsonify(graph_data)
+        return cached_json_response(("graph", cypher_path, organization), [cypher_path], build)
 
     except Exception as e:
         print(f"Error processing graph data: {e}")
@@ -102,11 +63,14 @@ def get_email_graph_data():
     try:
         print("Received email graph data request")
         json_file_path = os.path.join(os.path.dirname(__file__), "data/email_graph.json")
-        with open(json_file_path, "r", encoding="utf-8") as f:
-            graph_data = json.load(f)
 
-        print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
-        return jsonify(graph_data)
+        def build():
+            with open(json_file_path, "r", encoding="utf-8") as f:
+                graph_data = json.load(f)
+            print(f"Returning {len(graph_data['nodes'])} nodes and {len(graph_data['links'])} links")
+            return graph_data
+
+        return cached_json_response(("email_graph",), [json_file_path], build)
 
     except Exception as e:
         print(f"Error processing email graph data: {e}")